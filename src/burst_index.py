@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+###############################################################################
+# burst_index.py
+#
+# Project:  ADP INSAR
+# Purpose:  Index the bursts of a Sentinel-1 SAFE once and keep the index in
+#           a sidecar file next to it
+#
+###############################################################################
+# Copyright (c) 2018, Alaska Satellite Facility
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+###############################################################################
+
+import logging
+import argparse
+import os
+import glob
+import json
+import numpy as np
+from lxml import etree
+
+INDEX_VERSION = 3
+
+# Bursts of two acquisitions match when their ANX times are this close (s)
+MATCH_TOLERANCE = 0.20
+
+# ESA burst ID definition: orbit period, burst cycle and the time from the
+# ascending node to the start of the first burst cycle (s), and the orbits
+# in a repeat cycle
+ORBIT_PERIOD = 12 * 86400.0 / 175
+BURST_PERIOD = 2.758273
+BURST_PREAMBLE = 2.299849
+ORBITS_PER_CYCLE = 175
+
+# First absolute orbit of relative orbit 1 of each mission
+ORBIT_OFFSET = {"S1A": 73, "S1B": 27}
+
+_indexes = {}
+
+#
+# ESA relative burst IDs of the bursts of a swath, from the ANX times of
+# their first lines (s), the time from their first to their middle line
+# and the absolute orbit of the product.  None if the mission is unknown.
+#
+def burstIds(times,half,mission,orbit):
+    if mission not in ORBIT_OFFSET or orbit is None:
+        return None
+    relative = (orbit - ORBIT_OFFSET[mission]) % ORBITS_PER_CYCLE + 1
+    dt = np.asarray(times,dtype=float) + half + (relative - 1) * ORBIT_PERIOD
+    dt = np.mod(dt,ORBITS_PER_CYCLE * ORBIT_PERIOD)
+    return [int(x) for x in np.floor((dt - BURST_PREAMBLE) / BURST_PERIOD) + 1]
+
+#
+# Read one annotation file in a single streaming pass
+#
+def parseAnnotation(xml):
+    times = []
+    ids = []
+    count = 0
+    lines = None
+    interval = None
+    mission = None
+    orbit = None
+    utc = None
+    points = []
+    for event,elem in etree.iterparse(xml,events=("end",)):
+        tag = elem.tag
+        if tag == "azimuthAnxTime":
+            times.append(float(elem.text))
+        elif tag == "burstList":
+            count = int(elem.attrib["count"])
+        elif tag == "burstId":
+            ids.append(int(elem.text))
+        elif tag == "linesPerBurst":
+            lines = int(elem.text)
+        elif tag == "azimuthTimeInterval" and interval is None:
+            interval = float(elem.text)
+        elif tag == "missionId" and mission is None:
+            mission = elem.text
+        elif tag == "absoluteOrbitNumber" and orbit is None:
+            orbit = int(elem.text)
+        elif tag == "productFirstLineUtcTime":
+            utc = elem.text
+        elif tag == "geolocationGridPoint":
+            points.append((int(elem.findtext("line")),float(elem.findtext("latitude")),
+                           float(elem.findtext("longitude"))))
+            elem.clear()
+        elif tag == "burst":
+            elem.clear()
+
+    # Footprint (ymax,ymin,xmax,xmin) of each burst from the grid points
+    # within half a burst of it
+    footprints = []
+    if lines and points:
+        pts = np.array(points)
+        for k in range(1,count+1):
+            sel = (pts[:,0] >= (k - 1.5) * lines) & (pts[:,0] <= (k + 0.5) * lines)
+            if sel.any():
+                lat = pts[sel,1]
+                lon = pts[sel,2]
+                footprints.append([lat.max(),lat.min(),lon.max(),lon.min()])
+            else:
+                footprints.append(None)
+
+    # Older products don't list the burst IDs; they are worked out from the
+    # burst times as ESA defines them
+    if len(ids) != len(times):
+        ids = None
+        if lines and interval:
+            ids = burstIds(times,lines * interval / 2.0,mission,orbit)
+
+    name = os.path.basename(xml)
+    t = name.split("-")
+    return {"file": name, "swath": t[1].lower(), "pol": t[3].lower(), "count": count, "times": times,
+            "ids": ids, "lines_per_burst": lines, "first_line_utc": utc, "footprints": footprints}
+
+def indexPath(safe):
+    return os.path.realpath(safe).rstrip("/") + ".bursts.json"
+
+def annotationFiles(safe):
+    return sorted(glob.glob(os.path.join(safe,"annotation","s1*.xml")))
+
+#
+# Swaths are keyed by swath and polarization (e.g. iw1-vv); the number at
+# the end of the file names depends on how many polarizations the product
+# has, so it can't be used to find a swath
+#
+def swathKey(swath,pol):
+    return "{}-{}".format(swath.lower(),pol.lower())
+
+def buildBurstIndex(safe):
+    xmls = annotationFiles(safe)
+    if not xmls:
+        logging.error("ERROR: No annotation files found in {}".format(os.path.join(safe,"annotation")))
+        exit(1)
+    index = {"version": INDEX_VERSION, "safe": os.path.basename(os.path.realpath(safe)),
+             "annotations": [os.path.basename(x) for x in xmls], "files": {}}
+    for xml in xmls:
+        swath = parseAnnotation(xml)
+        index["files"][swathKey(swath["swath"],swath["pol"])] = swath
+
+    path = indexPath(safe)
+    tmp = "{}.tmp{}".format(path,os.getpid())
+    try:
+        f = open(tmp,"w")
+        json.dump(index,f)
+        f.close()
+        os.rename(tmp,path)
+    except (IOError,OSError) as e:
+        logging.warning("WARNING: Unable to save burst index {}: {}".format(path,e))
+    logging.info("Indexed {} annotation files of {}".format(len(xmls),safe))
+    return index
+
+#
+# The burst index of a SAFE directory, read from its sidecar file or built
+# if there is none yet, or if the annotation files have changed since (e.g.
+# more polarizations were extracted)
+#
+def getBurstIndex(safe):
+    path = indexPath(safe)
+    if path in _indexes:
+        return _indexes[path]
+    index = None
+    if os.path.isfile(path):
+        f = open(path,"r")
+        try:
+            index = json.load(f)
+        except ValueError:
+            index = None
+        f.close()
+        if index is not None and (index.get("version") != INDEX_VERSION or
+                                  index.get("annotations") != [os.path.basename(x) for x in annotationFiles(safe)]):
+            index = None
+    if index is None:
+        index = buildBurstIndex(safe)
+    _indexes[path] = index
+    return index
+
+#
+# The index entry of a swath (iw1, iw2 or iw3) in the given polarization,
+# or in any of them (burst timing is the same in all) if pol is None
+#
+def getSwath(safe,swath,pol=None):
+    files = getBurstIndex(safe)["files"]
+    if pol is not None:
+        key = swathKey(swath,pol)
+        if key in files:
+            return files[key]
+    else:
+        keys = sorted(k for k in files if k.startswith(swath.lower() + "-"))
+        if keys:
+            return files[keys[0]]
+    logging.error("ERROR: No annotation for swath {} {}in {}".format(swath,"" if pol is None else pol + " ",safe))
+    exit(1)
+
+#
+# Values to match the bursts of two swath index entries on, and the
+# tolerance to match them with: their burst IDs if both have them,
+# otherwise their ANX times
+#
+def burstKeys(a,b):
+    if a.get("ids") is not None and b.get("ids") is not None:
+        return a["ids"],b["ids"],0.5
+    return a["times"],b["times"],MATCH_TOLERANCE
+
+#
+# 1-based numbers of the bursts in times matching each of the given times,
+# 0 where there is none.  times must be increasing, as burst times (and
+# burst IDs) are.
+#
+def matchBursts(times,targets,tol=MATCH_TOLERANCE):
+    times = np.asarray(times,dtype=float)
+    targets = np.atleast_1d(np.asarray(targets,dtype=float))
+    if len(times) == 0:
+        return np.zeros(len(targets),dtype=int)
+    i = np.searchsorted(times,targets)
+    lo = np.clip(i - 1,0,len(times)-1)
+    hi = np.clip(i,0,len(times)-1)
+    nearest = np.where(np.abs(times[lo] - targets) <= np.abs(times[hi] - targets),lo,hi)
+    ok = np.abs(times[nearest] - targets) < tol
+    return np.where(ok,nearest + 1,0)
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='burst_index.py',
+    description='Build the burst index of Sentinel-1 SAFE directories')
+  parser.add_argument("safes",nargs="*",help="SAFE directories (def=all in the current directory)")
+  args = parser.parse_args()
+
+  logFile = "burst_index_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  for safe in args.safes or glob.glob("*.SAFE"):
+      buildBurstIndex(safe)
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+import logging
+import os
+import json
+import hashlib
+import threading
+from telemetry import set_stage
+
+#
+# Files smaller than this are fingerprinted by content, larger ones
+# (SLCs, interferograms) by size and modification time
+#
+HASH_LIMIT = 1024*1024
+
+def fingerprint(name):
+    if not os.path.isfile(name):
+        return None
+    st = os.stat(name)
+    if st.st_size <= HASH_LIMIT:
+        h = hashlib.sha1()
+        f = open(name,"rb")
+        h.update(f.read())
+        f.close()
+        return "sha1:{}".format(h.hexdigest())
+    return "stat:{}:{}".format(st.st_size,int(st.st_mtime*1000))
+
+#
+# Bytes used by the files under root, not following links
+#
+def disk_usage(root):
+    total = 0
+    for dirpath,dirnames,filenames in os.walk(root):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath,name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+#
+# Samples the disk use of a directory in the background while a stage runs
+#
+class DiskMonitor(object):
+
+    def __init__(self,root,interval=5.0):
+        self.root = root
+        self.interval = interval
+        self.peak = disk_usage(root)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak,disk_usage(self.root))
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        final = disk_usage(self.root)
+        self.peak = max(self.peak,final)
+        return self.peak,final
+
+#
+# Record of the completed processing stages in a work directory.  Each stage
+# stores the fingerprints of its input and output files; on a resumed run a
+# stage is skipped while its outputs exist unchanged and its inputs are the
+# same as when it last ran.  Stages form a linear sequence, so once any
+# stage has to run again every stage after it runs as well.
+#
+# Intermediate files registered with temporary() are deleted as soon as
+# every stage reading them is done (unless keep is set).  Deleted files are
+# remembered, so they don't make the stages around them look out of date.
+#
+class Manifest(object):
+
+    def __init__(self,root=".",name="checkpoint.json",resume=False,keep=False):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root,name)
+        self.stages = {}
+        self.released = []
+        self.temporaries = {}
+        self.finished = set()
+        self.keep = keep
+        self.ran = False
+        if resume and os.path.isfile(self.path):
+            f = open(self.path,"r")
+            self.stages = json.load(f)
+            f.close()
+            self.released = self.stages.pop("_released",[])
+            logging.info("Resuming from {} with {} completed stages".format(self.path,len(self.stages)))
+
+    def _key(self,name):
+        return os.path.relpath(os.path.abspath(name),self.root)
+
+    def _prints(self,names):
+        return dict((self._key(name),fingerprint(name)) for name in names)
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        f = open(tmp,"w")
+        stages = dict(self.stages)
+        stages["_released"] = self.released
+        json.dump(stages,f,indent=2,sort_keys=True)
+        f.close()
+        os.rename(tmp,self.path)
+
+    def is_done(self,stage,inputs=()):
+        if self.ran or stage not in self.stages:
+            return False
+        rec = self.stages[stage]
+        for name,fp in rec["outputs"].items():
+            if name in self.released:
+                continue
+            if fp is None or fingerprint(os.path.join(self.root,name)) != fp:
+                logging.info("Stage {}: output {} changed or missing".format(stage,name))
+                return False
+        prints = self._prints(inputs)
+        for name,fp in rec["inputs"].items():
+            if name in self.released:
+                prints[name] = fp
+        if prints != rec["inputs"]:
+            logging.info("Stage {}: inputs changed".format(stage))
+            return False
+        return True
+
+    def record(self,stage,inputs=(),outputs=(),result=None,disk=None):
+        self.stages[stage] = {"inputs": self._prints(inputs),
+                              "outputs": self._prints(outputs),
+                              "result": result}
+        if disk is not None:
+            self.stages[stage]["disk"] = disk
+        self._save()
+
+    #
+    # Register intermediate files (relative to the current directory) that
+    # the named stages read, to be deleted once all of them are done
+    #
+    def temporary(self,names,consumers):
+        for name in names:
+            key = self._key(name)
+            self.temporaries.setdefault(key,set()).update(consumers)
+        self._release()
+
+    def _release(self):
+        for key,consumers in list(self.temporaries.items()):
+            if not consumers.issubset(self.finished):
+                continue
+            del self.temporaries[key]
+            if self.keep:
+                continue
+            path = os.path.join(self.root,key)
+            if os.path.isfile(path) or os.path.islink(path):
+                os.remove(path)
+                logging.info("Removed intermediate file {}".format(key))
+            if key not in self.released:
+                self.released.append(key)
+        self._save()
+
+    def _finish(self,stage):
+        self.finished.add(stage)
+        self._release()
+
+    #
+    # Files the stage reads that have already been deleted as intermediates
+    #
+    def _missing(self,stage,inputs):
+        keys = set(self._key(name) for name in inputs)
+        keys.update(key for key,consumers in self.temporaries.items() if stage in consumers)
+        return sorted(key for key in keys if key in self.released and
+                      not os.path.exists(os.path.join(self.root,key)))
+
+    def _check_inputs(self,stage,inputs):
+        missing = self._missing(stage,inputs)
+        if missing:
+            logging.error("ERROR: Stage {} needs intermediate files that were removed ({}); "
+                          "rerun without resuming".format(stage,", ".join(missing)))
+            exit(1)
+
+    def _report(self,stage,peak,final):
+        mb = 1024.0 * 1024.0
+        logging.info("Stage {}: peak {:.1f} MB, final {:.1f} MB on disk".format(stage,peak/mb,final/mb))
+        return {"peak": peak, "final": final}
+
+    #
+    # Run func(*args,**kwargs) as the named stage unless it is already done.
+    # The return value is stored so that a skipped stage returns it again.
+    #
+    def run(self,stage,func,inputs=(),outputs=(),*args,**kwargs):
+        if self.is_done(stage,inputs):
+            logging.info("Stage {} is up to date; skipping".format(stage))
+            self._finish(stage)
+            return self.stages[stage]["result"]
+        self._check_inputs(stage,inputs)
+        self.stages.pop(stage,None)
+        self.ran = True
+        set_stage(stage)
+        monitor = DiskMonitor(self.root)
+        try:
+            result = func(*args,**kwargs)
+        finally:
+            peak,final = monitor.finish()
+        self.record(stage,inputs,outputs,result,self._report(stage,peak,final))
+        self._finish(stage)
+        return result
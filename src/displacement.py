@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import time
+import numpy as np
+from gamma_io import par, read_raster, create_raster, FLOAT
+
+# Map lines handled per pass
+CHUNK = 512
+
+SPEED_OF_LIGHT = 299792458.0
+
+# Displacement components written by displacement_maps
+COMPONENTS = ("los","vert","east","north","up")
+
+#
+# Displacement in meters from unwrapped phase and the look vector, all in
+# map geometry.  lv_theta is the elevation angle of the look vector and
+# lv_phi its orientation counterclockwise from east, both in radians, as
+# written by look_vector; the look vector points from the ground to the
+# sensor.  As with dispmap, displacement is positive toward the sensor
+# (uplift), and the vertical component assumes all motion is vertical.
+# The east, north and up components are the line of sight displacement
+# projected onto the look vector.
+#
+# outputs maps the components wanted (see COMPONENTS) to file names.
+# Pixels without phase or outside the DEM are 0.
+#
+def displacement_maps(unw,lv_theta,lv_phi,mlipar,width,outputs):
+    t0 = time.time()
+    wavelength = SPEED_OF_LIGHT / par(mlipar).float("radar_frequency")
+    scale = -wavelength / (4.0*np.pi)
+
+    phase = read_raster(unw,width,type=FLOAT)
+    theta = read_raster(lv_theta,width,type=FLOAT)
+    phi = read_raster(lv_phi,width,type=FLOAT)
+    nlines = min(phase.shape[0],theta.shape[0],phi.shape[0])
+    outs = {}
+    for name in outputs:
+        if name not in COMPONENTS:
+            raise ValueError("Unknown displacement component {}".format(name))
+        outs[name] = create_raster(outputs[name],width,nlines,type=FLOAT)
+
+    for a0 in range(0,nlines,CHUNK):
+        a1 = min(nlines,a0+CHUNK)
+        ph = np.array(phase[a0:a1],dtype=np.float64)
+        th = np.array(theta[a0:a1],dtype=np.float64)
+        valid = (ph != 0) & (th != 0)
+        los = np.where(valid,scale*ph,0.0)
+        if "los" in outs:
+            outs["los"][a0:a1] = los
+        if "vert" in outs:
+            sin = np.sin(th)
+            ok = valid & (np.abs(sin) > 1e-6)
+            outs["vert"][a0:a1] = np.where(ok,los/np.where(ok,sin,1.0),0.0)
+        if "east" in outs or "north" in outs:
+            ph = np.array(phi[a0:a1],dtype=np.float64)
+            horizontal = los*np.cos(th)
+            if "east" in outs:
+                outs["east"][a0:a1] = horizontal*np.cos(ph)
+            if "north" in outs:
+                outs["north"][a0:a1] = horizontal*np.sin(ph)
+        if "up" in outs:
+            outs["up"][a0:a1] = los*np.sin(th)
+
+    for name in outs:
+        outs[name].flush()
+    del outs
+    logging.info("Wrote {} displacement maps of {} x {} in {:.1f}s".format(
+                 len(outputs),width,nlines,time.time()-t0))
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='displacement.py',
+    description='Compute displacement maps from geocoded unwrapped phase in a single pass')
+  parser.add_argument("unw",help='Geocoded unwrapped phase (e.g. <ifg>.adf.unw.geo)')
+  parser.add_argument("theta",help='Look vector elevation angle (e.g. lv_theta)')
+  parser.add_argument("phi",help='Look vector orientation angle (e.g. lv_phi)')
+  parser.add_argument("mlipar",help='MLI parameter file giving the radar frequency')
+  parser.add_argument("dempar",help='DEM segment parameter file (e.g. DEM/demseg.par)')
+  parser.add_argument("output",help='Output prefix; maps are named <output>.<component>.disp.geo')
+  parser.add_argument("-c","--components",nargs="+",default=["los","vert"],choices=COMPONENTS,
+    help="Components to compute (def=los vert)")
+  args = parser.parse_args()
+
+  logFile = "displacement_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  demw,demn = par(args.dempar).shape()
+  displacement_maps(args.unw,args.theta,args.phi,args.mlipar,demw,
+      dict((c,"{}.{}.disp.geo".format(args.output,c)) for c in args.components))
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import logging
+import os
+import json
+import fcntl
+import hashlib
+import shutil
+import time
+
+#
+# A directory of cached results shared between processes.  Each entry is a
+# subdirectory named by the hash of what the result was made from, so an
+# entry never needs to be invalidated, only evicted.  Entries are evicted
+# least recently used first once the cache grows past quota bytes.
+#
+class FileCache(object):
+
+    def __init__(self,root,quota=None):
+        self.root = os.path.abspath(root)
+        self.quota = quota
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                if not os.path.isdir(self.root):
+                    raise
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts,sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _lock(self,name):
+        f = open(os.path.join(self.root,name),"a")
+        fcntl.flock(f,fcntl.LOCK_EX)
+        return f
+
+    def _unlock(self,f):
+        fcntl.flock(f,fcntl.LOCK_UN)
+        f.close()
+
+    def path(self,key):
+        return os.path.join(self.root,key)
+
+    def has(self,key):
+        return os.path.isfile(os.path.join(self.path(key),".complete"))
+
+    #
+    # Copy the files of an entry into dest; returns (False,None) on a miss
+    # and (True,info) on a hit
+    #
+    def fetch(self,key,dest):
+        if not self.has(key):
+            return False,None
+        entry = self.path(key)
+        f = open(os.path.join(entry,".complete"),"r")
+        meta = json.load(f)
+        f.close()
+        names = meta["names"]
+        for name in names:
+            out = os.path.join(dest,name)
+            if not os.path.isdir(os.path.dirname(out)):
+                os.makedirs(os.path.dirname(out))
+            shutil.copy2(os.path.join(entry,name),out)
+        os.utime(os.path.join(entry,".complete"),None)
+        logging.info("Restored {} files from cache entry {}".format(len(names),entry))
+        return True,meta["info"]
+
+    #
+    # Copy the named files (relative to src) into a new entry, along with
+    # info, anything json can hold
+    #
+    def store(self,key,src,names,info=None):
+        entry = self.path(key)
+        if self.has(key):
+            return
+        tmp = "{}.tmp{}".format(entry,os.getpid())
+        shutil.rmtree(tmp,ignore_errors=True)
+        for name in names:
+            out = os.path.join(tmp,name)
+            if not os.path.isdir(os.path.dirname(out)):
+                os.makedirs(os.path.dirname(out))
+            shutil.copy2(os.path.join(src,name),out)
+        f = open(os.path.join(tmp,".complete"),"w")
+        json.dump({"names": list(names), "info": info},f)
+        f.close()
+        shutil.rmtree(entry,ignore_errors=True)
+        os.rename(tmp,entry)
+        logging.info("Stored {} files in cache entry {}".format(len(names),entry))
+        self.evict(keep=key)
+
+    #
+    # Restore an entry into dest, or run create() and store what it made
+    # along with its return value.  Callers asking for the same key wait for
+    # whoever is creating it.  names is the list of files to store, or a
+    # function returning it.  Returns whether the entry was found and the
+    # value create() returned.
+    #
+    def get_or_create(self,key,dest,create,names):
+        lock = self._lock("{}.lock".format(key))
+        try:
+            hit,info = self.fetch(key,dest)
+            if hit:
+                return True,info
+            info = create()
+            if callable(names):
+                names = names()
+            g = self._lock(".lock")
+            try:
+                self.store(key,dest,names,info)
+            finally:
+                self._unlock(g)
+            return False,info
+        finally:
+            self._unlock(lock)
+
+    def _size(self,entry):
+        total = 0
+        for dirpath,dirnames,filenames in os.walk(entry):
+            for name in filenames:
+                total += os.path.getsize(os.path.join(dirpath,name))
+        return total
+
+    def evict(self,keep=None):
+        if self.quota is None:
+            return
+        entries = []
+        for name in os.listdir(self.root):
+            entry = self.path(name)
+            if self.has(name):
+                used = os.path.getmtime(os.path.join(entry,".complete"))
+                entries.append((used,name,self._size(entry)))
+        total = sum(e[2] for e in entries)
+        for used,name,size in sorted(entries):
+            if total <= self.quota:
+                break
+            if name == keep:
+                continue
+            # Leave entries alone while someone is restoring them
+            f = open(os.path.join(self.root,"{}.lock".format(name)),"a")
+            try:
+                fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                continue
+            logging.info("Evicting cache entry {} ({} bytes, last used {})".format(
+                         name,size,time.ctime(used)))
+            shutil.rmtree(self.path(name),ignore_errors=True)
+            self._unlock(f)
+            total -= size
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+import os
+import numpy as np
+
+#
+# Data types of gamma binary files; all are big-endian
+#
+FLOAT = np.dtype(">f4")
+FCOMPLEX = np.dtype(">c8")
+BYTE = np.dtype("u1")
+SHORT = np.dtype(">i2")
+DOUBLE = np.dtype(">f8")
+
+# geocode_back data type codes (2, raster images, has no binary type)
+GEOCODE_TYPES = {0: FLOAT, 1: FCOMPLEX, 3: BYTE, 4: SHORT, 5: DOUBLE}
+
+# data2geotiff data type codes (0, raster images, has no binary type)
+GEOTIFF_TYPES = {1: SHORT, 2: FLOAT, 4: FCOMPLEX, 5: BYTE}
+
+#
+# A parsed gamma parameter file (.par, .off, DEM par).  Files are parsed
+# once and kept until they change on disk, so repeated lookups of the same
+# file are cheap.
+#
+class ParFile(object):
+
+    _cache = {}
+
+    def __init__(self,name):
+        self.name = name
+        self.params = {}
+        f = open(name,"r")
+        for line in f:
+            if ":" not in line:
+                continue
+            key,value = line.split(":",1)
+            key = key.strip()
+            if key and key not in self.params:
+                self.params[key] = value.split()
+        f.close()
+
+    @classmethod
+    def load(cls,name):
+        path = os.path.abspath(name)
+        st = os.stat(path)
+        stamp = (st.st_mtime,st.st_size)
+        hit = cls._cache.get(path)
+        if hit is None or hit[0] != stamp:
+            hit = (stamp,cls(name))
+            cls._cache[path] = hit
+        return hit[1]
+
+    def __contains__(self,key):
+        return key in self.params
+
+    def values(self,key):
+        if key not in self.params:
+            raise KeyError("{} not found in {}".format(key,self.name))
+        return self.params[key]
+
+    def get(self,key,default=None):
+        if key not in self.params or not self.params[key]:
+            return default
+        return self.params[key][0]
+
+    def int(self,key):
+        return int(self.values(key)[0])
+
+    def float(self,key):
+        return float(self.values(key)[0])
+
+    #
+    # Raster dimensions described by the file as (width, lines)
+    #
+    def shape(self):
+        for w,n in (("range_samples","azimuth_lines"),
+                    ("interferogram_width","interferogram_azimuth_lines"),
+                    ("width","nlines")):
+            if w in self.params and n in self.params:
+                return self.int(w),self.int(n)
+        raise KeyError("No raster dimensions in {}".format(self.name))
+
+def par(name):
+    return ParFile.load(name)
+
+#
+# Map a gamma raster as a (lines, width) array without reading it.  The
+# width comes from width= or the par/offset file; the number of lines from
+# the file size.
+#
+def read_raster(name,width=None,parfile=None,type=FLOAT,mode="r"):
+    dtype = np.dtype(type)
+    if width is None:
+        width = par(parfile).shape()[0]
+    width = int(width)
+    lines = os.path.getsize(name) // (width * dtype.itemsize)
+    return np.memmap(name,dtype=dtype,mode=mode,shape=(lines,width))
+
+#
+# Create a gamma raster of the given size and map it for writing
+#
+def create_raster(name,width=None,lines=None,parfile=None,type=FLOAT):
+    if width is None or lines is None:
+        width,lines = par(parfile).shape()
+    return np.memmap(name,dtype=np.dtype(type),mode="w+",shape=(int(lines),int(width)))
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import os
+import time
+import numpy as np
+from osgeo import gdal
+from telemetry import execute
+from gamma_io import par, read_raster, create_raster, FCOMPLEX, GEOCODE_TYPES
+
+# Lines of the map geometry output handled per pass
+CHUNK = 256
+
+# Largest difference from geocode_back allowed by benchmark(), as a share
+# of the data range
+TOLERANCE = 1e-3
+
+#
+# Weights of the four samples at offsets -1..+2 around a fractional offset
+# f for the bicubic spline of geocode_back interpolation mode 0: the
+# natural cubic spline (zero curvature at the ends) through the four
+# samples, evaluated between the middle two
+#
+def spline_weights(f):
+    f = f.astype(np.float64)
+    c1 = ((1.0-f)**3 - (1.0-f)) / 6.0
+    c2 = (f**3 - f) / 6.0
+    w = np.empty((4,)+f.shape,dtype=np.float32)
+    w[0] = 1.6*c1 - 0.4*c2
+    w[1] = (1.0-f) - 3.6*c1 + 2.4*c2
+    w[2] = f + 2.4*c1 - 3.6*c2
+    w[3] = -0.4*c1 + 1.6*c2
+    return w
+
+#
+# Interpolation indices and weights for one block of the lookup table.  The
+# MAP_to_RDC table is FCOMPLEX with the range pixel in the real part and
+# the azimuth line in the imaginary part; 0,0 marks points outside the scene.
+#
+class Resampler(object):
+
+    def __init__(self,lut,width,nlines):
+        x = lut.real.astype(np.float64)
+        y = lut.imag.astype(np.float64)
+        self.valid = ((x > 0.0) | (y > 0.0)) & (x >= 0.0) & (x <= width-1) & (y >= 0.0) & (y <= nlines-1)
+        x = np.where(self.valid,x,0.0)
+        y = np.where(self.valid,y,0.0)
+        ix = np.floor(x).astype(np.int64)
+        iy = np.floor(y).astype(np.int64)
+        self.wx = spline_weights(x - ix)
+        self.wy = spline_weights(y - iy)
+        self.cols = [np.clip(ix+k-1,0,width-1) for k in range(4)]
+        self.rows = [np.clip(iy+k-1,0,nlines-1) for k in range(4)]
+        self.nx = np.clip(np.rint(x).astype(np.int64),0,width-1)
+        self.ny = np.clip(np.rint(y).astype(np.int64),0,nlines-1)
+
+    def nearest(self,data):
+        out = data[...,self.ny,self.nx]
+        out[...,~self.valid] = 0
+        return out
+
+    def bicubic(self,data):
+        out = np.zeros(self.valid.shape,dtype=data.dtype)
+        for j in range(4):
+            acc = np.zeros(self.valid.shape,dtype=data.dtype)
+            for k in range(4):
+                acc += self.wx[k] * data[self.rows[j],self.cols[k]]
+            out += self.wy[j] * acc
+        # Zero is no data in gamma files; don't smear it into valid pixels
+        out[(data[self.ny,self.nx] == 0) | ~self.valid] = 0
+        return out
+
+#
+# Geocode several radar geometry layers with one pass over the lookup table.
+# layers is a list of (input, output, width, type) with type 0 for FLOAT
+# and 1 for FCOMPLEX data, as for geocode_back.
+#
+def geocode_layers(layers,lt,demw,demn,chunk=CHUNK):
+    demn = int(demn)
+    table = read_raster(lt,width=demw,type=FCOMPLEX)
+
+    groups = {}
+    for inname,outname,width,type in layers:
+        data = read_raster(inname,width=width,type=GEOCODE_TYPES[int(type)])
+        out = create_raster(outname,width=demw,lines=demn,type=GEOCODE_TYPES[int(type)])
+        groups.setdefault(data.shape,[]).append((data,out))
+
+    for r0 in range(0,demn,chunk):
+        r1 = min(r0+chunk,demn)
+        lut = np.asarray(table[r0:r1])
+        for (nlines,width),items in groups.items():
+            res = Resampler(lut,width,nlines)
+            for data,out in items:
+                out[r0:r1] = res.bicubic(data)
+
+    for items in groups.values():
+        for data,out in items:
+            out.flush()
+
+#
+# Nearest neighbour geocoding of a raster image.  Rasters GDAL can't read
+# (e.g. SUN raster) are passed on to geocode_back.
+#
+def geocode_raster(inname,outname,width,lt,demw,demn,chunk=CHUNK):
+    src = gdal.Open(inname) if os.path.isfile(inname) else None
+    if src is None or src.RasterCount not in (1,3):
+        cmd = "geocode_back {IN} {W} {LT} {OUT} {DEMW} {DEMN} 0 2".format(IN=inname,W=width,LT=lt,OUT=outname,DEMW=demw,DEMN=demn)
+        execute(cmd,uselogging=True)
+        return
+    demw = int(demw)
+    demn = int(demn)
+    data = src.ReadAsArray()
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    nlines,width = data.shape[1:]
+    table = read_raster(lt,width=demw,type=FCOMPLEX)
+    out = np.zeros((data.shape[0],demn,demw),dtype=data.dtype)
+    for r0 in range(0,demn,chunk):
+        r1 = min(r0+chunk,demn)
+        res = Resampler(np.asarray(table[r0:r1]),width,nlines)
+        out[:,r0:r1] = res.nearest(data)
+    dst = gdal.GetDriverByName("BMP").Create(outname,demw,demn,data.shape[0],gdal.GDT_Byte)
+    for b in range(data.shape[0]):
+        table = src.GetRasterBand(b+1).GetColorTable()
+        if table is not None:
+            dst.GetRasterBand(b+1).SetColorTable(table)
+        dst.GetRasterBand(b+1).WriteArray(out[b])
+    src = None
+    dst = None
+
+#
+# Time geocode_back against geocode_layers on the same layers and check
+# that the results agree: the largest difference on pixels valid in both
+# must be within TOLERANCE of the data range.  Returns the two timings and
+# whether every layer agreed.
+#
+def benchmark(layers,lt,demw,demn):
+    start = time.time()
+    for inname,outname,width,type in layers:
+        cmd = "geocode_back {IN} {W} {LT} {OUT}.ref {DEMW} {DEMN} 0 {TYPE}".format(IN=inname,W=width,LT=lt,OUT=outname,DEMW=demw,DEMN=demn,TYPE=type)
+        execute(cmd,uselogging=True)
+    subproc = time.time() - start
+
+    start = time.time()
+    geocode_layers(layers,lt,demw,demn)
+    native = time.time() - start
+
+    logging.info("geocode_back: {:.1f}s  native: {:.1f}s  ({} layers)".format(subproc,native,len(layers)))
+    ok = True
+    for inname,outname,width,type in layers:
+        a = np.fromfile(outname,dtype=GEOCODE_TYPES[int(type)])
+        b = np.fromfile(outname+".ref",dtype=GEOCODE_TYPES[int(type)])
+        both = (a != 0) & (b != 0)
+        diff = np.abs(a[both] - b[both]).max() if both.any() else 0.0
+        scale = np.abs(b[both]).max() if both.any() else 1.0
+        edge = int(((a != 0) ^ (b != 0)).sum())
+        logging.info("{}: max difference {:.3g} (data range {:.3g}); valid in only one: {}".format(
+                     outname,diff,scale,edge))
+        if diff > TOLERANCE*scale:
+            logging.error("ERROR: {} differs from geocode_back by more than {:g} of the data range".format(
+                          outname,TOLERANCE))
+            ok = False
+        os.remove(outname+".ref")
+    return subproc,native,ok
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='geocode_native.py',
+    description='Geocode gamma FLOAT layers with a lookup table in a single pass')
+  parser.add_argument("lt",help='Lookup table (e.g. DEM/MAP2RDC)')
+  parser.add_argument("dempar",help='DEM segment parameter file (e.g. DEM/demseg.par)')
+  parser.add_argument("width",help='Width of the radar geometry layers')
+  parser.add_argument("layers",nargs="+",help='Input layers; outputs are named <input>.geo')
+  parser.add_argument("-b","--benchmark",action="store_true",help="Compare against geocode_back")
+  args = parser.parse_args()
+
+  logFile = "geocode_native_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  demw,demn = par(args.dempar).shape()
+  layers = [(name,name+".geo",args.width,0) for name in args.layers]
+  if args.benchmark:
+      if not benchmark(layers,args.lt,demw,demn)[2]:
+          exit(1)
+  else:
+      geocode_layers(layers,args.lt,demw,demn)
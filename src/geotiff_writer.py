@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import os
+from osgeo import gdal, osr
+from telemetry import execute
+from gamma_io import par
+
+COG_OPTIONS = ["COMPRESS=DEFLATE","PREDICTOR=YES","NUM_THREADS=ALL_CPUS","BLOCKSIZE=512",
+               "OVERVIEWS=IGNORE_EXISTING","BIGTIFF=IF_SAFER"]
+GTIFF_OPTIONS = ["TILED=YES","BLOCKXSIZE=512","BLOCKYSIZE=512","COMPRESS=DEFLATE",
+                 "NUM_THREADS=ALL_CPUS","COPY_SRC_OVERVIEWS=YES","BIGTIFF=IF_SAFER"]
+
+#
+# Geotransform and projection of a gamma DEM parameter file, or None when
+# the projection is not one we handle (data2geotiff is used then).  Gamma
+# corner coordinates are pixel centers.
+#
+def georeference(dempar):
+    p = par(dempar)
+    proj = p.get("DEM_projection")
+    if "ellipsoid_name" not in p or "".join(p.values("ellipsoid_name")).upper() != "WGS84":
+        return None
+    srs = osr.SpatialReference()
+    if proj == "EQA":
+        x0,y0 = p.float("corner_lon"),p.float("corner_lat")
+        dx,dy = p.float("post_lon"),p.float("post_lat")
+        srs.ImportFromEPSG(4326)
+    elif proj == "UTM":
+        x0,y0 = p.float("corner_east"),p.float("corner_north")
+        dx,dy = p.float("post_east"),p.float("post_north")
+        south = p.float("false_northing") >= 10000000.0
+        srs.ImportFromEPSG((32700 if south else 32600) + p.int("projection_zone"))
+    else:
+        return None
+    width,lines = p.shape()
+    bounds = [x0 - dx/2.0, y0 - dy/2.0, x0 + dx*(width-0.5), y0 + dy*(lines-0.5)]
+    return bounds,srs.ExportToWkt(),width
+
+#
+# Describe a FLOAT gamma file as a GDAL raster without copying it
+#
+def raw_vrt(inname,width):
+    width = int(width)
+    return ('<VRTDataset rasterXSize="{W}" rasterYSize="{L}">'
+            '<VRTRasterBand dataType="Float32" band="1" subClass="VRTRawRasterBand">'
+            '<SourceFilename relativeToVRT="0">{F}</SourceFilename>'
+            '<ImageOffset>0</ImageOffset><PixelOffset>4</PixelOffset><LineOffset>{LO}</LineOffset>'
+            '<ByteOrder>MSB</ByteOrder></VRTRasterBand></VRTDataset>').format(
+            W=width,L=os.path.getsize(inname)//(4*width),F=os.path.abspath(inname),LO=4*width)
+
+#
+# Write a geocoded gamma file as a tiled, compressed cloud optimized GeoTIFF
+# with overviews.  type follows data2geotiff: 0 for raster images, 2 for
+# FLOAT data (0 is no data).  Falls back to data2geotiff for projections
+# or images GDAL can't handle.
+#
+def write_geotiff(inname,outname,dempar,type):
+    geo = georeference(dempar)
+    src = None
+    if geo is not None:
+        bounds,wkt,width = geo
+        if type == 2:
+            src = gdal.Open(raw_vrt(inname,width))
+        elif os.path.isfile(inname):
+            src = gdal.Open(inname)
+    if src is None:
+        logging.info("Using data2geotiff for {}".format(inname))
+        cmd = "data2geotiff {DEM} {IN} {TYPE} {OUT}".format(DEM=dempar,IN=inname,OUT=outname,TYPE=type)
+        execute(cmd,uselogging=True)
+        return
+
+    nodata = 0 if type == 2 else None
+    resample = "AVERAGE" if type == 2 else "NEAREST"
+    vrt = gdal.Translate("",src,format="VRT",outputBounds=bounds,outputSRS=wkt,noData=nodata)
+    vrt.SetMetadataItem("AREA_OR_POINT","Point")
+
+    tmp = outname + ".tmp"
+    if gdal.GetDriverByName("COG") is not None:
+        gdal.Translate(tmp,vrt,format="COG",creationOptions=COG_OPTIONS+["RESAMPLING={}".format(resample)])
+    else:
+        # Older GDAL: build the overviews first so they are laid out ahead
+        # of the full resolution data
+        base = outname + ".base.tif"
+        ds = gdal.Translate(base,vrt,format="GTiff",creationOptions=["TILED=YES","COMPRESS=DEFLATE"])
+        ds.BuildOverviews(resample,[2,4,8,16,32])
+        ds = None
+        gdal.Translate(tmp,base,format="GTiff",creationOptions=GTIFF_OPTIONS)
+        os.remove(base)
+    os.rename(tmp,outname)
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='geotiff_writer.py',
+    description='Convert a geocoded gamma file to a cloud optimized GeoTIFF')
+  parser.add_argument("dempar",help='DEM segment parameter file (e.g. DEM/demseg.par)')
+  parser.add_argument("input",help='Geocoded gamma file')
+  parser.add_argument("type",type=int,choices=[0,2],help='0) raster image; 2) FLOAT data')
+  parser.add_argument("output",help='Output GeoTIFF')
+  args = parser.parse_args()
+
+  logFile = "geotiff_writer_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  write_geotiff(args.input,args.output,args.dempar,args.type)
@@ -5,16 +5,117 @@ from getSubSwath import get_bounding_box_file
 import logging
 from apply_wb_mask import apply_wb_mask
 import shutil
-import saa_func_lib as saa
-from osgeo import gdal
+from osgeo import gdal, osr
 from ps2dem import ps2dem
 from utm2dem import utm2dem
+from file_cache import FileCache
 import os
+import glob
+import time
 
-def getDemFileGamma(filename,use_opentopo,alooks,mask):
+# Persistent DEM cache location (none by default) and its size limit in GB
+DEM_CACHE = os.environ.get("DEM_CACHE")
+DEM_QUOTA = 20.0
+
+#
+# Stand in for getDemFile that cuts the DEM out of the GeoTIFFs in a local
+# directory (e.g. for testing without network access)
+#
+def localDemSource(directory,demtype="LOCAL"):
+    def fetch(filename,outfile,opentopoFlag=False,utmFlag=True):
+        ymax,ymin,xmax,xmin = get_bounding_box_file(filename)
+        tiles = sorted(glob.glob(os.path.join(directory,"*.tif")))
+        if not tiles:
+            logging.error("ERROR: No DEM tiles found in {}".format(directory))
+            exit(1)
+        vrt = gdal.BuildVRT("/vsimem/local_dem_{}.vrt".format(os.getpid()),tiles)
+        srs = "EPSG:4326"
+        if utmFlag:
+            zone = int((xmin + xmax) / 2.0 + 180.0) // 6 + 1
+            srs = "EPSG:{}".format((32600 if ymin + ymax >= 0 else 32700) + zone)
+        gdal.Warp(outfile,vrt,dstSRS=srs,outputBounds=(xmin-0.15,ymin-0.15,xmax+0.15,ymax+0.15),
+                  outputBoundsSRS="EPSG:4326",dstNodata=-32767)
+        vrt = None
+        return outfile,demtype
+    return fetch
+
+def demBounds(filename):
+    return [round(x,4) for x in get_bounding_box_file(filename)]
+
+#
+# Get a DEM from fetcher, going through the cache of source DEMs if there
+# is one.  getDemFile picks and mosaics the source tiles itself, so what
+# is cached is its cut of them for the scene, keyed by the scene bounds;
+# scenes whose bounds differ don't share it.
+#
+def fetchDem(filename,outfile,use_opentopo,utm,cache=None,fetcher=getDemFile):
+    def create():
+        demfile,demtype = fetcher(filename,outfile,opentopoFlag=use_opentopo,utmFlag=utm)
+        if not os.path.isfile(demfile):
+            logging.error("Got no return demfile ({}) from getDemfile".format(demfile))
+            exit(1)
+        if demfile != outfile:
+            shutil.move(demfile,outfile)
+        return demtype
+    if cache is None:
+        return outfile,create()
+    key = cache.key("source dem",demBounds(filename),bool(use_opentopo),bool(utm))
+    hit,demtype = cache.get_or_create(key,os.getcwd(),create,[outfile])
+    return outfile,demtype
+
+#
+# Make big.dem/big.par for the scene, cropped to bounds (ymax,ymin,xmax,xmin
+# in degrees) if given.  With a cache directory the finished DEM is kept,
+# keyed by its bounds, DEM source, masking and pixel size, along with the
+# source DEMs it was made from.
+#
+def getDemFileGamma(filename,use_opentopo,alooks,mask,cache_dir=DEM_CACHE,cache_quota=DEM_QUOTA,
+                    fetcher=getDemFile,bounds=None):
+    if cache_dir is None:
+        return makeDemFileGamma(filename,use_opentopo,alooks,mask,fetcher=fetcher,bounds=bounds)
+
+    cache = FileCache(cache_dir,int(cache_quota*1024**3))
+    area = demBounds(filename) if bounds is None else [round(x,4) for x in bounds]
+    key = cache.key("gamma dem",area,bool(use_opentopo),bool(mask),20 * int(alooks) * 2)
+    def create():
+        return makeDemFileGamma(filename,use_opentopo,alooks,mask,cache=cache,fetcher=fetcher,
+                                bounds=bounds)[1]
+    hit,demtype = cache.get_or_create(key,os.getcwd(),create,["big.dem","big.par"])
+    if hit:
+        logging.info("Using cached DEM of type {}".format(demtype))
+    return("big",demtype)
+
+#
+# Bounds (xmin,ymin,xmax,ymax) in the projection wkt of the lat/lon box
+# bounds (ymax,ymin,xmax,xmin), from points along its edges so that the
+# whole box is covered whatever the projection (e.g. polar stereographic)
+#
+def projectBounds(bounds,wkt,points=20):
+    ymax,ymin,xmax,xmin = bounds
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(4326)
+    dst = osr.SpatialReference(wkt=wkt)
+    for srs in (src,dst):
+        if hasattr(srs,"SetAxisMappingStrategy"):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src,dst)
+    edge = []
+    for i in range(points+1):
+        f = float(i)/points
+        lon = xmin + f*(xmax-xmin)
+        lat = ymin + f*(ymax-ymin)
+        edge += [(lon,ymin),(lon,ymax),(xmin,lat),(xmax,lat)]
+    xy = [transform.TransformPoint(lon,lat)[:2] for lon,lat in edge]
+    xs = [x for x,y in xy]
+    ys = [y for x,y in xy]
+    return (min(xs),min(ys),max(xs),max(ys))
+
+def makeDemFileGamma(filename,use_opentopo,alooks,mask,cache=None,fetcher=getDemFile,bounds=None):
 
     # first get a DEM to check the type
-    demfile,demtype = getDemFile(filename,"tmpdem.tif",opentopoFlag=use_opentopo,utmFlag=True)
+    start = time.time()
+    demfile,demtype = fetchDem(filename,"tmpdem.tif",use_opentopo,True,cache,fetcher)
+    logging.info("Getting DEM of type {} took {:.1f}s".format(demtype,time.time()-start))
     if not os.path.isfile(demfile):
         logging.error("Got no return demfile ({}) from getDemfile".format(demfile))
         exit(1)
@@ -23,36 +124,34 @@ def getDemFileGamma(filename,use_opentopo,alooks,mask):
     if "REMA" in demtype or "GIMP" in demtype:
         ps = True
 
+    # Everything between the source DEM and big.dem stays in memory
+    src = demfile
+    masked = "/vsimem/temp_mask_dem_{}.tif".format(os.getpid())
+    dstSRS = None
     if mask and not ps:
         # Make a DEM for use with wb_mask
+        start = time.time()
         ymax,ymin,xmax,xmin = get_bounding_box_file(filename)
         if (xmax >= 177 and xmin <= -177):
             logging.info("Using anti-meridian special UTM file")
         
             # Need to pass wb mask routine a UTM DEM file
-            tmpdem = "temp_mask_dem_{}.tif".format(os.getpid())
-
             # Apply the water body mask
             logging.info("Applying water body mask")
-            apply_wb_mask(demfile,tmpdem,maskval=-32767,gcs=False)
+            apply_wb_mask(demfile,masked,maskval=-32767,gcs=False)
             logging.info("Done with water body mask")
-            shutil.move(tmpdem,demfile)
         else:
+            # Keep the UTM zone of the first DEM; the masked lat,lon DEM is
+            # warped into it directly at the final pixel size
+            dstSRS = gdal.Open(demfile).GetProjection()
+
             # Need to pass wb mask routine a lat,lon DEM file
-            demfile,demtype = getDemFile(filename,"tmpdem.tif",opentopoFlag=use_opentopo,utmFlag=False)
-            tmpdem = "temp_mask_dem_{}.tif".format(os.getpid())
+            demfile,demtype = fetchDem(filename,"tmpdem.tif",use_opentopo,False,cache,fetcher)
 
             # Apply the water body mask
-            apply_wb_mask(demfile,tmpdem,maskval=-32767,gcs=True)
-     
-            # Reproject DEM file into UTM coordinates
-            pixsize = 30.0
-            if demtype == "SRTMGL3":
-                pixsize = 90.
-            if demtype == "NED2":
-                pixsize = 60.
-
-            saa.reproject_gcs_to_utm(tmpdem,demfile,pixsize)
+            apply_wb_mask(demfile,masked,maskval=-32767,gcs=True)
+        src = masked
+        logging.info("Water body masking took {:.1f}s".format(time.time()-start))
     elif mask and ps:
         logging.info("WARNING: water masking not supported or polar stereo projections - skipping")
 
@@ -68,9 +167,21 @@ def getDemFileGamma(filename,use_opentopo,alooks,mask):
 
     pix_size = 20 * int(alooks) * 2;
     logging.info("Changing resolution")
-    gdal.Warp("tmpdem2.tif",demfile,xRes=pix_size,yRes=pix_size,resampleAlg="cubic",dstNodata=-32767,creationOptions=['COMPRESS=LZW'])
+    start = time.time()
+    crop = {}
+    if bounds is not None:
+        wkt = dstSRS if dstSRS is not None else gdal.Open(src).GetProjection()
+        crop = {"outputBounds": projectBounds(bounds,wkt)}
+    dem = gdal.Warp("",src,format="MEM",dstSRS=dstSRS,xRes=pix_size,yRes=pix_size,resampleAlg="cubic",
+                    dstNodata=-32767,multithread=True,warpOptions=["NUM_THREADS=ALL_CPUS"],**crop)
+    logging.info("Warping DEM took {:.1f}s".format(time.time()-start))
+    if mask and not ps:
+        gdal.Unlink(masked)
     os.remove(demfile)
 
+    start = time.time()
+    gdal.Translate("tmpdem2.tif",dem,format="GTiff")
+    dem = None
     if not ps:
       if use_opentopo == True:
         utm2dem("tmpdem2.tif","big.dem","big.par",dataType="int16")
@@ -78,5 +189,7 @@ def getDemFileGamma(filename,use_opentopo,alooks,mask):
         utm2dem("tmpdem2.tif","big.dem","big.par")
     else:
         ps2dem("tmpdem2.tif","big.dem","big.par")
+    os.remove("tmpdem2.tif")
+    logging.info("Writing big.dem took {:.1f}s".format(time.time()-start))
       
     return("big",demtype)
@@ -35,43 +35,71 @@
 
 import logging
 import argparse
-import os, re
+import os
 import datetime
 import time
 import glob
 import shutil
-from lxml import etree
-from interf_pwr_s1_lt_tops_proc import interf_pwr_s1_lt_tops_proc
-from par_s1_slc import par_s1_slc
+from interf_pwr_s1_lt_tops_proc import interf_pwr_s1_lt_tops_proc, read_offset_fit
+from par_s1_slc import par_s1_slc, is_ingested
+from orbit_store import orbitDir
 from SLC_copy_S1_fullSW import SLC_copy_S1_fullSW
-from unwrapping_geocoding import unwrapping_geocoding
-from execute import execute
-from getDemFileGamma import getDemFileGamma
+from unwrapping_geocoding import unwrapping, geocoding, product_targets, geocoding_inputs, GEOCODE_WORKERS
+from tiled_unwrap import UNWRAP_WORKERS
+from pipeline import PipelineError
+from telemetry import execute
+import telemetry
+from getDemFileGamma import getDemFileGamma, DEM_CACHE
 from makeAsfBrowse import makeAsfBrowse
 from create_metadata_insar_gamma import create_readme_file
+from checkpoint import Manifest, fingerprint
+from file_cache import FileCache
+from burst_index import getSwath, matchBursts, burstKeys
+from staging import stage_in, Publisher, STAGE_WORKERS
+import tempfile
+import hashlib
+import numpy as np
 
 global lasttime
 global log
 global proc_log
 
+# Copies products out of a scratch directory as they are made (see
+# stagedGammaProcess)
+publisher = None
+
 def process_log(msg):
     global proc_log
     time =  datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
     proc_log.write("{} - {}\n".format(time,msg))
 
-def getBursts(mydir,name):
-    back = os.getcwd()
-    os.chdir(os.path.join(mydir,"annotation"))
-    time = []
-    for myfile in os.listdir("."):
-        if name in myfile:
-            root = etree.parse(myfile)
-            for coord in root.iter('azimuthAnxTime'):
-                time.append(float(coord.text))
-            for count in root.iter('burstList'):
-                total_bursts=int(count.attrib['count'])
-    os.chdir(back) 
-    return time,total_bursts
+def getBursts(mydir,swath):
+    index = getSwath(mydir,swath)
+    return index["times"],index["count"]
+
+#
+# Lat/lon bounds (ymax,ymin,xmax,xmin) of the bursts listed in the burst
+# tabs of one or more scenes, taken from the geolocation grid of each
+# swath's annotation, plus a margin in degrees.  None if they cross the
+# anti-meridian.
+#
+def getBurstFootprint(scenes,margin=0.05):
+    boxes = []
+    for mydir,burst_tab in scenes:
+        f = open(burst_tab,"r")
+        ranges = [[int(float(x)) for x in line.split()] for line in f if line.strip()]
+        f.close()
+        for swath,(first,last) in zip(['iw1','iw2','iw3'],ranges):
+            footprints = getSwath(mydir,swath)["footprints"]
+            boxes += [box for box in footprints[first-1:last] if box is not None]
+    if not boxes:
+        logging.error("ERROR: No geolocation grid points found for the selected bursts")
+        exit(1)
+    boxes = np.array(boxes)
+    if boxes[:,2].max() - boxes[:,3].min() > 180.0:
+        logging.info("Bursts cross the anti-meridian; using the whole scene for the DEM")
+        return None
+    return (boxes[:,0].max()+margin,boxes[:,1].min()-margin,boxes[:,2].max()+margin,boxes[:,3].min()-margin)
 
 def getSelectBursts(masterDir,slaveDir,time):
     logging.info("Finding selected bursts at times {}, {}, {} for length {}".format(time[0],time[1],time[2],time[3]))
@@ -82,29 +110,15 @@ def getSelectBursts(masterDir,slaveDir,time):
     f2 = open(burst_tab2,"w")    
     size = float(time[3])
     xml_cnt = 0
-    for name in ['001.xml','002.xml','003.xml']:
-        time1,total_bursts1 = getBursts(masterDir,name)
-        time2,total_bursts2 = getBursts(slaveDir,name)
-        cnt = 1
-        found1 = 0
-        for x in time1:
-            if (abs(float(x)-float(time[xml_cnt])) < 0.20):
-                logging.info("Found selected burst at {}".format(cnt))
-                found1 = 1
-                start1 = cnt
-            cnt = cnt + 1
-        cnt = 1
-        found2 = 0
-        for x in time2:
-            if (abs(float(x)-float(time[xml_cnt])) < 0.20):
-                logging.info("Found selected burst at {}".format(cnt))
-                found2 = 1
-                start2 = cnt
-            cnt = cnt + 1
-      
-        if not found1 or not found2:
+    for swath in ['iw1','iw2','iw3']:
+        time1,total_bursts1 = getBursts(masterDir,swath)
+        time2,total_bursts2 = getBursts(slaveDir,swath)
+        start1 = matchBursts(time1,time[xml_cnt])[0]
+        start2 = matchBursts(time2,time[xml_cnt])[0]
+        if not start1 or not start2:
             logging.error("ERROR: Unable to find bursts at selected time")
             exit(1)
+        logging.info("Found selected burst at {} and {}".format(start1,start2))
 
         f1.write("%s %s\n" % (start1, start1+size-1))
         f2.write("%s %s\n" % (start2, start2+size-1))
@@ -122,39 +136,28 @@ def getBurstOverlaps(masterDir,slaveDir):
     f1 = open(burst_tab1,"w")
     burst_tab2 = "%s_burst_tab" % slaveDir[17:25]
     f2 = open(burst_tab2,"w")    
-    for name in ['001.xml','002.xml','003.xml']:
-        time1,total_bursts1 = getBursts(masterDir,name)
-        logging.info("total_bursts1, time1 {} {}".format(total_bursts1,time1))
-        time2,total_bursts2 = getBursts(slaveDir,name)
-        logging.info("total_bursts2, time2 {} {}".format(total_bursts2,time2))
-        cnt = 1
-        found = 0
-        x = time1[0]
-        for y in time2:
-            if (abs(x-y) < 0.20):
-                logging.info("Found burst match at 1 %s" % cnt)
-                found = 1
-                start1 = 1
-                start2 = cnt
-            cnt += 1
-
-        if found == 0:
-            y = time2[0]
-            cnt = 1
-            for x in time1:
-                if (abs(x-y) < 0.20):
-                    logging.info("Found burst match at %s 1" % cnt)
-                    found = 1
-                    start1 = cnt
-                    start2 = 1
-                cnt += 1
-        
-        try: 
-            size1 = total_bursts1 - start1 + 1
-            size2 = total_bursts2 - start2 + 1
-        except:
-            logging.error("ERROR: Unable to find burst overlap")
-            exit(2)
+    for swath in ['iw1','iw2','iw3']:
+        swath1 = getSwath(masterDir,swath)
+        swath2 = getSwath(slaveDir,swath)
+        total_bursts1 = swath1["count"]
+        total_bursts2 = swath2["count"]
+        key1,key2,tol = burstKeys(swath1,swath2)
+        logging.info("total_bursts1, key1 {} {}".format(total_bursts1,key1))
+        logging.info("total_bursts2, key2 {} {}".format(total_bursts2,key2))
+        start2 = matchBursts(key2,key1[0],tol)[0]
+        if start2:
+            logging.info("Found burst match at 1 %s" % start2)
+            start1 = 1
+        else:
+            start1 = matchBursts(key1,key2[0],tol)[0]
+            if not start1:
+                logging.error("ERROR: Unable to find burst overlap")
+                exit(2)
+            logging.info("Found burst match at %s 1" % start1)
+            start2 = 1
+
+        size1 = total_bursts1 - start1 + 1
+        size2 = total_bursts2 - start2 + 1
 
         if (size1 > size2):
             size = size2
@@ -191,6 +194,7 @@ def makeHDF5List(master,slave,outdir,output,dem_source,logname):
     f.write("data = Sentinel-1\n")
     f.write("master metadata = {}.xml\n".format(master))
     f.write("slave metadata = {}.xml\n".format(slave))
+
     f.write("amplitude master = {}.mli.geo.tif\n".format(os.path.join(outdir,master)))
     f.write("amplitude slave = {}.mli.geo.tif\n".format(os.path.join(outdir,slave)))
     f.write("digital elevation model = {}.dem.tif\n".format(os.path.join(outdir,output)))
@@ -207,16 +211,30 @@ def makeHDF5List(master,slave,outdir,output,dem_source,logname):
     f.close()
 
 
-def move_output_files(outdir,output,master,prod_dir,long_output,los_flag,inc_flag,look_flag):
+#
+# Put a product file into the product directory.  The file is hard linked
+# when possible so that large GeoTIFFs aren't written a second time.
+#
+def publish(inName,outName):
+    if os.path.lexists(outName):
+        os.remove(outName)
+    try:
+        os.link(inName,outName)
+    except OSError:
+        shutil.copy(inName,outName)
+    if publisher is not None:
+        publisher.publish(outName)
+
+def move_output_files(outdir,output,master,prod_dir,long_output,los_flag,inc_flag,look_flag,enu_flag=False):
 
     inName = "{}.mli.geo.tif".format(os.path.join(outdir,master))
     outName = "{}_amp.tif".format(os.path.join(prod_dir,long_output))
-    shutil.copy(inName,outName)
+    publish(inName,outName)
 
     inName = "{}.cc.geo.tif".format(os.path.join(outdir,output))
     outName = "{}_corr.tif".format(os.path.join(prod_dir,long_output))
     if os.path.isfile(inName):
-        shutil.copy(inName,outName)
+        publish(inName,outName)
 
 # This code uses the filered coherence output from adf command:
 #
@@ -228,29 +246,35 @@ def move_output_files(outdir,output,master,prod_dir,long_output,los_flag,inc_fla
 
     inName = "{}.vert.disp.geo.org.tif".format(os.path.join(outdir,output))
     outName = "{}_vert_disp.tif".format(os.path.join(prod_dir,long_output))
-    shutil.copy(inName,outName)
+    publish(inName,outName)
 
     inName = "{}.adf.unw.geo.tif".format(os.path.join(outdir,output))
     outName = "{}_unw_phase.tif".format(os.path.join(prod_dir,long_output))
-    shutil.copy(inName,outName)
+    publish(inName,outName)
 
     if los_flag:
         inName = "{}.los.disp.geo.org.tif".format(os.path.join(outdir,output))
         outName = "{}_los_disp.tif".format(os.path.join(prod_dir,long_output))
-        shutil.copy(inName,outName)
+        publish(inName,outName)
+
+    if enu_flag:
+        for c in ("east","north","up"):
+            inName = "{}.{}.disp.geo.org.tif".format(os.path.join(outdir,output),c)
+            outName = "{}_{}_disp.tif".format(os.path.join(prod_dir,long_output),c)
+            publish(inName,outName)
  
     if inc_flag:
         inName = "{}.inc.tif".format(os.path.join(outdir,output))
         outName = "{}_inc.tif".format(os.path.join(prod_dir,long_output))
-        shutil.copy(inName,outName)
+        publish(inName,outName)
  
     if look_flag:
         inName = "{}.lv_theta.tif".format(os.path.join(outdir,output))
         outName = "{}_lv_theta.tif".format(os.path.join(prod_dir,long_output))
-        shutil.copy(inName,outName)
+        publish(inName,outName)
         inName = "{}.lv_phi.tif".format(os.path.join(outdir,output))
         outName = "{}_lv_phi.tif".format(os.path.join(prod_dir,long_output))
-        shutil.copy(inName,outName)
+        publish(inName,outName)
  
     makeAsfBrowse("{}.diff0.man.adf.bmp.geo.tif".format(os.path.join(outdir,output)),
                   "{}_color_phase".format(os.path.join(prod_dir,long_output)))
@@ -259,10 +283,126 @@ def move_output_files(outdir,output,master,prod_dir,long_output,los_flag,inc_fla
                   "{}_unw_phase".format(os.path.join(prod_dir,long_output)))
 
 
+def getBurstTabs(masterFile,slaveFile,time):
+    masterDateShort = masterFile[17:25]
+    slaveDateShort = slaveFile[17:25]
+    if time is None:
+        (burst_tab1,burst_tab2) = getBurstOverlaps(masterFile,slaveFile)
+    else:
+        (burst_tab1,burst_tab2) = getSelectBursts(masterFile,slaveFile,time)
+        
+    logging.info("Finished calculating overlap - in directory {}".format(os.getcwd()))
+    shutil.move(burst_tab1,os.path.join(masterDateShort,burst_tab1))
+    shutil.move(burst_tab2,os.path.join(slaveDateShort,burst_tab2))
+    return(burst_tab1,burst_tab2)
+
+#
+# The SLC files listed in an SLC tab, relative to the current directory
+#
+def tabSlcs(tab):
+    if not os.path.isfile(tab):
+        return []
+    f = open(tab,"r")
+    names = [os.path.join(os.path.dirname(tab),line.split()[0]) for line in f if line.strip()]
+    f.close()
+    return names
+
+def copySLC(mydir,*args,**kwargs):
+    back = os.getcwd()
+    os.chdir(mydir)
+    SLC_copy_S1_fullSW(*args,**kwargs)
+    os.chdir(back)
+
+#
+# Copy the selected bursts of the SLCs listed in mydir/tabin to path and
+# mosaic them into path/<name>.slc and its multilooked .mli, listing the
+# copies in path/tabout.  This is what SLC_copy_S1_fullSW does for the
+# master (mode 1, tabout SLC1_tab) without the DEM and geometry step.
+#
+def mosaicSLC(mydir,path,name,tabin,burst_tab,tabout,rlooks,alooks):
+    back = os.getcwd()
+    os.chdir(mydir)
+    f = open(tabin,"r")
+    count = len([line for line in f if line.strip()])
+    f.close()
+    out = os.path.join(path,tabout)
+    f = open(out,"w")
+    for n in range(1,count+1):
+        base = os.path.join(path,"{}_00{}".format(name,n))
+        f.write("{B}.slc {B}.slc.par {B}.tops_par\n".format(B=base))
+    f.close()
+    try:
+        execute("SLC_copy_S1_TOPS {} {} {}".format(tabin,out,burst_tab),uselogging=True)
+        os.chdir(path)
+        execute("SLC_mosaic_S1_TOPS {T} {N}.slc {N}.slc.par {RL} {AL}".format(T=tabout,N=name,RL=rlooks,AL=alooks),
+                uselogging=True)
+        execute("multi_look {N}.slc {N}.slc.par {N}.mli {N}.mli.par {RL} {AL}".format(N=name,RL=rlooks,AL=alooks),
+                uselogging=True)
+    finally:
+        os.chdir(back)
+
+#
+# Mosaic the master SLC and make its geometry products (DEM/HGT_SAR,
+# MAP2RDC, demseg, inc_flat, ...).  With a cache the DEM products are shared
+# by every pair with the same master bursts, DEM and looks, and only the
+# SLC mosaic is redone.
+#
+def copyMasterSLC(master,path,burst_tab,dem,wrk,rlooks,alooks,cache=None):
+    args = (master,path,master,"SLC_TAB",burst_tab)
+    def create():
+        copySLC(*args,mode=1,dem=dem,dempath=wrk,raml=rlooks,azml=alooks)
+    if cache is None:
+        create()
+        return
+    key = cache.key("master geometry",
+                    [fingerprint(os.path.join(master,"{}_00{}.slc.par".format(master,n))) for n in (1,2,3)],
+                    fingerprint(os.path.join(master,burst_tab)),
+                    fingerprint(os.path.join(wrk,"{}.dem".format(dem))),
+                    fingerprint(os.path.join(wrk,"{}.par".format(dem))),
+                    int(rlooks),int(alooks))
+    def names():
+        return [os.path.join("DEM",name) for name in os.listdir(os.path.join(path,"DEM"))
+                if os.path.isfile(os.path.join(path,"DEM",name))]
+    hit,info = cache.get_or_create(key,path,create,names)
+    if hit:
+        logging.info("Using cached geometry for master {}".format(master))
+        mosaicSLC(master,path,master,"SLC_TAB",burst_tab,"SLC1_tab",rlooks,alooks)
+
+def makeMetadata(master,slave,masterFile,slaveFile,outdir):
+    back = os.getcwd()
+    os.chdir(outdir)
+    cmd = "base_init {}.slc.par {}.slc.par - - base > baseline.log".format(master,slave)
+    execute(cmd,uselogging=True,logfile=log)
+    os.chdir(back)
+    
+    etc_dir =  os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "etc"))
+    shutil.copy(os.path.join(etc_dir,"sentinel_xml.xsl"),".")
+
+    cmd = "xsltproc --stringparam path {PATH} --stringparam timestamp timestring --stringparam file_size 1000 --stringparam server stuff --output {M}.xml sentinel_xml.xsl {PATH}/manifest.safe".format(M=master,PATH=masterFile)
+    execute(cmd,uselogging=True,logfile=log)
+    cmd = "xsltproc --stringparam path {PATH} --stringparam timestamp timestring --stringparam file_size 1000 --stringparam server stuff --output {S}.xml sentinel_xml.xsl {PATH}/manifest.safe".format(S=slave,PATH=slaveFile)
+    execute(cmd,uselogging=True,logfile=log)
+
+def makeProducts(masterFile,slaveFile,outdir,output,master,igramName,alooks,dem_source,pol,
+    los_flag,inc_flag,look_flag,enu_flag=False):
+    prod_dir = "PRODUCT"
+    if not os.path.exists(prod_dir):
+        os.mkdir("PRODUCT") 
+    move_output_files(outdir,output,master,prod_dir,igramName,los_flag,inc_flag,look_flag,enu_flag)
+
+    create_readme_file(masterFile,slaveFile,igramName,int(alooks)*20,dem_source,pol)
+
 def gammaProcess(masterFile,slaveFile,outdir,dem=None,dem_source=None,rlooks=10,alooks=2,
-    inc_flag=False,look_flag=False,los_flag=False,ot_flag=False,cp_flag=False,time=None):
+    inc_flag=False,look_flag=False,los_flag=False,ot_flag=False,cp_flag=False,time=None,
+    resume=False,geocode_workers=GEOCODE_WORKERS,native_geocode=False,cog=False,
+    coreg_tol=None,geometry_cache=None,cache_quota=None,dem_cache=DEM_CACHE,keep_intermediates=False,
+    products=None,tiled_unwrap=0,enu_flag=False,orbit_dir=None):
 
     global proc_log
+    global log
+    global publisher
+
+    publisher = products
 
     logging.info("\n\nSentinel1A differential interferogram creation program\n")
     logging.info("Creating output interferogram in directory {}\n\n".format(outdir))
@@ -277,10 +417,23 @@ def gammaProcess(masterFile,slaveFile,outdir,dem=None,dem_source=None,rlooks=10,
     slaveDateShort = slaveFile[17:25]
     igramName = "{}_{}".format(masterDate,slaveDate) 
     logname = "{}.log".format(outdir)
-    log = open(logname,"w")
-    proc_log = open("processing.log","w")
+    log = open(logname,"a" if resume else "w")
+    proc_log = open("processing.log","a" if resume else "w")
     process_log("starting processing")
 
+    # Every gamma command run is recorded here, by stage
+    if not resume and os.path.isfile("telemetry.jsonl"):
+        os.remove("telemetry.jsonl")
+    telemetry.start("telemetry.jsonl")
+
+    # Completed stages are recorded here so that a resumed run can skip them
+    manifest = Manifest(wrk,resume=resume,keep=keep_intermediates)
+
+    # Master geometry products can be shared with other pairs
+    cache = None
+    if geometry_cache is not None:
+        cache = FileCache(geometry_cache,None if cache_quota is None else int(cache_quota*1024**3))
+
     if not "IW_SLC__" in masterFile:
         logging.error("ERROR: Master file {} is not of type IW_SLC!".format(masterFile))
         exit(1)
@@ -301,18 +454,44 @@ def gammaProcess(masterFile,slaveFile,outdir,dem=None,dem_source=None,rlooks=10,
 
     logging.info("Processing the {} polarization".format(pol))
 
+    master = masterDateShort
+    slave = slaveDateShort
+    output = masterDateShort + "_" + slaveDateShort
+    hgt = "DEM/HGT_SAR_{}_{}".format(rlooks,alooks)
+
     #
     #  Ingest the data files into gamma format
     #
     process_log("Starting par_s1_slc.py")
-    par_s1_slc(pol)
+    ingest = []
+    for date in (master,slave):
+        ingest += [os.path.join(date,"SLC_TAB")] 
+        ingest += [os.path.join(date,"{}_00{}.slc.par".format(date,n)) for n in (1,2,3)]
+    manifest.run("ingest",par_s1_slc,
+                 [os.path.join(masterFile,"manifest.safe"),os.path.join(slaveFile,"manifest.safe")],
+                 ingest,pol,orbit_dir=orbit_dir)
    
+    #
+    # Figure out which bursts overlap between the two swaths 
+    #
+    (burst_tab1,burst_tab2) = manifest.run("burst_tabs",getBurstTabs,ingest,
+                                           [os.path.join(master,"{}_burst_tab".format(master)),
+                                            os.path.join(slave,"{}_burst_tab".format(slave))],
+                                           masterFile,slaveFile,time)
+
     #
     #  Fetch the DEM file
     # 
     process_log("Getting a DEM file")
     if dem is None:
-        dem, dem_source = getDemFileGamma(masterFile,ot_flag,alooks,True)
+        # Only the area of the selected bursts is needed
+        bounds = getBurstFootprint([(masterFile,os.path.join(master,burst_tab1)),
+                                    (slaveFile,os.path.join(slave,burst_tab2))])
+        logging.info("Burst footprint (ymax,ymin,xmax,xmin): {}".format(bounds))
+        dem, dem_source = manifest.run("dem",getDemFileGamma,
+                                       [os.path.join(master,burst_tab1),os.path.join(slave,burst_tab2)],
+                                       ["big.dem","big.par"],
+                                       masterFile,ot_flag,alooks,True,cache_dir=dem_cache,bounds=bounds)
         logging.info("Got dem of type {}".format(dem_source))
     else:
         logging.debug("Value of DEM is {}".format(dem))
@@ -323,105 +502,199 @@ def gammaProcess(masterFile,slaveFile,outdir,dem=None,dem_source=None,rlooks=10,
     if not os.path.isdir(outdir):
         os.mkdir(outdir)        
 
-    #
-    # Figure out which bursts overlap between the two swaths 
-    #
-    if time is None:
-        (burst_tab1,burst_tab2) = getBurstOverlaps(masterFile,slaveFile)
-    else:
-        (burst_tab1,burst_tab2) = getSelectBursts(masterFile,slaveFile,time)
-        
-    logging.info("Finished calculating overlap - in directory {}".format(os.getcwd()))
-    shutil.move(burst_tab1,masterDateShort)
-    shutil.move(burst_tab2,slaveDateShort)
+    # Intermediate files are deleted as soon as the last stage reading them
+    # is done, to keep the scratch space of a pair down
+    manifest.temporary(tabSlcs(os.path.join(master,"SLC_TAB")),["slc_copy_master"])
+    manifest.temporary(tabSlcs(os.path.join(slave,"SLC_TAB")),["slc_copy_slave"])
 
     #
     # Mosaic the swaths together and copy SLCs over
     #
     process_log("Starting SLC_copy_S1_fullSW.py")
-    master = masterDateShort
-    slave = slaveDateShort
-
     path = os.path.join(wrk,outdir)
-    os.chdir(master)
-    SLC_copy_S1_fullSW(path,master,"SLC_TAB",burst_tab1,mode=1,dem="big",dempath=wrk,raml=rlooks,azml=alooks)
-    os.chdir("..")
-    os.chdir(slave)
-    SLC_copy_S1_fullSW(path,slave,"SLC_TAB",burst_tab2,mode=2,raml=rlooks,azml=alooks)
-    os.chdir("..")
+    # The master and slave copies both write into outdir, and
+    # SLC_copy_S1_fullSW leaves intermediates there that aren't known to be
+    # distinct, so they run one after the other
+    manifest.run("slc_copy_master",copyMasterSLC,
+                 [os.path.join(master,burst_tab1),os.path.join(master,"SLC_TAB"),"{}.dem".format(dem)],
+                 [os.path.join(outdir,name) for name in 
+                      ("{}.slc".format(master),"{}.slc.par".format(master),
+                       "{}.mli".format(master),"{}.mli.par".format(master),
+                       "SLC1_tab",hgt,"DEM/MAP2RDC","DEM/demseg.par")],
+                 master,path,burst_tab1,"big",wrk,rlooks,alooks,cache=cache)
+    manifest.run("slc_copy_slave",copySLC,
+                 [os.path.join(slave,burst_tab2),os.path.join(slave,"SLC_TAB")],
+                 [os.path.join(outdir,name) for name in 
+                      ("{}.slc".format(slave),"{}.slc.par".format(slave),
+                       "{}.mli".format(slave),"{}.mli.par".format(slave),"SLC2_tab")],
+                 slave,path,slave,"SLC_TAB",burst_tab2,mode=2,raml=rlooks,azml=alooks)
     os.chdir(outdir)
 
+    # The full resolution SLCs, lookup table and offset estimates are only
+    # needed for coregistration
+    slcs = tabSlcs("SLC1_tab") + tabSlcs("SLC2_tab")
+    slcs += ["{}.slc".format(master),"{}.slc".format(slave),"{}.rslc".format(slave)]
+    manifest.temporary(slcs + ["{}.lt".format(master),"offs","snr","{}.off_temp".format(output),
+                               "{}.off_0".format(output)],["interf_step3"])
+
     #
     # Interferogram creation, matching, refinement
     #
     process_log("Starting interf_pwr_s1_lt_tops_proc.py 0")
-    hgt = "DEM/HGT_SAR_{}_{}".format(rlooks,alooks)
-    interf_pwr_s1_lt_tops_proc(master,slave,hgt,rlooks=rlooks,alooks=alooks,iter=3,step=0)
+    manifest.run("interf_step0",interf_pwr_s1_lt_tops_proc,
+                 ["{}.slc.par".format(master),"{}.slc.par".format(slave),hgt],
+                 ["{}.lt".format(master),"{}.sim_unw".format(output),"{}.off_temp".format(output)],
+                 master,slave,hgt,rlooks=rlooks,alooks=alooks,iter=3,step=0)
  
     process_log("Starting interf_pwr_s1_lt_tops_proc.py 1")
-    interf_pwr_s1_lt_tops_proc(master,slave,hgt,rlooks=rlooks,alooks=alooks,step=1)
+    manifest.run("interf_step1",interf_pwr_s1_lt_tops_proc,
+                 ["{}.lt".format(master),"{}.sim_unw".format(output)],
+                 ["{}.off_0".format(output),"{}.diff0.it0".format(output),"offsetfit0.log"],
+                 master,slave,hgt,rlooks=rlooks,alooks=alooks,step=1)
  
     process_log("Starting interf_pwr_s1_lt_tops_proc.py 2")
-    interf_pwr_s1_lt_tops_proc(master,slave,hgt,rlooks=rlooks,alooks=alooks,iter=3,step=2)
-
-    g = open("offsetfit3.log")
-    offset = 1.0
-    for line in g:
-        if "final azimuth offset poly. coeff.:" in line:
-            offset = line.split(":")[1]
-    if float(offset) > 0.02:
+    niter = manifest.run("interf_step2",interf_pwr_s1_lt_tops_proc,
+                 ["{}.off_0".format(output)],["{}.off.it".format(output)],
+                 master,slave,hgt,rlooks=rlooks,alooks=alooks,iter=3,step=2,tol=coreg_tol)
+
+    manifest.temporary(tabSlcs("SLC2R_tab") + glob.glob("{}.diff0.it*".format(output)),["interf_step3"])
+
+    offset = read_offset_fit("offsetfit{}.log".format(niter))[1][0]
+    if offset > 0.02:
         logging.error("ERROR: Found azimuth offset of {}!".format(offset))
         exit(1)
     else:
         logging.info("Found azimuth offset of {}!".format(offset))
 
-    output = masterDateShort + "_" + slaveDateShort
-
     process_log("Starting s1_coreg_overlap")
     cmd  = "S1_coreg_overlap SLC1_tab SLC2R_tab {OUT} {OUT}.off.it {OUT}.off.it.corrected".format(OUT=output)
-    execute(cmd,uselogging=True,logfile=log)
+    manifest.run("coreg_overlap",execute,["{}.off.it".format(output)],["{}.off.it.corrected".format(output)],
+                 cmd,uselogging=True,logfile=log)
 
     process_log("Starting interf_pwr_s1_lt_tops_proc.py 2")
-    interf_pwr_s1_lt_tops_proc(master,slave,hgt,rlooks=rlooks,alooks=alooks,step=3)
+    manifest.run("interf_step3",interf_pwr_s1_lt_tops_proc,
+                 ["{}.off.it.corrected".format(output)],
+                 ["{}.diff0.man".format(output),"offsetfit4.log"],
+                 master,slave,hgt,rlooks=rlooks,alooks=alooks,iter=3,step=3)
 
     #
     # Perform phase unwrapping and geocoding of results
     #
     process_log("Starting phase unwrapping and geocoding")
-    unwrapping_geocoding(master, slave, step="man", rlooks=rlooks, alooks=alooks)
+    targets = product_targets(master,slave,step="man",los_flag=los_flag,inc_flag=inc_flag,look_flag=look_flag,
+                              enu_flag=enu_flag)
+    needed = geocoding_inputs(master,slave,step="man",targets=targets,enu=enu_flag)
+    manifest.run("unwrapping",unwrapping,
+                 ["{}.diff0.man".format(output),"{}.mli".format(master)],
+                 [f for f in needed if f.startswith(output)],
+                 master,slave,step="man",rlooks=rlooks,alooks=alooks,targets=needed,tile_workers=tiled_unwrap)
+    try:
+        manifest.run("geocoding",geocoding,
+                     ["{}.adf.unw".format(output),"DEM/MAP2RDC","DEM/demseg.par"],targets,
+                     master,slave,step="man",workers=geocode_workers,targets=targets,
+                     native=native_geocode,cog=cog,keep=keep_intermediates,enu=enu_flag)
+    except PipelineError as e:
+        for node,err in e.failures:
+            logging.error("ERROR: Geocoding step {} failed: {}".format(node.name,err))
+        for node in e.blocked:
+            logging.error("ERROR: Geocoding step {} was not run".format(node.name))
+        exit(1)
+    os.chdir(wrk)
 
     #
     #  Generate metadata
     #
     process_log("Collecting metadata and output files")
-
-    cmd = "base_init {}.slc.par {}.slc.par - - base > baseline.log".format(master,slave)
-    execute(cmd,uselogging=True,logfile=log)
-    os.chdir(wrk)
-    
-    etc_dir =  os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "etc"))
-    shutil.copy(os.path.join(etc_dir,"sentinel_xml.xsl"),".")
-
-    cmd = "xsltproc --stringparam path {PATH} --stringparam timestamp timestring --stringparam file_size 1000 --stringparam server stuff --output {M}.xml sentinel_xml.xsl {PATH}/manifest.safe".format(M=master,PATH=masterFile)
-    execute(cmd,uselogging=True,logfile=log)
-    cmd = "xsltproc --stringparam path {PATH} --stringparam timestamp timestring --stringparam file_size 1000 --stringparam server stuff --output {S}.xml sentinel_xml.xsl {PATH}/manifest.safe".format(S=slave,PATH=slaveFile)
-    execute(cmd,uselogging=True,logfile=log)
+    manifest.run("metadata",makeMetadata,
+                 [os.path.join(outdir,"{}.slc.par".format(name)) for name in (master,slave)],
+                 [os.path.join(outdir,"baseline.log"),"{}.xml".format(master),"{}.xml".format(slave)],
+                 master,slave,masterFile,slaveFile,outdir)
  
     makeHDF5List(master,slave,outdir,output,dem_source,logname)
 
     #
     # Move the outputs to the PRODUCT directory
     #
-    prod_dir = "PRODUCT"
-    if not os.path.exists(prod_dir):
-        os.mkdir("PRODUCT") 
-    move_output_files(outdir,output,master,prod_dir,igramName,los_flag,inc_flag,look_flag)
-
-    create_readme_file(masterFile,slaveFile,igramName,int(alooks)*20,dem_source,pol)
-
+    manifest.run("packaging",makeProducts,
+                 [os.path.join(outdir,"{}.adf.unw.geo.tif".format(output))],
+                 [os.path.join("PRODUCT","{}_unw_phase.tif".format(igramName)),
+                  os.path.join("PRODUCT","README.txt")],
+                 masterFile,slaveFile,outdir,output,master,igramName,alooks,dem_source,pol,
+                 los_flag,inc_flag,look_flag,enu_flag)
+
+    telemetry.summary()
     process_log("Done!!!")
     logging.info("Done!!!")
 
+#
+# Run gammaProcess in a new directory under scratch (e.g. node local disk)
+# instead of the current directory.  The SAFE directories and DEM are
+# copied in; ingested SLCs, read only once, are linked.  Products are
+# published back to the current directory in the background as they are
+# made, along with the logs at the end.  finish() is run in the scratch
+# directory after processing, for any further products.  With resume the
+# scratch directory is the same for every run of the pair, and is kept
+# when processing fails so the next run can pick up from it.
+#
+def stagedGammaProcess(scratch,masterFile,slaveFile,outdir,dem=None,finish=None,workers=STAGE_WORKERS,
+                       **kwargs):
+    wrk = os.getcwd()
+    # Orbits go to the run directory, not to a scratch directory of their own
+    if kwargs.get("orbit_dir") is None:
+        kwargs["orbit_dir"] = orbitDir(wrk)
+    scratch = os.path.abspath(scratch)
+    if not os.path.isdir(scratch):
+        os.makedirs(scratch)
+    if kwargs.get("resume"):
+        # A resumed run has to find the checkpoints of the last one, so the
+        # directory is named after the pair and where its products go
+        digest = hashlib.sha1(wrk.encode("utf-8")).hexdigest()[:8]
+        tmp = os.path.join(scratch,"ifm_{}_{}_{}".format(masterFile[17:25],slaveFile[17:25],digest))
+        if os.path.isdir(tmp):
+            logging.info("Resuming in scratch directory {}".format(tmp))
+        else:
+            os.makedirs(tmp)
+            logging.info("Processing in scratch directory {}".format(tmp))
+    else:
+        tmp = tempfile.mkdtemp(prefix="ifm_",dir=scratch)
+        logging.info("Processing in scratch directory {}".format(tmp))
+
+    copies = [masterFile,slaveFile]
+    links = []
+    ingested = []
+    for safe in (masterFile,slaveFile):
+        date = safe[17:25]
+        if is_ingested(date):
+            links.append(date)
+            ingested.append(safe)
+        elif os.path.isdir(date):
+            copies.append(date)
+    if dem is not None:
+        copies += ["{}.dem".format(dem),"{}.par".format(dem)]
+    def skip(path):
+        # The measurement TIFFs of ingested scenes aren't read again
+        return any(path.startswith(os.path.join(safe,"measurement")) for safe in ingested)
+    stage_in(copies,tmp,workers=workers,links=links,skip=skip)
+
+    products = Publisher(tmp,wrk)
+    os.chdir(tmp)
+    try:
+        gammaProcess(masterFile,slaveFile,outdir,dem=dem,products=products,**kwargs)
+        if finish is not None:
+            finish()
+        products.sync("PRODUCT")
+        for name in ("processing.log","telemetry.jsonl","{}.log".format(outdir)):
+            if os.path.isfile(name):
+                products.publish(name)
+    finally:
+        errors = products.close()
+        os.chdir(wrk)
+    if errors:
+        logging.error("ERROR: {} products were not published; scratch directory {} kept".format(len(errors),tmp))
+        exit(1)
+    if not kwargs.get("keep_intermediates"):
+        shutil.rmtree(tmp,ignore_errors=True)
+
 
 if __name__ == '__main__':
 
@@ -437,10 +710,29 @@ if __name__ == '__main__':
   parser.add_argument("-i",action="store_true",help="Create incidence angle file")
   parser.add_argument("-l",action="store_true",help="Create look vector theta and phi files")
   parser.add_argument("-s",action="store_true",help="Create line of sight displacement file")
+  parser.add_argument("-e","--enu",action="store_true",help="Create east, north and up displacement files")
   parser.add_argument("-o",action="store_true",help="Use opentopo to get the DEM file instead of get_dem")
   parser.add_argument("-c",action="store_true",help="cross pol processing - either hv or vh (default hh or vv)")
   parser.add_argument("-t",nargs=4,type=float,help="Start processing at time for length bursts",
                       metavar=('t1','t2','t3','length'))
+  parser.add_argument("--resume",action="store_true",help="Skip the stages already completed by a previous run")
+  parser.add_argument("-g","--geocode-workers",default=GEOCODE_WORKERS,type=int,
+    help="Number of layers to geocode concurrently (def={})".format(GEOCODE_WORKERS))
+  parser.add_argument("--native-geocode",action="store_true",
+    help="Geocode the data layers in a single pass in python instead of with geocode_back")
+  parser.add_argument("--cog",action="store_true",
+    help="Write compressed cloud optimized GeoTIFFs with GDAL instead of using data2geotiff")
+  parser.add_argument("--coreg-tol",type=float,
+    help="Stop coregistration iterations once the offset correction is below this many pixels (e.g. 0.01)")
+  parser.add_argument("--geometry-cache",help="Directory in which to share master geometry products between runs")
+  parser.add_argument("--cache-quota",type=float,help="Size limit of the geometry cache in GB")
+  parser.add_argument("--dem-cache",default=DEM_CACHE,help="Directory in which to keep DEMs between runs (def=$DEM_CACHE)")
+  parser.add_argument("--keep-intermediates",action="store_true",
+    help="Keep intermediate files instead of deleting them once no later stage needs them")
+  parser.add_argument("--tiled-unwrap",nargs="?",const=UNWRAP_WORKERS,default=0,type=int,metavar="N",
+    help="Unwrap in patches sized from the scene and memory, N at a time (def N={})".format(UNWRAP_WORKERS))
+  parser.add_argument("--scratch",help="Process in a new directory under this one (e.g. node local disk) and publish the products back")
+  parser.add_argument("--orbit-dir",help="Directory of orbit files, shared between runs (def=$ORBIT_DIR or ORBITS)")
   args = parser.parse_args()
 
   logFile = "ifm_sentinel_log.txt"
@@ -449,7 +741,15 @@ if __name__ == '__main__':
   logging.getLogger().addHandler(logging.StreamHandler())
   logging.info("Starting run")
 
-  gammaProcess(args.master,args.slave,args.output,dem=args.dem,rlooks=args.rlooks,alooks=args.alooks,
-    inc_flag=args.i,look_flag=args.l,los_flag=args.s,ot_flag=args.o,cp_flag=args.c,time=args.t)
+  kwargs = dict(dem=args.dem,rlooks=args.rlooks,alooks=args.alooks,
+    inc_flag=args.i,look_flag=args.l,los_flag=args.s,ot_flag=args.o,cp_flag=args.c,time=args.t,
+    resume=args.resume,geocode_workers=args.geocode_workers,native_geocode=args.native_geocode,
+    cog=args.cog,coreg_tol=args.coreg_tol,geometry_cache=args.geometry_cache,cache_quota=args.cache_quota,
+    dem_cache=args.dem_cache,keep_intermediates=args.keep_intermediates,tiled_unwrap=args.tiled_unwrap,
+    enu_flag=args.enu,orbit_dir=args.orbit_dir and os.path.abspath(args.orbit_dir))
+  if args.scratch:
+      stagedGammaProcess(args.scratch,args.master,args.slave,args.output,**kwargs)
+  else:
+      gammaProcess(args.master,args.slave,args.output,**kwargs)
 
 
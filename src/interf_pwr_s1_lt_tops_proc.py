@@ -4,8 +4,15 @@ import argparse
 import logging
 import os
 import shutil
-from execute import execute
-from getParameter import getParameter
+from telemetry import execute
+from gamma_io import par
+from pipeline import Pipeline
+
+# Coregistration is taken to diverge when an offset correction is this many
+# times the smallest one so far and above DIVERGE_FLOOR pixels; smaller
+# increases are noise
+DIVERGE_FACTOR = 3.0
+DIVERGE_FLOOR = 0.1
 
 # 
 # Create a new rslc tab
@@ -24,7 +31,44 @@ def create_slc2r_tab(SLC2tab,SLC2Rtab):
             g.write("{}\n".format(out))
     g.close()
  
-def coregister_data(cnt,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter):
+#
+# Read the final range and azimuth offset polynomial coefficients from an
+# offset_fit log
+#
+def read_offset_fit(logname):
+    rng = None
+    azi = None
+    f = open(logname,"r")
+    for line in f:
+        if "final range offset poly. coeff.:" in line:
+            rng = [float(x) for x in line.split(":")[1].split()]
+        elif "final azimuth offset poly. coeff.:" in line:
+            azi = [float(x) for x in line.split(":")[1].split()]
+    f.close()
+    if rng is None or azi is None:
+        logging.error("ERROR: No final offset polynomial found in {}".format(logname))
+        exit(1)
+    return rng,azi
+
+#
+# Size of the correction an offset_fit log asks for, in pixels
+#
+def offset_correction(logname):
+    rng,azi = read_offset_fit(logname)
+    return max(abs(rng[0]),abs(azi[0]))
+
+def rasmph_pwr(ifgf,mli,offi):
+    width = par(offi).int("interferogram_width")
+    cmd = "rasmph_pwr {IFGF} {M}.mli {W} 1 1 0 3 3".format(IFGF=ifgf,M=mli,W=width)
+    execute(cmd,uselogging=True)
+
+#
+# The offset parameter files are refined in place from one step to the
+# next, so the in place updates are ordered with "after" rather than being
+# declared as outputs, and the pipeline is always run in full.
+#
+def coregister_data(cnt,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter,
+    workers=1):
 
     if (cnt < iter+1):
         offi = ifgname + ".off_{}".format(cnt)
@@ -42,49 +86,63 @@ def coregister_data(cnt,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slav
     srslc = slave + ".rslc"
     srpar = slave + ".rslc.par" 
 
+    if (cnt < iter+1):
+        diff = "{IFG}.diff0.it{I}".format(IFG=ifgname,I=cnt)
+    else:
+        diff = "{IFG}.diff0.man".format(IFG=ifgname)
+
+    p = Pipeline("coregistration {}".format(cnt))
+
+    inputs = [SLC2tab,spar,SLC1tab,mpar,lt,mmli,smli,SLC2Rtab]
+    if offit != "-":
+        inputs.append(offit)
     cmd = "SLC_interp_lt_S1_TOPS {TAB2} {SPAR} {TAB1} {MPAR} {LT} {MMLI} {SMLI} {OFFIT} {TAB2R} {SRSLC} {SRPAR}".format(TAB1=SLC1tab,TAB2=SLC2tab,TAB2R=SLC2Rtab,SPAR=spar,MPAR=mpar,LT=lt,MMLI=mmli,SMLI=smli,SRSLC=srslc,SRPAR=srpar,OFFIT=offit)
-    execute(cmd,uselogging=True)
+    p.add("SLC_interp_lt_S1_TOPS",cmd,inputs=inputs,outputs=[srslc,srpar])
 
     cmd = "create_offset {MPAR} {SPAR} {OFFI} 1 {RL} {AL} 0".format(MPAR=mpar,SPAR=spar,IFG=ifgname,RL=rlooks,AL=alooks,OFFI=offi)
-    execute(cmd,uselogging=True)
+    p.add("create_offset",cmd,inputs=[mpar,spar],outputs=[offi])
 
     if (cnt < iter+1):
         cmd = "offset_pwr {M}.slc {S}.rslc {MPAR} {SRPAR} {OFFI} offs snr 256 64 offsets 1 64 256 0.2".format(M=master,S=slave,MPAR=mpar,SRPAR=srpar,IFG=ifgname,OFFI=offi)
     else:
         cmd = "offset_pwr {M}.slc {S}.rslc {MPAR} {SRPAR} {OFFI} offs snr 512 256 - 1 16 64 0.2".format(M=master,S=slave,MPAR=mpar,SRPAR=srpar,IFG=ifgname,OFFI=offi)
-    execute(cmd,uselogging=True)
+    p.add("offset_pwr",cmd,inputs=[master+".slc",srslc,mpar,srpar,offi],outputs=["offs","snr"])
 
     cmd = "offset_fit offs snr {OFFI} - - 0.2 1".format(IFG=ifgname,OFFI=offi)
-    log = open("offsetfit{}.log".format(cnt),"w")
-    execute(cmd,uselogging=True,logfile=log)
-    log.close()
+    p.add("offset_fit",cmd,inputs=["offs","snr",offi],outputs=["offsetfit{}.log".format(cnt)],
+          logfile="offsetfit{}.log".format(cnt))
 
-    if (cnt < iter+1):
-        cmd = "SLC_diff_intf {M}.slc {S}.rslc {MPAR} {SRPAR} {OFFI} {IFG}.sim_unw {IFG}.diff0.it{I} {RL} {AL} 0 0".format(M=master,S=slave,MPAR=mpar,SRPAR=srpar,IFG=ifgname,RL=rlooks,AL=alooks,OFFI=offi,I=cnt)
-    else:
-        cmd = "SLC_diff_intf {M}.slc {S}.rslc {MPAR} {SRPAR} {OFFI} {IFG}.sim_unw {IFG}.diff0.man {RL} {AL} 0 0".format(M=master,S=slave,MPAR=mpar,SRPAR=srpar,IFG=ifgname,RL=rlooks,AL=alooks,OFFI=offi)
-    execute(cmd,uselogging=True)
+    cmd = "SLC_diff_intf {M}.slc {S}.rslc {MPAR} {SRPAR} {OFFI} {IFG}.sim_unw {DIFF} {RL} {AL} 0 0".format(M=master,S=slave,MPAR=mpar,SRPAR=srpar,IFG=ifgname,RL=rlooks,AL=alooks,OFFI=offi,DIFF=diff)
+    p.add("SLC_diff_intf",cmd,inputs=[master+".slc",srslc,mpar,srpar,offi,ifgname+".sim_unw"],
+          outputs=[diff],after=["offset_fit"])
 
-    width = getParameter(offi,"interferogram_width")
-    if (cnt < iter+1):
-        cmd = "rasmph_pwr {IFG}.diff0.it{I} {M}.mli {W} 1 1 0 3 3".format(IFG=ifgname,M=master,W=width,I=cnt)
-    else:
-        cmd = "rasmph_pwr {IFG}.diff0.man {M}.mli {W} 1 1 0 3 3".format(IFG=ifgname,M=master,W=width,I=cnt)
-    execute(cmd,uselogging=True)
+    p.add("rasmph_pwr",func=rasmph_pwr,args=(diff,master,offi),inputs=[diff],outputs=[diff+".bmp"])
     
     if (cnt == 0):
         offit = ifgname + ".off.it"
-        shutil.copy(offi,offit)
+        p.add("update offset",func=shutil.copy,args=(offi,offit),inputs=[offi],
+              after=["offset_fit","SLC_diff_intf"])
     elif (cnt<iter+1):
         cmd = "offset_add {OFFIT} {OFFI} {OFFI}.temp".format(OFFIT=offit,OFFI=offi)
-        execute(cmd,uselogging=True)
-        shutil.copy("{}.temp".format(offi),offit)
+        p.add("offset_add",cmd,inputs=[offi],outputs=["{}.temp".format(offi)],
+              after=["offset_fit","SLC_interp_lt_S1_TOPS"])
+        p.add("update offset",func=shutil.copy,args=("{}.temp".format(offi),offit),
+              inputs=["{}.temp".format(offi)],after=["SLC_diff_intf"])
     else:
         cmd = "offset_add {OFFIT} {OFFI} {OFFIT}.out".format(OFFIT=offit,OFFI=offi)
-        execute(cmd,uselogging=True)
+        p.add("offset_add",cmd,inputs=[offi],outputs=["{}.out".format(offit)],
+              after=["offset_fit","SLC_interp_lt_S1_TOPS"])
 
-  
-def interf_pwr_s1_lt_tops_proc(master,slave,dem,rlooks=10,alooks=2,iter=5,step=0):
+    p.run(workers=workers,force=True)
+
+#
+# Step 2 with a tolerance stops refining once the correction from an
+# iteration is below tol pixels, or once it stops getting smaller; the
+# last correction is then dropped, leaving the offsets the resampled slave
+# was made with.  It fails if the corrections really grow.  The number of
+# iterations run is returned.
+#
+def interf_pwr_s1_lt_tops_proc(master,slave,dem,rlooks=10,alooks=2,iter=5,step=0,workers=1,tol=None):
 
     # Setup various file names that we'll need    
     ifgname = "{}_{}".format(master,slave)
@@ -107,22 +165,50 @@ def interf_pwr_s1_lt_tops_proc(master,slave,dem,rlooks=10,alooks=2,iter=5,step=0
             exit(1)
         logging.info("Input DEM file {} found".format(dem))
         logging.info("Preparing initial look up table and sim_unw file")
+        p = Pipeline("lookup table")
         cmd = "create_offset {MPAR} {SPAR} {OFF} 1 {RL} {AL} 0".format(MPAR=mpar,SPAR=spar,OFF=off,RL=rlooks,AL=alooks)
-        execute(cmd,uselogging=True)
+        p.add("create_offset",cmd,inputs=[mpar,spar],outputs=[off])
         cmd = "rdc_trans {MMLI} {DEM} {SMLI} {LT}".format(MMLI=mmli,DEM=dem,SMLI=smli,M=master,LT=lt)
-        execute(cmd,uselogging=True)
+        p.add("rdc_trans",cmd,inputs=[mmli,dem,smli],outputs=[lt])
         cmd = "phase_sim_orb {MPAR} {SPAR} {OFF} {DEM} {IFG}.sim_unw {MPAR} -".format(MPAR=mpar,SPAR=spar,OFF=off,DEM=dem,IFG=ifgname,M=master)
-        execute(cmd,uselogging=True)
+        p.add("phase_sim_orb",cmd,inputs=[mpar,spar,off,dem],outputs=["{}.sim_unw".format(ifgname)])
+        p.run(workers=workers)
     elif step == 1:
         logging.info("Starting initial coregistration with look up table")
-        coregister_data(0,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter)
+        coregister_data(0,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter,
+                        workers=workers)
     elif step == 2:
         logging.info("Starting iterative coregistration with look up table")
+        offit = ifgname + ".off.it"
+        best = None
         for n in range (1,iter+1):
-            coregister_data(n,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter)
+            if tol is not None:
+                shutil.copy(offit,offit + ".prev")
+            coregister_data(n,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter,
+                        workers=workers)
+            if tol is None:
+                continue
+            corr = offset_correction("offsetfit{}.log".format(n))
+            logging.info("Iteration {} offset correction {} pixels".format(n,corr))
+            if corr < tol:
+                logging.info("Coregistration converged after {} iterations".format(n))
+                os.remove(offit + ".prev")
+                return n
+            if best is not None and corr > DIVERGE_FACTOR*best and corr > DIVERGE_FLOOR:
+                logging.error("ERROR: Coregistration diverging; offset correction grew from {} to {} pixels".format(best,corr))
+                exit(1)
+            if best is not None and corr >= best:
+                logging.info("Offset correction no longer decreasing; stopping after {} iterations".format(n))
+                shutil.move(offit + ".prev",offit)
+                return n
+            best = corr
+        if tol is not None:
+            os.remove(offit + ".prev")
+        return iter
     elif step == 3:
         logging.info("Starting single interation coregistration with look up table")
-        coregister_data(iter+1,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter)
+        coregister_data(iter+1,SLC2tab,SLC2Rtab,spar,mpar,mmli,smli,ifgname,master,slave,lt,rlooks,alooks,iter,
+                        workers=workers)
     else:
         logging.error("ERROR: Unrecognized step {}; must be from 0 - 2".format(step))
         exit(1)     
@@ -137,6 +223,8 @@ if __name__ == '__main__':
   parser.add_argument("-r","--rlooks",default=10,help="Number of range looks (def=10)",type=int)
   parser.add_argument("-a","--alooks",default=2,help="Number of azimuth looks (def=2)",type=int)
   parser.add_argument("-i","--iter",help='Number of coregistration iterations (def=5)',default=5,type=int)
+  parser.add_argument("-w","--workers",default=1,type=int,help="Number of commands to run concurrently (def=1)")
+  parser.add_argument("-t","--tol",type=float,help="Stop iterating once the offset correction is below this many pixels")
   parser.add_argument("-s","--step",type=int,help='Procesing step: 0) Prepare LUT and SIM_UNW; 1) Initial co-registration with DEM; 2) iteration coregistration',default=0)
   args = parser.parse_args()
 
@@ -146,6 +234,7 @@ if __name__ == '__main__':
   logging.getLogger().addHandler(logging.StreamHandler())
   logging.info("Starting run")
 
-  interf_pwr_s1_lt_tops_proc(args.master,args.slave,args.dem,rlooks=args.rlooks,alooks=args.alooks,iter=args.iter,step=args.step)
+  interf_pwr_s1_lt_tops_proc(args.master,args.slave,args.dem,rlooks=args.rlooks,alooks=args.alooks,iter=args.iter,step=args.step,
+    workers=args.workers,tol=args.tol)
     
 
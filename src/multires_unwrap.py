@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import os
+import math
+import time
+import shutil
+import numpy as np
+from osgeo import gdal
+from telemetry import execute
+from gamma_io import par, read_raster, create_raster, FLOAT, FCOMPLEX, BYTE
+from pipeline import Pipeline
+from tiled_unwrap import patch_boxes, cut_raster, cut_mask, overlap_offset, MIN_OVERLAP_PIXELS, \
+    UNWRAP_WORKERS, TWO_PI
+
+# Lines handled per pass
+CHUNK = 512
+
+# Default further multilooking of the coarse interferogram
+MULTIRES_FACTOR = 4
+
+# Coherence below which pixels are left unwrapped, as rascc_mask does, when
+# there is no mask
+MASK_CC = 0.10
+
+# Coherence below which the coarse solution is not trusted
+LOW_CC = 0.30
+
+# Pixels whose wrapped phase is further than this from the coarse solution
+# could round to either cycle
+AMBIGUOUS = 0.8*np.pi
+
+# Blocks are unwrapped again with mcf when more than this share of their
+# unmasked pixels has low coherence or an ambiguous cycle
+FALLBACK_SHARE = 0.25
+
+# Size of the blocks considered for the mcf fallback
+BLOCK = 1024
+
+#
+# Pixels to unwrap, from the mask raster (non zero where mcf unwraps), or
+# None if there is no mask
+#
+def read_mask(mask):
+    if not os.path.isfile(mask):
+        return None
+    src = gdal.Open(mask)
+    data = src.GetRasterBand(1).ReadAsArray()
+    src = None
+    return data
+
+#
+# The mask at factor x factor coarser resolution: a cell is unwrapped when
+# most of its pixels are, and takes the largest of their values
+#
+def multilook_mask(mask,valid,factor,wc,nc,mask_out):
+    block = valid[:nc*factor,:wc*factor].reshape(nc,factor,wc,factor)
+    values = mask[:nc*factor,:wc*factor].reshape(nc,factor,wc,factor).max(axis=(1,3))
+    keep = block.sum(axis=(1,3)) * 2 >= factor*factor
+    src = gdal.Open(mask)
+    band = src.GetRasterBand(1)
+    dst = gdal.GetDriverByName("BMP").Create(mask_out,wc,nc,1,gdal.GDT_Byte)
+    if band.GetColorTable() is not None:
+        dst.GetRasterBand(1).SetColorTable(band.GetColorTable())
+    dst.GetRasterBand(1).WriteArray(np.where(keep,values,0).astype(np.uint8))
+    dst = None
+    src = None
+
+#
+# Sum the interferogram and average the coherence over factor x factor
+# pixels; the edges that do not fill a whole cell are dropped
+#
+def multilook(ifg,cc,width,factor,ifg_out,cc_out):
+    data = read_raster(ifg,width,type=FCOMPLEX)
+    coh = read_raster(cc,width,type=FLOAT)
+    nlines = min(data.shape[0],coh.shape[0])
+    wc = width//factor
+    nc = nlines//factor
+    out = create_raster(ifg_out,wc,nc,type=FCOMPLEX)
+    cout = create_raster(cc_out,wc,nc,type=FLOAT)
+    step = max(1,CHUNK//factor)
+    for c0 in range(0,nc,step):
+        c1 = min(nc,c0+step)
+        a0,a1 = c0*factor,c1*factor
+        block = np.array(data[a0:a1,:wc*factor],dtype=np.complex64).reshape(c1-c0,factor,wc,factor)
+        out[c0:c1] = block.sum(axis=(1,3))
+        block = np.array(coh[a0:a1,:wc*factor],dtype=np.float32).reshape(c1-c0,factor,wc,factor)
+        cout[c0:c1] = block.mean(axis=(1,3))
+    out.flush()
+    cout.flush()
+    del out,cout
+    return wc,nc
+
+#
+# Bilinear interpolation of full resolution lines a0..a1 from a coarse
+# raster made with factor x factor looks.  Zero (unwrapped) coarse pixels
+# are left out; where all four neighbours are zero the result is zero.
+#
+def upsample(coarse,factor,a0,a1,width):
+    nc,wc = coarse.shape
+    y = np.clip((np.arange(a0,a1)+0.5)/factor-0.5,0,nc-1)
+    x = np.clip((np.arange(width)+0.5)/factor-0.5,0,wc-1)
+    y0 = np.floor(y).astype(int)
+    x0 = np.floor(x).astype(int)
+    y1 = np.minimum(y0+1,nc-1)
+    x1 = np.minimum(x0+1,wc-1)
+    wy = (y-y0)[:,None]
+    wx = x-x0
+
+    rows = np.unique(np.concatenate((y0,y1)))
+    lut = np.searchsorted(rows,np.arange(nc))
+    sub = np.array(coarse[rows],dtype=np.float64)
+    valid = (sub != 0).astype(np.float64)
+    def interp(v):
+        v = v[lut[y0]]*(1-wy) + v[lut[y1]]*wy
+        return v[:,x0]*(1-wx) + v[:,x1]*wx
+    num = interp(sub)
+    den = interp(valid)
+    out = np.zeros(num.shape,dtype=np.float64)
+    ok = den > 1e-6
+    out[ok] = num[ok]/den[ok]
+    return out,ok
+
+#
+# Full resolution unwrapped phase from the wrapped phase and the upsampled
+# coarse solution: each pixel takes the cycle that brings it nearest to
+# the coarse phase.  Pixels whose cycle is doubtful (low coherence, far
+# from the coarse phase or with no coarse phase around) are flagged in the
+# BYTE raster doubtful.  Pixels outside valid (below MASK_CC coherence
+# without a mask) are left unwrapped.  Returns the number of lines and the
+# counts of unmasked and doubtful pixels.
+#
+def refine(ifg,cc,coarse,factor,width,unw,doubtful,valid=None):
+    data = read_raster(ifg,width,type=FCOMPLEX)
+    coh = read_raster(cc,width,type=FLOAT)
+    nlines = min(data.shape[0],coh.shape[0])
+    out = create_raster(unw,width,nlines,type=FLOAT)
+    doubt = create_raster(doubtful,width,nlines,type=BYTE)
+    unmasked = 0
+    doubts = 0
+    for a0 in range(0,nlines,CHUNK):
+        a1 = min(nlines,a0+CHUNK)
+        phase = np.angle(np.array(data[a0:a1],dtype=np.complex64)).astype(np.float64)
+        c = np.array(coh[a0:a1],dtype=np.float32)
+        up,ok = upsample(coarse,factor,a0,a1,width)
+        cycles = np.round((up-phase)/TWO_PI)
+        result = phase + TWO_PI*cycles
+        residual = np.abs(up-result)
+        if valid is None:
+            masked = c < MASK_CC
+        else:
+            masked = ~valid[a0:a1,:width]
+        flags = ~masked & (~ok | (c < LOW_CC) | (residual > AMBIGUOUS))
+        result[masked | ~ok] = 0
+        out[a0:a1] = result
+        doubt[a0:a1] = flags
+        unmasked += int((~masked).sum())
+        doubts += int(flags.sum())
+    out.flush()
+    doubt.flush()
+    del out,doubt
+    return nlines,unmasked,doubts
+
+#
+# Unwrap the blocks with too many doubtful pixels again with mcf, and put
+# each back shifted by the whole cycles that make it agree with the
+# refined solution around it
+#
+def fallback(ifg,cc,mask,unw,width,nlines,doubtful,trimode,workers,valid=None):
+    coh = read_raster(cc,width,type=FLOAT)
+    doubt = read_raster(doubtful,width,type=BYTE)
+    npr = max(1,int(math.ceil(width/float(BLOCK))))
+    npa = max(1,int(math.ceil(nlines/float(BLOCK))))
+    boxes = []
+    for core,full in patch_boxes(width,nlines,npr,npa):
+        r0,r1,a0,a1 = core
+        if valid is None:
+            unmasked = int((np.array(coh[a0:a1,r0:r1]) >= MASK_CC).sum())
+        else:
+            unmasked = int(valid[a0:a1,r0:r1].sum())
+        if unmasked and doubt[a0:a1,r0:r1].sum() > FALLBACK_SHARE*unmasked:
+            boxes.append((core,full))
+    if not boxes:
+        return 0
+
+    tmp = "{}.fallback".format(unw)
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    p = Pipeline("mcf fallback")
+    names = []
+    for t,(core,full) in enumerate(boxes):
+        base = os.path.join(tmp,"{:03d}".format(t))
+        cut_raster(ifg,base+".int",width,FCOMPLEX,full)
+        cut_raster(cc,base+".cc",width,FLOAT,full)
+        m = "-"
+        if os.path.isfile(mask):
+            m = base+".bmp"
+            cut_mask(mask,m,full)
+        cmd = "mcf {B}.int {B}.cc {M} {B}.unw {W} {TRI} 0 0 - - 1 1".format(B=base,M=m,W=full[1]-full[0],TRI=trimode)
+        p.add("mcf {:03d}".format(t),cmd,inputs=[base+".int",base+".cc"],outputs=[base+".unw"],
+              logfile=base+".log")
+        names.append(base+".unw")
+    p.run(workers=workers,force=True)
+
+    out = read_raster(unw,width,type=FLOAT,mode="r+")
+    for name,(core,full) in zip(names,boxes):
+        r0,r1,a0,a1 = full
+        tile = np.array(read_raster(name,r1-r0,type=FLOAT),dtype=np.float64)
+        ref = np.array(out[a0:a1,r0:r1],dtype=np.float64)
+        ref[doubt[a0:a1,r0:r1] != 0] = 0
+        cycles,count = overlap_offset(ref,tile)
+        if count < MIN_OVERLAP_PIXELS:
+            logging.warning("WARNING: No reliable pixels around fallback block {}; kept the coarse solution".format(name))
+            continue
+        tile[tile != 0] += TWO_PI*cycles
+        c0,c1,b0,b1 = core
+        part = tile[b0-a0:b1-a0,c0-r0:c1-r0]
+        region = out[b0:b1,c0:c1]
+        region[part != 0] = part[part != 0]
+    out.flush()
+    del out
+    shutil.rmtree(tmp,ignore_errors=True)
+    return len(boxes)
+
+#
+# Share of the pixels unwrapped in both a and b whose cycle count differs
+# from the one most of them agree on (the two may differ by a constant
+# number of cycles)
+#
+def disagreement(a,b,width):
+    ra = read_raster(a,width,type=FLOAT)
+    rb = read_raster(b,width,type=FLOAT)
+    nlines = min(ra.shape[0],rb.shape[0])
+    counts = {}
+    for a0 in range(0,nlines,CHUNK):
+        a1 = min(nlines,a0+CHUNK)
+        x = np.array(ra[a0:a1],dtype=np.float64)
+        y = np.array(rb[a0:a1],dtype=np.float64)
+        both = (x != 0) & (y != 0)
+        values,n = np.unique(np.round((x[both]-y[both])/TWO_PI).astype(int),return_counts=True)
+        for v,c in zip(values,n):
+            counts[v] = counts.get(v,0) + int(c)
+    total = sum(counts.values())
+    if total == 0:
+        return None
+    return 1.0 - max(counts.values())/float(total)
+
+#
+# Unwrap at factor x factor coarser resolution with mcf, carry the solution
+# to full resolution by fixing the cycle of every wrapped pixel from it, and
+# rerun mcf only on the blocks where that is not reliable.  The mask is
+# multilooked for the coarse mcf and decides which pixels are refined and
+# counted for the fallback.  factor must be at least 2.  Same inputs and
+# output as the single mcf command.  With compare, plain mcf is run as well
+# and the share of pixels whose cycles disagree with it is logged.
+#
+def multires_mcf(ifg,cc,mask,unw,parfile,trimode=0,factor=MULTIRES_FACTOR,workers=UNWRAP_WORKERS,
+                 compare=False):
+    if factor < 2:
+        logging.error("ERROR: Multiresolution factor must be at least 2, not {}".format(factor))
+        exit(1)
+    t0 = time.time()
+    width,nlines = par(parfile).shape()
+    tmp = "{}.coarse".format(unw)
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    base = os.path.join(tmp,"coarse")
+    wc,nc = multilook(ifg,cc,width,factor,base+".int",base+".cc")
+    logging.info("Unwrapping {} x {} interferogram at {} x {} ({} looks)".format(width,nlines,wc,nc,factor))
+
+    m = "-"
+    values = read_mask(mask)
+    valid = None
+    if values is not None:
+        valid = values != 0
+        m = base+".bmp"
+        multilook_mask(values,valid,factor,wc,nc,m)
+        del values
+    cmd = "mcf {B}.int {B}.cc {M} {B}.unw {W} {TRI} 0 0 - - 1 1".format(B=base,M=m,W=wc,TRI=trimode)
+    execute(cmd,uselogging=True)
+    coarse = read_raster(base+".unw",wc,type=FLOAT)
+
+    nlines,unmasked,doubts = refine(ifg,cc,coarse,factor,width,unw,base+".doubt",valid)
+    del coarse
+    logging.info("{:.2f}% of the unmasked pixels have a doubtful cycle".format(100.0*doubts/max(1,unmasked)))
+
+    blocks = fallback(ifg,cc,mask,unw,width,nlines,base+".doubt",trimode,workers,valid)
+    shutil.rmtree(tmp,ignore_errors=True)
+    elapsed = time.time()-t0
+    logging.info("Multiresolution unwrapping took {:.1f}s, {} blocks unwrapped again with mcf".format(elapsed,blocks))
+
+    if compare:
+        t0 = time.time()
+        ref = "{}.mcf".format(unw)
+        cmd = "mcf {} {} {} {} {} {} 0 0 - - 1 1".format(ifg,cc,mask,ref,width,trimode)
+        execute(cmd,uselogging=True)
+        share = disagreement(unw,ref,width)
+        logging.info("Plain mcf took {:.1f}s; cycle disagreement with it {}".format(
+                     time.time()-t0,"n/a" if share is None else "{:.3f}%".format(100.0*share)))
+        os.remove(ref)
+
+#
+# argparse type for a multiresolution factor
+#
+def factor_arg(value):
+    factor = int(value)
+    if factor < 2:
+        raise argparse.ArgumentTypeError("factor must be at least 2, not {}".format(value))
+    return factor
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='multires_unwrap.py',
+    description='Unwrap an interferogram at coarse resolution and carry the solution to full resolution')
+  parser.add_argument("ifg",help='Filtered interferogram (e.g. <ifg>.diff0.man.adf)')
+  parser.add_argument("cc",help='Coherence (e.g. <ifg>.adf.cc)')
+  parser.add_argument("mask",help='Mask raster (e.g. <ifg>.adf.cc_mask.bmp) or -')
+  parser.add_argument("unw",help='Unwrapped output')
+  parser.add_argument("off",help='Offset parameter file giving the interferogram size')
+  parser.add_argument("-f","--factor",default=MULTIRES_FACTOR,type=factor_arg,
+    help="Further looks of the coarse interferogram in each direction (def={})".format(MULTIRES_FACTOR))
+  parser.add_argument("-t","--tri",default=0,help="Triangulation method for mcf: 0) filled triangular mesh (default); 1) Delaunay triangulation")
+  parser.add_argument("-w","--workers",default=UNWRAP_WORKERS,type=int,
+    help="Number of fallback blocks to unwrap concurrently (def={})".format(UNWRAP_WORKERS))
+  parser.add_argument("-c","--compare",action="store_true",help="Also run plain mcf and report the cycle disagreement")
+  args = parser.parse_args()
+
+  logFile = "multires_unwrap_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  multires_mcf(args.ifg,args.cc,args.mask,args.unw,args.off,trimode=args.tri,factor=args.factor,
+      workers=args.workers,compare=args.compare)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+###############################################################################
+# orbit_store.py
+#
+# Project:  ADP INSAR
+# Purpose:  Keep Sentinel-1 orbit files in a local directory and pick the
+#           one covering each acquisition
+#
+###############################################################################
+# Copyright (c) 2018, Alaska Satellite Facility
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+###############################################################################
+
+import logging
+import argparse
+import os
+import re
+import fcntl
+import shutil
+import datetime
+from get_orb import downloadSentinelOrbitFile
+
+# Orbit directory shared by all runs (none by default) and whether to stay
+# off the network, taken from the environment
+ORBIT_DIR = os.environ.get("ORBIT_DIR")
+ORBIT_OFFLINE = os.environ.get("ORBIT_OFFLINE","0") not in ("","0")
+
+# Precise orbits are preferred over restituted ones
+ORBIT_TYPES = ("POEORB","RESORB")
+
+# The orbit must cover the acquisition by this much on either side
+MARGIN = datetime.timedelta(seconds=60)
+
+EOF_NAME = re.compile(r"^(S1[AB])_OPER_AUX_(POEORB|RESORB)_OPOD_(\d{8}T\d{6})_V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF$")
+
+def parseStamp(stamp):
+    return datetime.datetime.strptime(stamp,"%Y%m%dT%H%M%S")
+
+#
+# Mission, type, production time and validity window of an orbit file, or
+# None if the name is not that of one
+#
+def parseOrbitName(name):
+    m = EOF_NAME.match(os.path.basename(name))
+    if m is None:
+        return None
+    mission,kind,made,start,end = m.groups()
+    return {"mission": mission, "type": kind, "made": parseStamp(made),
+            "start": parseStamp(start), "end": parseStamp(end)}
+
+#
+# Mission and start and stop times of a granule (zip, SAFE or plain name)
+#
+def parseGranule(granule):
+    t = os.path.basename(granule.rstrip("/")).split("_")
+    return t[0],parseStamp(t[5]),parseStamp(t[6])
+
+#
+# A directory of orbit files.  The file names hold everything needed to
+# choose between them, so the index is the directory listing, reread
+# whenever the directory changes.  Files missing from the directory are
+# downloaded once, however many processes ask for them at the same time.
+#
+class OrbitStore(object):
+
+    def __init__(self,root,offline=ORBIT_OFFLINE):
+        self.root = os.path.abspath(root)
+        self.offline = offline
+        self._stamp = None
+        self._index = []
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                if not os.path.isdir(self.root):
+                    raise
+
+    def index(self):
+        stamp = os.path.getmtime(self.root)
+        if stamp != self._stamp:
+            self._index = []
+            for name in os.listdir(self.root):
+                info = parseOrbitName(name)
+                if info is not None:
+                    info["path"] = os.path.join(self.root,name)
+                    self._index.append(info)
+            self._stamp = stamp
+        return self._index
+
+    #
+    # The orbit file in the store covering granule: precise before
+    # restituted, then the most recently produced.  None if there is none.
+    #
+    def find(self,granule):
+        mission,start,end = parseGranule(granule)
+        best = None
+        for info in self.index():
+            if info["mission"] != mission:
+                continue
+            if info["start"] > start - MARGIN or info["end"] < end + MARGIN:
+                continue
+            rank = (-ORBIT_TYPES.index(info["type"]),info["made"])
+            if best is None or rank > best[0]:
+                best = (rank,info["path"])
+        return None if best is None else best[1]
+
+    def _fetch(self,granule):
+        back = os.getcwd()
+        tmp = os.path.join(self.root,".fetch{}".format(os.getpid()))
+        if not os.path.isdir(tmp):
+            os.makedirs(tmp)
+        os.chdir(tmp)
+        try:
+            orbfile,provider = downloadSentinelOrbitFile(os.path.basename(granule.rstrip("/")))
+            orbfile = os.path.abspath(orbfile)
+        finally:
+            os.chdir(back)
+        if parseOrbitName(orbfile) is None:
+            shutil.rmtree(tmp,ignore_errors=True)
+            raise ValueError("Downloaded file {} is not an orbit file".format(orbfile))
+        os.rename(orbfile,os.path.join(self.root,os.path.basename(orbfile)))
+        shutil.rmtree(tmp,ignore_errors=True)
+        self._stamp = None
+        logging.info("Stored orbit file {} from {}".format(os.path.basename(orbfile),provider))
+
+    #
+    # The path of the orbit file covering granule, downloading it into the
+    # store first if needed and allowed.  None if no orbit can be had.
+    #
+    def get(self,granule):
+        eof = self.find(granule)
+        if eof is not None or self.offline:
+            return eof
+        mission,start,end = parseGranule(granule)
+        lock = open(os.path.join(self.root,".{}_{}.lock".format(mission,start.strftime("%Y%m%d"))),"a")
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            # Someone else may have fetched it while we waited
+            eof = self.find(granule)
+            if eof is None:
+                try:
+                    self._fetch(granule)
+                except Exception as e:
+                    logging.warning("WARNING: Unable to download orbit for {}: {}".format(granule,e))
+                eof = self.find(granule)
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+            lock.close()
+        return eof
+
+#
+# Default orbit directory: $ORBIT_DIR, or ORBITS under the directory given
+# (the current one if none).  A stack passes its own directory so that all
+# of its pairs share one store.
+#
+def orbitDir(base=None):
+    return ORBIT_DIR or os.path.join(os.path.abspath(base or os.getcwd()),"ORBITS")
+
+def getOrbitStore(root=None):
+    if root is None:
+        root = orbitDir()
+    return OrbitStore(root)
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='orbit_store.py',
+    description='Find (and fetch) the orbit files covering Sentinel-1 granules')
+  parser.add_argument("granules",nargs="+",help="Granule names, zip files or SAFE directories")
+  parser.add_argument("-d","--dir",help="Orbit directory (def=$ORBIT_DIR or ORBITS)")
+  parser.add_argument("--offline",action="store_true",help="Only use orbit files already in the directory")
+  args = parser.parse_args()
+
+  logFile = "orbit_store_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  store = getOrbitStore(args.dir)
+  if args.offline:
+      store.offline = True
+  for granule in args.granules:
+      logging.info("{} {}".format(granule,store.get(granule)))
@@ -3,124 +3,265 @@
 import logging
 import argparse
 from argparse import RawTextHelpFormatter
-from execute import execute
-from get_orb import downloadSentinelOrbitFile
-from getParameter import getParameter
-import sys, re, os
+from telemetry import execute
+from orbit_store import getOrbitStore
+from gamma_io import par
+from pipeline import Pipeline, PipelineError
+import os
 import zipfile
 import glob
 import shutil
+import threading
+import multiprocessing
 
 #
-# This subroutine puts together the par_S1_SLC gamma commands
+# This subroutine puts together the par_S1_SLC gamma commands.  safe is the
+# SAFE directory and path the output directory; the command works from any
+# directory.
 #
-def make_cmd(val,acqdate,path,pol=None):
+def make_cmd(val,acqdate,path,pol=None,safe="."):
+    def find(pattern):
+        return os.path.abspath(glob.glob(os.path.join(safe,pattern))[0])
     if pol is None:
-        m = glob.glob("measurement/s1*-iw{VAL}*".format(VAL=val))[0]
-        n = glob.glob("annotation/s1*-iw{VAL}*".format(VAL=val))[0]
-        o = glob.glob("annotation/calibration/calibration-s1*-iw{VAL}*".format(VAL=val))[0]
-        p = glob.glob("annotation/calibration/noise-s1*-iw{VAL}*".format(VAL=val))[0]
+        m = find("measurement/s1*-iw{VAL}*".format(VAL=val))
+        n = find("annotation/s1*-iw{VAL}*".format(VAL=val))
+        o = find("annotation/calibration/calibration-s1*-iw{VAL}*".format(VAL=val))
+        p = find("annotation/calibration/noise-s1*-iw{VAL}*".format(VAL=val))
     else:
-        m = glob.glob("measurement/s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))[0]
-        n = glob.glob("annotation/s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))[0]
-        o = glob.glob("annotation/calibration/calibration-s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))[0]
-        p = glob.glob("annotation/calibration/noise-s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))[0]
+        m = find("measurement/s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))
+        n = find("annotation/s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))
+        o = find("annotation/calibration/calibration-s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))
+        p = find("annotation/calibration/noise-s1*-iw{VAL}*{POL}*".format(VAL=val,POL=pol))
     cmd = "par_S1_SLC {m} {n} {o} {p} {path}/{acq}_00{VAL}.slc.par {path}/{acq}_00{VAL}.slc {path}/{acq}_00{VAL}.tops_par".format(acq=acqdate,m=m,n=n,o=o,p=p,VAL=val,path=path) 
     return cmd
 
-def par_s1_slc(pol=None):
+# Number of zip members decompressed at once
+UNZIP_WORKERS = min(4,multiprocessing.cpu_count())
+
+# Number of gamma ingest commands (one swath each) run at once
+INGEST_WORKERS = min(6,multiprocessing.cpu_count())
+
+#
+# Whether a member of a SAFE zip is needed for processing: the manifest, the
+# annotation, calibration and noise XMLs of every polarization (they are
+# small, and the metadata reads the co-pol annotation even when a cross-pol
+# is processed) and, unless only the annotation is wanted, the measurement
+# TIFFs of the given polarization (or all of them).  Previews, quicklooks
+# and support schemas are left in the zip.
+#
+def wanted_member(name,pol=None,annotation_only=False):
+    parts = name.split("/")
+    if len(parts) < 2 or not parts[-1]:
+        return False
+    if parts[1:] == ["manifest.safe"]:
+        return True
+    base = parts[-1]
+    if parts[1:-1] == ["measurement"]:
+        return (base.endswith(".tiff") and not annotation_only and
+                (pol is None or "-{}-".format(pol.lower()) in base))
+    elif parts[1:-1] == ["annotation"] or parts[1:-1] == ["annotation","calibration"]:
+        return base.endswith(".xml") and not base.startswith("rfi-")
+    return False
+
+def extract_members(zipname,members,dest):
+    zip_ref = zipfile.ZipFile(zipname,'r')
+    for info in members:
+        out = os.path.join(dest,info.filename)
+        if not os.path.isdir(os.path.dirname(out)):
+            try:
+                os.makedirs(os.path.dirname(out))
+            except OSError:
+                pass
+        # Written under a temporary name so a partial file is never taken
+        # for a complete one
+        src = zip_ref.open(info)
+        f = open(out + ".part","wb")
+        shutil.copyfileobj(src,f,1024*1024)
+        f.close()
+        src.close()
+        os.rename(out + ".part",out)
+    zip_ref.close()
+
+#
+# Extract the members of a SAFE zip needed for pol into dest, skipping any
+# already there, with the members spread over workers threads each reading
+# the zip through its own handle
+#
+def unzip_safe(zipname,pol=None,dest=".",workers=UNZIP_WORKERS,annotation_only=False):
+    zip_ref = zipfile.ZipFile(zipname,'r')
+    infos = zip_ref.infolist()
+    zip_ref.close()
+    members = [x for x in infos if wanted_member(x.filename,pol,annotation_only)]
+    if pol is not None and not annotation_only and not any("/measurement/" in x.filename for x in members):
+        # Single pol files have only the one polarization, whatever was asked for
+        logging.info("No {} files in {}; extracting all polarizations".format(pol,zipname))
+        members = [x for x in infos if wanted_member(x.filename,None,annotation_only)]
+    total = len(members)
+    members = [x for x in members if not os.path.isfile(os.path.join(dest,x.filename)) or
+               os.path.getsize(os.path.join(dest,x.filename)) != x.file_size]
+    if not members:
+        return
+    logging.info("Extracting {} of {} needed files ({:.1f} MB) from {}".format(len(members),total,
+                 sum(x.file_size for x in members)/1024.0**2,zipname))
+
+    # Largest first, dealt out so each worker gets a similar amount of data
+    members.sort(key=lambda x: x.file_size,reverse=True)
+    workers = max(1,min(workers,len(members)))
+    lists = [members[i::workers] for i in range(workers)]
+    errors = []
+    def work(part):
+        try:
+            extract_members(zipname,part,dest)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work,args=(part,)) for part in lists]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        logging.error("ERROR: Unable to extract {}: {}".format(zipname,errors[0]))
+        exit(1)
+
+def unzip_files(pol=None,workers=UNZIP_WORKERS,annotation_only=False):
+    for myfile in os.listdir("."):
+        if myfile.endswith(".zip"):
+            logging.info("Unzipping file {}".format(myfile))
+            unzip_safe(myfile,pol,".",workers,annotation_only)
+
+def get_acq_date(myfile):
+    return (os.path.basename(myfile).split("_")[5].split("T"))[0]
+
+def is_ingested(path):
+    return os.path.isfile(os.path.join(path,"SLC_TAB"))
+
+def write_slc_tab(path):
+    slc = sorted(glob.glob(os.path.join(path,"*_00*.slc")))
+    pars = sorted(glob.glob(os.path.join(path,"*_00*.slc.par")))
+    top = sorted(glob.glob(os.path.join(path,"*_00*.tops_par")))
+    f = open(os.path.join(path,"SLC_TAB"),"w")
+    for i in range(len(slc)):
+        f.write("{} {} {}\n".format(os.path.basename(slc[i]),os.path.basename(pars[i]),
+                                    os.path.basename(top[i])))
+    f.close()
+
+def ras_slc(slc,parfile):
+    width = par(parfile).int("range_samples")
+    execute("rasSLC {} {} 1 0 50 10".format(slc,width),uselogging=True)
+
+#
+# Add the steps ingesting a SAFE directory into gamma format SLC, par and
+# tops_par files plus an SLC_TAB in path to pipeline p.  Each swath is read
+# and gets its orbit on its own, and every path is absolute, so the steps
+# of any number of swaths and scenes can run at the same time.
+#
+def ingest_nodes(p,myfile,pol,path,orbits=None):
+
+    path = os.path.abspath(path)
+    myfile = os.path.abspath(myfile)
+    name = os.path.basename(myfile)
+
+    logging.info("Procesing directory {}".format(myfile))
+    mytype = name[13:16]
+    logging.info("Found image type {}".format(mytype))
+
+    if "SSH" in mytype or "SSV" in mytype:
+         logging.info("Found single pol file")
+         single_pol = 1
+    elif "SDV" in mytype:
+         logging.info("Found multi-pol file")
+         single_pol = 0
+         if "hv" in pol or "hh" in pol:
+             logging.error("ERROR: no {} polarization exists in a {} file".format(pol,mytype))
+             exit(1)
+    elif "SDH" in mytype:
+         logging.info("Found multi-pol file")
+         single_pol = 0
+         if "vh" in pol or "vv" in pol:
+             logging.error("ERROR: no {} polarization exists in a {} file".format(pol,mytype))
+             exit(1)
+
+    folder = name.replace(".SAFE","")
+    datelong = name.split("_")[5]
+    acqdate = get_acq_date(name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    logging.info("Folder is {}".format(folder))
+    logging.info("Long date is {}".format(datelong))
+    logging.info("Acquisition date is {}".format(acqdate))
+
+    # The orbit is looked up (or fetched) up front, once for all swaths
+    logging.info("Getting precision orbit for file {}".format(myfile))
+    if orbits is None:
+        orbits = getOrbitStore()
+    eof = orbits.get(name)
+    if eof is None:
+        logging.warning("WARNING: No orbit file covers {}; using the annotation orbit".format(name))
+    else:
+        logging.info("Using orbit file {}".format(eof))
+
+    done = []
+    for val in (1,2,3):
+        base = os.path.join(path,"{}_00{}".format(acqdate,val))
+        cmd = make_cmd(val,acqdate,path,pol=None if single_pol == 1 else pol,safe=myfile)
+        node = p.add("par_S1_SLC {} {}".format(acqdate,val),cmd,
+                     outputs=[base + ".slc",base + ".slc.par",base + ".tops_par"])
+        if eof is not None:
+            node = p.add("S1_OPOD_vec {} {}".format(acqdate,val),
+                         "S1_OPOD_vec {}.slc.par {}".format(base,eof),
+                         inputs=[base + ".slc.par"])
+        done.append(node.name)
+
+    #
+    # Make a raster version of swath 3
+    #
+    base = os.path.join(path,"{}_003".format(acqdate))
+    p.add("rasSLC {}".format(acqdate),func=ras_slc,args=(base + ".slc",base + ".slc.par"),
+          after=done[2:])
+
+    # The SLC_TAB is written last; its presence marks a complete ingest
+    p.add("SLC_TAB {}".format(acqdate),func=write_slc_tab,args=(path,),
+          outputs=[os.path.join(path,"SLC_TAB")],after=done + ["rasSLC {}".format(acqdate)])
+
+#
+# Ingest SAFE directories, given as (SAFE, output path) pairs, running up
+# to workers gamma commands at a time
+#
+def ingest_safes(scenes,pol,workers=INGEST_WORKERS,orbits=None):
+    p = Pipeline("ingest")
+    if orbits is None:
+        orbits = getOrbitStore()
+    for myfile,path in scenes:
+        ingest_nodes(p,myfile,pol,path,orbits)
+    try:
+        p.run(workers=workers,force=True)
+    except PipelineError as e:
+        logging.error("ERROR: {}".format(e))
+        exit(1)
+
+def ingest_safe(myfile,pol,path,workers=INGEST_WORKERS,orbits=None):
+    ingest_safes([(myfile,path)],pol,workers,orbits)
+
+def par_s1_slc(pol=None,workers=INGEST_WORKERS,orbit_dir=None):
 
     wrk = os.getcwd()
    
     if pol is None:
         pol = 'vv'
 
-    for myfile in os.listdir("."):
-        if ".zip" in myfile:
-            if not os.path.exists(myfile.replace(".zip",".SAFE")):
-                logging.info("Unzipping file {}".format(myfile))
-                zip_ref = zipfile.ZipFile(myfile, 'r')
-                zip_ref.extractall(".")
-                zip_ref.close()    
+    unzip_files(pol)
 
+    scenes = []
     for myfile in os.listdir("."):
       if ".SAFE" in myfile:
-        logging.info("Procesing directory {}".format(myfile))
-        mytype = myfile[13:16]
-        logging.info("Found image type {}".format(mytype))
-
-        if "SSH" in mytype or "SSV" in mytype:
-             logging.info("Found single pol file")
-             single_pol = 1
-        elif "SDV" in mytype:
-             logging.info("Found multi-pol file")
-             single_pol = 0
-             if "hv" in pol or "hh" in pol:
-                 logging.error("ERROR: no {} polarization exists in a {} file".format(pol,mytype))
-                 exit(1)
-        elif "SDH" in mytype:
-             logging.info("Found multi-pol file")
-             single_pol = 0
-             if "vh" in pol or "vv" in pol:
-                 logging.error("ERROR: no {} polarization exists in a {} file".format(pol,mytype))
-                 exit(1)
-
-        folder = myfile.replace(".SAFE","")
-        datelong = myfile.split("_")[5]
-        acqdate = (myfile.split("_")[5].split("T"))[0]
-        path = os.path.join(wrk,acqdate)
-        if not os.path.exists(path):
-            os.mkdir(path)
-
-        logging.info("Folder is {}".format(folder))
-        logging.info("Long date is {}".format(datelong))
-        logging.info("Acquisition date is {}".format(acqdate))
-
-        os.chdir("{}.SAFE".format(folder))
-
-        if (single_pol == 1):
-            cmd = make_cmd(1,acqdate,path)
-            execute(cmd,uselogging=True)
-            cmd = make_cmd(2,acqdate,path)
-            execute(cmd,uselogging=True)
-            cmd = make_cmd(3,acqdate,path)
-            execute(cmd,uselogging=True)
-        else:
-            cmd = make_cmd(1,acqdate,path,pol=pol)
-            execute(cmd,uselogging=True)
-            cmd = make_cmd(2,acqdate,path,pol=pol)
-            execute(cmd,uselogging=True)
-            cmd = make_cmd(3,acqdate,path,pol=pol)
-            execute(cmd,uselogging=True)
-
-        os.chdir(path)
-
-        logging.info("Getting precision orbit for file {}".format(myfile))
-        try:
-            orbfile,tmp = downloadSentinelOrbitFile(myfile)
-            execute("S1_OPOD_vec {}_001.slc.par *.EOF".format(acqdate))
-            execute("S1_OPOD_vec {}_002.slc.par *.EOF".format(acqdate))
-            execute("S1_OPOD_vec {}_003.slc.par *.EOF".format(acqdate))
-        except Exception as e:
-            print "Error: "+str(e)
-
-        slc = glob.glob("*_00*.slc")
-        slc.sort()
-        par = glob.glob("*_00*.slc.par")
-        par.sort()
-        top = glob.glob("*_00*.tops_par")
-        top.sort()
-        f = open(os.path.join(path,"SLC_TAB"),"w")
-        for i in range(len(slc)):
-            f.write("{} {} {}\n".format(slc[i],par[i],top[i]))
-        f.close()
-
-        #
-        # Make a raster version of swath 3
-        #
-        width = getParameter("{}_003.slc.par".format(acqdate),"range_samples")
-        execute("rasSLC {}_003.slc {} 1 0 50 10".format(acqdate,width))
-        os.chdir(wrk)
+        path = os.path.join(wrk,get_acq_date(myfile))
+        if is_ingested(path):
+            logging.info("Found existing ingest of {} in {}; skipping".format(myfile,path))
+            continue
+        scenes.append((myfile,path))
+    if scenes:
+        ingest_safes(scenes,pol,workers,getOrbitStore(orbit_dir))
 
 
 if __name__ == '__main__':
@@ -129,6 +270,8 @@ if __name__ == '__main__':
       description='Pre-process S1 SLC imagery into gamma format SLCs',
       formatter_class=RawTextHelpFormatter)
     parser.add_argument('pol',nargs='?',default='vv',help='name of polarization to process (default vv)')
+    parser.add_argument('-w','--workers',default=INGEST_WORKERS,type=int,
+                        help='number of swaths to ingest concurrently (default {})'.format(INGEST_WORKERS))
     args = parser.parse_args()
     
     logFile = "par_s1_slc_log.txt"
@@ -137,5 +280,5 @@ if __name__ == '__main__':
     logging.getLogger().addHandler(logging.StreamHandler())
     logging.info("Starting run")
 
-    par_s1_slc(args.pol)    
+    par_s1_slc(args.pol,args.workers)    
 
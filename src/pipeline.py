@@ -0,0 +1,318 @@
+#!/usr/bin/python
+
+import logging
+import os
+import json
+import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from telemetry import execute
+
+# Intermediate files deleted by pipelines run in a directory, with their
+# modification times, kept in this file there
+RELEASED = "pipeline_released.json"
+
+_released_lock = threading.Lock()
+
+#
+# One step of a pipeline: either a shell command (run through execute) or
+# a python callable, with the files it reads and writes
+#
+class Node(object):
+
+    def __init__(self,name,cmd=None,inputs=(),outputs=(),func=None,args=(),kwargs=None,
+                 logfile=None,after=()):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.logfile = logfile
+        self.after = list(after)
+        self.duration = 0.0
+        self.status = "pending"
+
+    def run(self):
+        if self.cmd is not None:
+            if self.logfile is not None:
+                log = open(self.logfile,"w")
+                try:
+                    execute(self.cmd,uselogging=True,logfile=log)
+                finally:
+                    log.close()
+            else:
+                execute(self.cmd,uselogging=True)
+        else:
+            self.func(*self.args,**self.kwargs)
+
+    def __repr__(self):
+        return "Node({})".format(self.name)
+
+class PipelineError(Exception):
+
+    def __init__(self,name,failures,blocked=()):
+        self.failures = failures
+        self.blocked = list(blocked)
+        msg = "{} of pipeline {} failed: ".format(len(failures),name)
+        msg += "; ".join("{} ({})".format(node.name,err) for node,err in failures)
+        if self.blocked:
+            msg += "; {} not run: {}".format(len(self.blocked),", ".join(node.name for node in self.blocked))
+        Exception.__init__(self,msg)
+
+#
+# A set of nodes connected by the files they produce and consume.  Nodes
+# run as soon as everything they depend on is done, up to workers at a
+# time.  Like make, a node is skipped when all of its outputs are newer
+# than all of its inputs and nothing upstream of it was rerun.  Files
+# marked temporary are deleted once every node reading them is done,
+# unless keep is set.  Deleted files are recorded with their modification
+# times and stand in for themselves on later runs, so they don't make the
+# nodes around them look out of date; only when a node that reads one has
+# to run again is the node making it run again too.
+#
+class Pipeline(object):
+
+    def __init__(self,name="pipeline",keep=False):
+        self.name = name
+        self.keep = keep
+        self.nodes = []
+        self.byname = {}
+        self.producers = {}
+        self.temporaries = set()
+
+    def add(self,name,cmd=None,inputs=(),outputs=(),func=None,args=(),kwargs=None,
+            logfile=None,after=()):
+        if name in self.byname:
+            raise ValueError("Duplicate node name {}".format(name))
+        node = Node(name,cmd=cmd,inputs=inputs,outputs=outputs,func=func,args=args,
+                    kwargs=kwargs,logfile=logfile,after=after)
+        for out in node.outputs:
+            if out in self.producers:
+                raise ValueError("{} is produced by both {} and {}".format(
+                                 out,self.producers[out].name,name))
+            self.producers[out] = node
+        self.nodes.append(node)
+        self.byname[name] = node
+        return node
+
+    def temporary(self,names):
+        self.temporaries.update(names)
+
+    def released(self):
+        if not os.path.isfile(RELEASED):
+            return {}
+        f = open(RELEASED,"r")
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+        finally:
+            f.close()
+
+    def _update_released(self,add=(),drop=()):
+        add = list(add)
+        with _released_lock:
+            released = self.released()
+            if not add and not any(f in released for f in drop):
+                return
+            for f,mtime in add:
+                released[f] = mtime
+            for f in drop:
+                released.pop(f,None)
+            tmp = "{}.tmp{}".format(RELEASED,os.getpid())
+            f = open(tmp,"w")
+            json.dump(released,f,indent=2,sort_keys=True)
+            f.close()
+            os.rename(tmp,RELEASED)
+
+    def _release(self,node,selected):
+        if self.keep:
+            return
+        for f in node.inputs:
+            if f not in self.temporaries or not os.path.isfile(f):
+                continue
+            if all(n.status in ("done","skipped") for n in selected if f in n.inputs):
+                mtime = os.path.getmtime(f)
+                os.remove(f)
+                self._update_released(add=[(f,mtime)])
+                logging.info("{}: removed intermediate file {}".format(self.name,f))
+
+    def dependencies(self,node):
+        deps = [self.producers[f] for f in node.inputs if f in self.producers]
+        deps += [self.byname[name] for name in node.after]
+        return list(set(deps))
+
+    #
+    # Nodes needed to build the given target files or node names
+    #
+    def select(self,targets=None):
+        if targets is None:
+            return list(self.nodes)
+        todo = []
+        for target in targets:
+            if target in self.byname:
+                todo.append(self.byname[target])
+            elif target in self.producers:
+                todo.append(self.producers[target])
+            elif not os.path.exists(target):
+                raise ValueError("No node in {} produces {}".format(self.name,target))
+        needed = set()
+        while todo:
+            node = todo.pop()
+            if node not in needed:
+                needed.add(node)
+                todo.extend(self.dependencies(node))
+        return [node for node in self.nodes if node in needed]
+
+    def up_to_date(self,node,released=None):
+        if not node.outputs:
+            return False
+        if released is None:
+            released = self.released()
+        def mtime(f):
+            if os.path.exists(f):
+                return os.path.getmtime(f)
+            return released.get(f)
+        times = [mtime(out) for out in node.outputs]
+        if None in times:
+            return False
+        oldest = min(times)
+        for inp in node.inputs:
+            t = mtime(inp)
+            if t is not None and t > oldest:
+                return False
+        return True
+
+    #
+    # Nodes of selected that have to run: those out of date, and those
+    # making deleted intermediate files that a node which has to run reads
+    #
+    def stale(self,selected,force=False):
+        released = self.released()
+        stale = set(node for node in selected if force or not self.up_to_date(node,released))
+        todo = list(stale)
+        while todo:
+            node = todo.pop()
+            for f in node.inputs:
+                if f in released and not os.path.exists(f) and f in self.producers:
+                    producer = self.producers[f]
+                    if producer in selected and producer not in stale:
+                        stale.add(producer)
+                        todo.append(producer)
+        return stale
+
+    def _worker(self,node,results):
+        start = time.time()
+        try:
+            node.run()
+            err = None
+        except (Exception,SystemExit) as e:
+            err = e
+        results.put((node,err,time.time()-start))
+
+    def _wait(self,results):
+        # Poll so that a KeyboardInterrupt still gets through
+        while True:
+            try:
+                return results.get(True,1.0)
+            except queue.Empty:
+                pass
+
+    def run(self,workers=1,targets=None,force=False):
+        selected = self.select(targets)
+        for node in selected:
+            node.status = "pending"
+            node.duration = 0.0
+        deps = dict((node,[d for d in self.dependencies(node) if d in selected]) for node in selected)
+        stale = self.stale(selected,force)
+        pending = list(selected)
+        running = 0
+        rerun = set()
+        failures = []
+        results = queue.Queue()
+
+        while pending or running:
+            # Start everything whose dependencies are finished
+            progress = False
+            for node in list(pending):
+                if running >= workers:
+                    break
+                states = [d.status for d in deps[node]]
+                if "failed" in states or "blocked" in states:
+                    node.status = "blocked"
+                    pending.remove(node)
+                    progress = True
+                    continue
+                if any(s not in ("done","skipped") for s in states):
+                    continue
+                pending.remove(node)
+                progress = True
+                if node not in stale and not rerun.intersection(deps[node]):
+                    logging.info("{}: {} is up to date".format(self.name,node.name))
+                    node.status = "skipped"
+                    self._release(node,selected)
+                    continue
+                rerun.add(node)
+                node.status = "running"
+                running += 1
+                t = threading.Thread(target=self._worker,args=(node,results))
+                t.daemon = True
+                t.start()
+
+            if not running:
+                if pending and not progress:
+                    raise ValueError("Dependency cycle in {} among {}".format(self.name,pending))
+                continue
+
+            node,err,node.duration = self._wait(results)
+            running -= 1
+            if err is None:
+                node.status = "done"
+                self._update_released(drop=[f for f in node.outputs if os.path.exists(f)])
+                self._release(node,selected)
+            else:
+                node.status = "failed"
+                failures.append((node,err))
+                logging.error("ERROR: {}: {} failed: {}".format(self.name,node.name,err))
+                # Don't leave partial outputs behind to look up to date
+                for out in node.outputs:
+                    if os.path.isfile(out):
+                        os.remove(out)
+
+        self.report(selected,deps)
+        if failures:
+            raise PipelineError(self.name,failures,[n for n in selected if n.status == "blocked"])
+
+    #
+    # Log the chain of nodes that determined the wall time of the run
+    #
+    def report(self,selected,deps):
+        finish = {}
+        prev = {}
+        def finished(node):
+            if node not in finish:
+                best = None
+                for d in deps[node]:
+                    if best is None or finished(d) > finished(best):
+                        best = d
+                prev[node] = best
+                finish[node] = node.duration + (finished(best) if best else 0.0)
+            return finish[node]
+        for node in selected:
+            finished(node)
+        if not finish:
+            return
+        node = max(finish,key=lambda n: finish[n])
+        total = finish[node]
+        path = []
+        while node is not None:
+            path.append("{} ({:.1f}s)".format(node.name,node.duration))
+            node = prev[node]
+        busy = sum(node.duration for node in selected)
+        logging.info("{}: {:.1f}s of work, critical path {:.1f}s: {}".format(
+                     self.name,busy,total," -> ".join(reversed(path))))
@@ -35,7 +35,6 @@
 import logging
 import sys
 import os
-from lxml import etree
 import re
 import math
 import zipfile
@@ -43,25 +42,52 @@ import argparse
 import commands
 import glob
 import shutil
+import time as timer
+import multiprocessing
 from getSubSwath import get_bounding_box_file
-from ifm_sentinel import gammaProcess
-from execute import execute
+from ifm_sentinel import gammaProcess, stagedGammaProcess, getFileType
+from unwrapping_geocoding import GEOCODE_WORKERS
+from tiled_unwrap import UNWRAP_WORKERS
+from sbas_network import sbas_network, readNetwork
+from par_s1_slc import unzip_files, ingest_safes, is_ingested, get_acq_date
+from orbit_store import getOrbitStore, orbitDir
+from gamma_io import par
+from burst_index import getSwath, getBurstIndex
+from staging import place
+from telemetry import execute
 from utm2dem import utm2dem
-from getDemFileGamma import getDemFileGamma
+from getDemFileGamma import getDemFileGamma, DEM_CACHE
 import file_subroutines
 import saa_func_lib as saa
 
+# Default size limit in GB of the master geometry cache
+GEOMETRY_QUOTA = 50.0
+
 #####################
 #
 # Define procedures
 #
 #####################
 
-def makeDirAndLinks(name1,name2,file1,file2,dem):
+def linkIngest(cachedir,acqdate):
+    # Each pair gets a real date directory (burst tabs are written into it)
+    # holding links to the shared, already ingested SLC files
+    if not os.path.exists(acqdate):
+        os.mkdir(acqdate)
+    for myfile in os.listdir(cachedir):
+        link = os.path.join(acqdate,myfile)
+        if not os.path.lexists(link):
+            os.symlink(os.path.join(cachedir,myfile),link)
+
+def makeDirAndLinks(name1,name2,file1,file2,dem,cache=None):
     dirname = '%s_%s' % (name1,name2)
     if not os.path.exists(dirname):
         os.mkdir(dirname)
     os.chdir(dirname)
+    if cache is not None:
+        for myfile in (file1,file2):
+            acqdate = get_acq_date(myfile)
+            linkIngest(os.path.join(cache,acqdate),acqdate)
     if not os.path.exists(file1):
         os.symlink("../%s" % file1,"%s" % file1)
     if not os.path.exists(file2):
@@ -72,6 +98,55 @@ def makeDirAndLinks(name1,name2,file1,file2,dem):
         os.symlink("../%s.par" % dem,"%s.par" % dem)
     os.chdir('..')
 
+def ingestStack(filenames,pol,cache="SLC_CACHE",orbit_dir=None):
+    # Ingest every acquisition once into a shared cache directory so that
+    # pairs only link to the gamma SLCs instead of rebuilding them
+    wrk = os.getcwd()
+    cache = os.path.join(wrk,cache,pol)
+    unzip_files(pol)
+    scenes = []
+    for myfile in filenames:
+        safe = myfile.replace(".zip",".SAFE")
+        path = os.path.join(cache,get_acq_date(safe))
+        if is_ingested(path):
+            logging.info("Using cached ingest of {} in {}".format(safe,path))
+            continue
+        logging.info("Ingesting {} into {}".format(safe,path))
+        scenes.append((safe,path))
+    if scenes:
+        ingest_safes(scenes,pol,orbits=getOrbitStore(orbit_dir))
+    return(cache)
+
+def selectPairs(filenames,filedates,proc_all=None,sbas=None,network=None):
+    length = len(filenames)
+    pairs = []
+    if network is None and sbas is not None:
+        # Plan a small baseline network from the annotation orbits
+        unzip_files(annotation_only=True)
+        network = sbas_network([os.path.basename(x).replace(".zip",".SAFE") for x in filenames],
+                               **sbas)
+    if network is not None:
+        # Pairs listed by date in a (previously planned) network file
+        for master,slave in readNetwork(network):
+            if master not in filedates or slave not in filedates:
+                logging.warning("WARNING: Skipping network pair {} {}; no such files".format(master,slave))
+                continue
+            pairs.append((filedates.index(master),filedates.index(slave)))
+    elif not proc_all:
+        # Pairs and 2nd pairs, plus the last pair
+        for x in xrange(length-2):
+            pairs.append((x,x+1))
+            pairs.append((x,x+2))
+        if length > 1:
+            pairs.append((length-2,length-1))
+    else:
+        # ALL possible pairs
+        for i in xrange(length):
+            for j in xrange(i+1,length):
+                pairs.append((i,j))
+    logging.info("Selected {} pairs".format(len(pairs)))
+    return(pairs)
+
 def makeParameterFile(mydir,alooks,rlooks,dem_source):
     res = 20 * int(alooks)        
     
@@ -90,29 +165,15 @@ def makeParameterFile(mydir,alooks,rlooks,dem_source):
             baseline = float(s[1])
     f.close
 
-    back = os.getcwd()
-    os.chdir(os.path.join(master_file,"annotation"))
-    for myfile in os.listdir("."):
-        if "001.xml" in myfile:
-            root = etree.parse(myfile)
-            for coord in root.iter('productFirstLineUtcTime'):
-                utc = coord.text
-                logging.info("Found utc time {}".format(utc))
+    utc = getSwath(master_file,"iw1")["first_line_utc"]
+    logging.info("Found utc time {}".format(utc))
     t = utc.split("T")
     logging.info("{}".format(t))
     s = t[1].split(":")
     logging.info("{}".format(s))
     utctime = ((int(s[0])*60+int(s[1]))*60)+float(s[2])
-    os.chdir(back) 
  
-    name = "IFM/" + master_date[:8] + ".mli.par"
-    f = open(name,"r")
-    for line in f:
-        if "heading" in line:
-            t = re.split(":",line)
-            s = re.split("\s+",t[1])
-            heading = float(s[1])
-    f.close
+    heading = par("IFM/" + master_date[:8] + ".mli.par").float("heading")
     
     master_file = master_file.replace(".SAFE","")
     slave_file = slave_file.replace(".SAFE","")
@@ -141,6 +202,107 @@ def makeParameterFile(mydir,alooks,rlooks,dem_source):
     os.chdir("..")  
     
 
+def getPairFiles(mydir):
+    master = mydir.split("_")[0]
+    slave = mydir.split("_")[1]
+    for myfile in glob.glob("*.SAFE"):
+        if master in myfile: 
+            masterFile = myfile
+        if slave in myfile:
+            slaveFile = myfile
+    return(masterFile,slaveFile)
+
+def processPair(mydir,dem,dem_source,alooks,rlooks,inc_flag,look_flag,los_flag,time,resume=False,
+                geocode_workers=1,geometry_cache=None,cache_quota=None,keep_intermediates=False,
+                scratch=None,tiled_unwrap=0,enu_flag=False,orbit_dir=None):
+    logging.info("Processing directory %s" % mydir)
+    os.chdir(mydir)
+    masterFile,slaveFile = getPairFiles(mydir)
+    kwargs = dict(dem=dem,dem_source=dem_source,rlooks=rlooks,
+                  alooks=alooks,inc_flag=inc_flag,look_flag=look_flag,los_flag=los_flag,
+                  time=time,resume=resume,geocode_workers=geocode_workers,
+                  geometry_cache=geometry_cache,cache_quota=cache_quota,
+                  keep_intermediates=keep_intermediates,tiled_unwrap=tiled_unwrap,
+                  enu_flag=enu_flag,orbit_dir=orbit_dir)
+    if scratch is not None:
+        stagedGammaProcess(scratch,masterFile,slaveFile,"IFM",
+                           finish=lambda: makeParameterFile(mydir,alooks,rlooks,dem_source),**kwargs)
+    else:
+        gammaProcess(masterFile,slaveFile,"IFM",**kwargs)
+        makeParameterFile(mydir,alooks,rlooks,dem_source)
+    os.chdir("..")
+
+def setupWorkerLog(mydir):
+    # Each worker gets its own log file so pair logs don't interleave
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    fmt = '%(asctime)s - {} - %(levelname)s - %(message)s'.format(mydir)
+    handler = logging.FileHandler("{}_log.txt".format(mydir))
+    handler.setFormatter(logging.Formatter(fmt,datefmt='%m/%d/%Y %I:%M:%S %p'))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+def processPairWorker(args):
+    # Runs in a child process: the os.chdir calls made by gammaProcess,
+    # par_s1_slc and getBursts only change this process's working directory
+    wrk,mydir = args[0],args[1]
+    os.chdir(wrk)
+    setupWorkerLog(mydir)
+    start = timer.time()
+    try:
+        processPair(mydir,*args[2:])
+    except (Exception,SystemExit) as e:
+        logging.exception("ERROR: Processing of {} failed".format(mydir))
+        return(mydir,False,"{}: {}".format(type(e).__name__,e),timer.time()-start)
+    return(mydir,True,None,timer.time()-start)
+
+def collectProducts(mydir):
+    for myfile in glob.glob("{}/PRODUCT/*".format(mydir)):
+        place(myfile,"PRODUCTS/{}".format(os.path.basename(myfile)),move=True)
+
+def processPairsParallel(dirs,workers,dem,dem_source,alooks,rlooks,inc_flag,look_flag,los_flag,time,
+                         resume=False,geocode_workers=1,geometry_cache=None,cache_quota=None,
+                         keep_intermediates=False,scratch=None,tiled_unwrap=0,enu_flag=False,
+                         orbit_dir=None):
+    wrk = os.getcwd()
+    jobs = [(wrk,mydir,dem,dem_source,alooks,rlooks,inc_flag,look_flag,los_flag,time,resume,geocode_workers,
+             geometry_cache,cache_quota,keep_intermediates,scratch,tiled_unwrap,enu_flag,orbit_dir)
+            for mydir in dirs]
+    total = len(jobs)
+    logging.info("Processing {} pairs using {} workers".format(total,workers))
+
+    # One process per pair so that no state leaks between gammaProcess runs
+    pool = multiprocessing.Pool(processes=workers,maxtasksperchild=1)
+    done = 0
+    failed = []
+    try:
+        # Products are collected here in the parent as each pair finishes, 
+        # so only one process ever writes into PRODUCTS
+        for mydir,ok,msg,elapsed in pool.imap_unordered(processPairWorker,jobs):
+            done += 1
+            if ok:
+                collectProducts(mydir)
+                if not keep_intermediates:
+                    shutil.rmtree(mydir,ignore_errors=True)
+                logging.info("Finished pair {} in {:.1f} minutes".format(mydir,elapsed/60.0))
+            else:
+                failed.append(mydir)
+                logging.error("Pair {} failed after {:.1f} minutes ({}); see {}_log.txt".format(
+                              mydir,elapsed/60.0,msg,mydir))
+            logging.info("Stack progress: {} of {} pairs done, {} failed".format(done,total,len(failed)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    logging.info("Stack summary: {} pairs succeeded, {} failed".format(total-len(failed),len(failed)))
+    for mydir in failed:
+        logging.info("    failed: {}".format(mydir))
+    return(failed)
+
 ###########################################################################
 #  Main entry point --
 #
@@ -149,11 +311,39 @@ def makeParameterFile(mydir,alooks,rlooks,dem_source):
 #       file = name of CSV file use to for get_asf.py
 #       dem = name of external DEM file 
 #       use_opentopo = flag for using opentopo instead of get_dem
+#       workers = number of pairs to process concurrently
+#       cache = ingest each acquisition once and share it between pairs
+#       sbas = dict of sbas_network thresholds; plan a small baseline network
+#       network = file of pairs to process, as written by sbas_network
+#       resume = skip the stages completed by a previous run of a pair
+#       geocode_workers = number of layers each pair geocodes concurrently
+#       cache_quota = size limit in GB of the master geometry cache
+#       dem_cache = directory in which to keep DEMs between runs
+#       keep_intermediates = keep the intermediate files and directory of every pair
+#       scratch = process every pair under this (node local) directory
+#       tiled_unwrap = unwrap in automatically sized patches, this many at a
+#                      time over all of the pairs run concurrently (0 = off)
+#       enu_flag = also make east, north and up displacement files
+#       orbit_dir = directory of orbit files shared by every pair
 #
 ###########################################################################
 def procS1StackGAMMA(alooks=4,rlooks=20,csvFile=None,dem=None,use_opentopo=None,
                      inc_flag=None,look_flag=None,los_flag=None,proc_all=None,
-                     time=None,mask=False):
+                     time=None,mask=False,workers=1,cache=True,sbas=None,network=None,
+                     resume=False,geocode_workers=GEOCODE_WORKERS,cache_quota=GEOMETRY_QUOTA,
+                     dem_cache=DEM_CACHE,keep_intermediates=False,scratch=None,tiled_unwrap=0,
+                     enu_flag=False,orbit_dir=None):
+
+    # Pairs change directory before using it
+    if scratch is not None:
+        scratch = os.path.abspath(scratch)
+
+    # Every pair uses the same orbit store, whichever directory it runs in
+    orbit_dir = os.path.abspath(orbit_dir) if orbit_dir is not None else orbitDir()
+
+    # Pairs run at once share the unwrapping processors
+    if tiled_unwrap and workers > 1:
+        tiled_unwrap = max(1,tiled_unwrap//workers)
 
     # If file list is given, download the files
     if csvFile is not None:
@@ -164,58 +354,72 @@ def procS1StackGAMMA(alooks=4,rlooks=20,csvFile=None,dem=None,use_opentopo=None,
     logging.info("{}".format(filenames))
     logging.info("{}".format(filedates))
 
+    # Pick the pairs before any processing starts
+    pairs = selectPairs(filenames,filedates,proc_all,sbas,network)
+
     # If no DEM is given, determine one from first file
     if dem is None:
-        dem, dem_source = getDemFileGamma(filenames[0],use_opentopo,alooks,mask)
+        dem, dem_source = getDemFileGamma(filenames[0],use_opentopo,alooks,mask,cache_dir=dem_cache)
     else: 
         dem_source = "UNKNOWN"
 
     length=len(filenames)
 
-    if not proc_all:
-         # Make directory and link files for pairs and 2nd pairs
-         for x in xrange(length-2):
-             makeDirAndLinks(filedates[x],filedates[x+1],filenames[x],filenames[x+1],dem)
-             makeDirAndLinks(filedates[x],filedates[x+2],filenames[x],filenames[x+2],dem)
-    else:
-         # Make directory and link files for ALL possible pairs
-         for i in xrange(length):
-             for j in xrange(i+1,length):
-                 makeDirAndLinks(filedates[i],filedates[j],filenames[i],filenames[j],dem)
+    # Build the gamma SLCs once per acquisition date
+    slc_cache = None
+    if cache and length > 1:
+        type, pol = getFileType(filenames[0])
+        slc_cache = ingestStack(filenames,pol,orbit_dir=orbit_dir)
+
+    # Pairs with the same master share its geometry products
+    geometry_cache = None
+    if cache:
+        geometry_cache = os.path.join(os.getcwd(),"GEOMETRY_CACHE")
+
+    # Index the bursts of every granule once for all of the pairs
+    for myfile in filenames:
+        safe = myfile.replace(".zip",".SAFE")
+        if os.path.isdir(safe):
+            getBurstIndex(safe)
+
+    # Make directory and link files for every selected pair
+    for i,j in pairs:
+        makeDirAndLinks(filedates[i],filedates[j],filenames[i],filenames[j],dem,slc_cache)
             
     # If we have anything to process
     if (length > 1) :
-        if not proc_all:
-            # Make directory and link files for last pair
-            makeDirAndLinks(filedates[length-2],filedates[length-1],filenames[length-2],filenames[length-1],dem)
-
         # Run through directories processing ifgs as we go
         if not os.path.exists("PRODUCTS"):
             os.mkdir("PRODUCTS")
-        first = 1
-        dirs = os.listdir(".")
-        dirs.sort
-        for mydir in dirs:
-            if len(mydir) == 31 and os.path.isdir(mydir) and "_20" in mydir:
-                logging.info("Processing directory %s" % mydir)
-                os.chdir(mydir)
-                master = mydir.split("_")[0]
-                slave = mydir.split("_")[1]
-                for myfile in glob.glob("*.SAFE"):
-                    if master in myfile: 
-                        masterFile = myfile
-                    if slave in myfile:
-                        slaveFile = myfile
-                gammaProcess(masterFile,slaveFile,"IFM",dem=dem,dem_source=dem_source,rlooks=rlooks,
-                             alooks=alooks,inc_flag=inc_flag,look_flag=look_flag,los_flag=los_flag,
-                             time=time)
-                makeParameterFile(mydir,alooks,rlooks,dem_source)
-                os.chdir("..")
-                for myfile in glob.glob("{}/PRODUCT/*".format(mydir)):
-                    shutil.move(myfile,"PRODUCTS/{}".format(os.path.basename(myfile)))
-                if not first:
+        dirs = [mydir for mydir in sorted(os.listdir(".")) 
+                if len(mydir) == 31 and os.path.isdir(mydir) and "_20" in mydir]
+
+        if workers > 1:
+            failed = processPairsParallel(dirs,workers,dem,dem_source,alooks,rlooks,
+                                          inc_flag,look_flag,los_flag,time,resume,geocode_workers,
+                                          geometry_cache,cache_quota,keep_intermediates,scratch,tiled_unwrap,
+                                          enu_flag,orbit_dir)
+            if failed:
+                logging.error("ERROR: {} of {} pairs failed".format(len(failed),len(dirs)))
+                exit(1)
+        else:
+            for mydir in dirs:
+                processPair(mydir,dem,dem_source,alooks,rlooks,inc_flag,look_flag,los_flag,time,resume,
+                            geocode_workers,geometry_cache,cache_quota,keep_intermediates,scratch,tiled_unwrap,
+                            enu_flag,orbit_dir)
+                collectProducts(mydir)
+                if not keep_intermediates:
                     shutil.rmtree(mydir,ignore_errors=True)
-                first = 0
+
+        # Pair directories only hold links into the cache, so it can go once
+        # every pair has been processed and removed; kept pair directories
+        # still link to it
+        if slc_cache is not None:
+            if keep_intermediates:
+                logging.info("Keeping {} for the links in the kept pair directories".format(
+                             os.path.dirname(slc_cache)))
+            else:
+                shutil.rmtree(os.path.dirname(slc_cache),ignore_errors=True)
 
 ###########################################################################
 
@@ -228,12 +432,32 @@ if __name__ == '__main__':
   parser.add_argument("-i",action="store_true",help="Create incidence angle file")
   parser.add_argument("-l",action="store_true",help="Create look vector theta and phi files")
   parser.add_argument("-s",action="store_true",help="Create line of sight displacement file")
+  parser.add_argument("-e","--enu",action="store_true",help="Create east, north and up displacement files")
   parser.add_argument("-o",action="store_true",help="Use opentopo to get the DEM file instead of get_dem")
   parser.add_argument("-r","--rlooks",default=20,help="Number of range looks (def=20)")
   parser.add_argument("-a","--alooks",default=4,help="Number of azimuth looks (def=4)")
   parser.add_argument("-p",action="store_true",help="Process ALL possible pairs")
   parser.add_argument("-t",nargs=4,metavar=("t1","t2","t3","length"),help="Start times and number of selected bursts to process")
   parser.add_argument("-m","--mask",action="store_true",help="Apply water body mask to DEM file prior to processing")
+  parser.add_argument("-w","--workers",default=1,type=int,help="Number of pairs to process concurrently (def=1)")
+  parser.add_argument("-n","--network",help="Process the pairs listed in this network file")
+  parser.add_argument("--sbas",action="store_true",help="Plan a small baseline pair network (written to sbas_network.txt)")
+  parser.add_argument("--max-btemp",default=48.0,type=float,help="SBAS maximum temporal baseline in days (def=48)")
+  parser.add_argument("--max-bperp",default=150.0,type=float,help="SBAS maximum perpendicular baseline in meters (def=150)")
+  parser.add_argument("--max-pairs",default=4,type=int,help="SBAS maximum number of pairs per date (def=4)")
+  parser.add_argument("--resume",action="store_true",help="Resume pairs left over by a previous run")
+  parser.add_argument("-g","--geocode-workers",default=GEOCODE_WORKERS,type=int,
+    help="Number of layers each pair geocodes concurrently (def={})".format(GEOCODE_WORKERS))
+  parser.add_argument("--no-cache",action="store_true",help="Ingest the SLCs separately in every pair directory instead of once per date")
+  parser.add_argument("--cache-quota",default=GEOMETRY_QUOTA,type=float,
+    help="Size limit in GB of the master geometry cache kept in GEOMETRY_CACHE (def={})".format(GEOMETRY_QUOTA))
+  parser.add_argument("--dem-cache",default=DEM_CACHE,help="Directory in which to keep DEMs between runs (def=$DEM_CACHE)")
+  parser.add_argument("--keep-intermediates",action="store_true",
+    help="Keep the intermediate files and directory of every pair instead of deleting them once no later stage needs them")
+  parser.add_argument("--tiled-unwrap",nargs="?",const=UNWRAP_WORKERS,default=0,type=int,metavar="N",
+    help="Unwrap in patches sized from the scene and memory, N at a time over all pairs (def N={})".format(UNWRAP_WORKERS))
+  parser.add_argument("--scratch",help="Process each pair in a new directory under this one (e.g. node local disk)")
+  parser.add_argument("--orbit-dir",help="Directory of orbit files shared by every pair (def=$ORBIT_DIR or ORBITS)")
   args = parser.parse_args()
 
   logFile = "procS1StackGAMMA_{}_log.txt".format(os.getpid())
@@ -242,6 +466,14 @@ if __name__ == '__main__':
   logging.getLogger().addHandler(logging.StreamHandler())
   logging.info("Starting run")
 
+  sbas = None
+  if args.sbas:
+      sbas = {"max_btemp": args.max_btemp, "max_bperp": args.max_bperp, "max_pairs": args.max_pairs}
+
   procS1StackGAMMA(alooks=args.alooks,rlooks=args.rlooks,csvFile=args.file,dem=args.dem,use_opentopo=args.o,
-                   inc_flag=args.i,look_flag=args.l,los_flag=args.s,proc_all=args.p,time=args.t,mask=args.mask)
+                   inc_flag=args.i,look_flag=args.l,los_flag=args.s,proc_all=args.p,time=args.t,mask=args.mask,
+                   workers=args.workers,cache=not args.no_cache,sbas=sbas,network=args.network,
+                   resume=args.resume,geocode_workers=args.geocode_workers,cache_quota=args.cache_quota,
+                   dem_cache=args.dem_cache,keep_intermediates=args.keep_intermediates,scratch=args.scratch,
+                   tiled_unwrap=args.tiled_unwrap,enu_flag=args.enu,orbit_dir=args.orbit_dir)
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+###############################################################################
+# sbas_network.py
+#
+# Project:  ADP INSAR
+# Purpose:  Plan a small baseline (SBAS) pair network for a Sentinel-1 stack
+#           from the orbit state vectors in the SAFE annotation files
+#
+###############################################################################
+# Copyright (c) 2018, Alaska Satellite Facility
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Library General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+###############################################################################
+
+import logging
+import argparse
+import os
+import glob
+import datetime
+import numpy as np
+from lxml import etree
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+
+def parseTime(utc):
+    return datetime.datetime.strptime(utc[:26],"%Y-%m-%dT%H:%M:%S.%f")
+
+def llhToXyz(lat,lon,hgt):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    n = WGS84_A / np.sqrt(1.0 - WGS84_E2 * np.sin(lat)**2)
+    return np.array([(n + hgt) * np.cos(lat) * np.cos(lon),
+                     (n + hgt) * np.cos(lat) * np.sin(lon),
+                     (n * (1.0 - WGS84_E2) + hgt) * np.sin(lat)])
+
+#
+# Read the acquisition time, orbit state vectors and scene center from the
+# annotation file of the middle swath of a SAFE directory
+#
+def readAnnotation(safe):
+    xmls = glob.glob(os.path.join(safe,"annotation","s1*-iw2-*.xml"))
+    if not xmls:
+        xmls = glob.glob(os.path.join(safe,"annotation","s1*.xml"))
+    if not xmls:
+        logging.error("ERROR: No annotation files found in {}".format(safe))
+        exit(1)
+    root = etree.parse(sorted(xmls)[0])
+
+    start = parseTime(root.find(".//adsHeader/startTime").text)
+    stop = parseTime(root.find(".//adsHeader/stopTime").text)
+    mid = start + (stop - start) / 2
+
+    times = []
+    pos = []
+    vel = []
+    for orbit in root.iter("orbit"):
+        times.append((parseTime(orbit.find("time").text) - mid).total_seconds())
+        p = orbit.find("position")
+        v = orbit.find("velocity")
+        pos.append([float(p.find(c).text) for c in ("x","y","z")])
+        vel.append([float(v.find(c).text) for c in ("x","y","z")])
+
+    points = [(float(pt.find("latitude").text),float(pt.find("longitude").text),
+               float(pt.find("height").text)) for pt in root.iter("geolocationGridPoint")]
+    lat,lon,hgt = np.mean(np.array(points),axis=0)
+
+    return {"time": mid, "orbit_time": np.array(times), "position": np.array(pos),
+            "velocity": np.array(vel), "center": llhToXyz(lat,lon,hgt)}
+
+#
+# Interpolate the orbit at time t (seconds from scene center) by fitting a
+# polynomial through the nearest state vectors
+#
+def orbitAt(ann,t,npts=8,deg=5):
+    idx = np.argsort(np.abs(ann["orbit_time"] - t))[:npts]
+    tt = ann["orbit_time"][idx]
+    deg = min(deg,len(idx)-1)
+    pos = np.array([np.polyval(np.polyfit(tt,ann["position"][idx,k],deg),t) for k in range(3)])
+    vel = np.array([np.polyval(np.polyfit(tt,ann["velocity"][idx,k],deg),t) for k in range(3)])
+    return pos,vel
+
+#
+# Find the zero Doppler position of the satellite for a ground target
+#
+def zeroDopplerPosition(ann,target):
+    t = 0.0
+    for i in range(20):
+        pos,vel = orbitAt(ann,t)
+        dt = np.dot(target - pos,vel) / np.dot(vel,vel)
+        t += dt
+        if abs(dt) < 1.0e-6:
+            break
+    return orbitAt(ann,t)
+
+#
+# Estimate the perpendicular baseline of every acquisition relative to the
+# first one.  Pair baselines are then differences of these values.
+#
+def estimateBaselines(safes):
+    anns = [readAnnotation(safe) for safe in safes]
+    target = anns[0]["center"]
+    ref,refvel = zeroDopplerPosition(anns[0],target)
+    look = (target - ref) / np.linalg.norm(target - ref)
+    along = refvel / np.linalg.norm(refvel)
+    perp = np.cross(along,look)
+    perp /= np.linalg.norm(perp)
+
+    bperp = []
+    for ann in anns:
+        pos,vel = zeroDopplerPosition(ann,target)
+        bperp.append(float(np.dot(pos - ref,perp)))
+    times = [ann["time"] for ann in anns]
+    return times,bperp
+
+class UnionFind(object):
+    def __init__(self,n):
+        self.parent = list(range(n))
+
+    def find(self,i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self,i,j):
+        ri,rj = self.find(i),self.find(j)
+        if ri == rj:
+            return False
+        self.parent[rj] = ri
+        return True
+
+#
+# Choose a connected small baseline network.  Candidate pairs within the
+# thresholds are taken cheapest first until each date reaches max_pairs
+# connections; pairs are then added across components (ignoring thresholds)
+# until the network is connected.
+#
+def planNetwork(times,bperp,max_btemp=48.0,max_bperp=150.0,max_pairs=4):
+    n = len(times)
+    pairs = []
+    for i in range(n):
+        for j in range(i+1,n):
+            btemp = abs((times[j] - times[i]).total_seconds()) / 86400.0
+            bp = bperp[j] - bperp[i]
+            cost = (btemp / max_btemp)**2 + (bp / max_bperp)**2
+            pairs.append((cost,i,j,btemp,bp))
+    pairs.sort()
+
+    degree = [0] * n
+    uf = UnionFind(n)
+    chosen = []
+    for cost,i,j,btemp,bp in pairs:
+        if btemp > max_btemp or abs(bp) > max_bperp:
+            continue
+        if degree[i] >= max_pairs or degree[j] >= max_pairs:
+            continue
+        chosen.append((i,j,btemp,bp))
+        degree[i] += 1
+        degree[j] += 1
+        uf.union(i,j)
+
+    for cost,i,j,btemp,bp in pairs:
+        if uf.union(i,j):
+            logging.warning("WARNING: Adding pair {} {} (btemp {:.0f} days, bperp {:.1f} m) "
+                            "outside the thresholds to connect the network".format(
+                            times[i].strftime("%Y%m%d"),times[j].strftime("%Y%m%d"),btemp,bp))
+            chosen.append((i,j,btemp,bp))
+
+    chosen.sort()
+    return chosen
+
+def writeNetwork(netfile,names,chosen):
+    f = open(netfile,"w")
+    f.write("# master slave btemp(days) bperp(m)\n")
+    for i,j,btemp,bp in chosen:
+        f.write("{} {} {:.0f} {:.1f}\n".format(names[i],names[j],btemp,bp))
+    f.close()
+    logging.info("Wrote {} pairs to {}".format(len(chosen),netfile))
+
+def readNetwork(netfile):
+    pairs = []
+    f = open(netfile,"r")
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            t = line.split()
+            pairs.append((t[0],t[1]))
+    f.close()
+    return pairs
+
+def sbas_network(safes,netfile="sbas_network.txt",max_btemp=48.0,max_bperp=150.0,max_pairs=4):
+    safes = sorted(safes,key=lambda x: x[17:32])
+    times,bperp = estimateBaselines(safes)
+    for safe,bp in zip(safes,bperp):
+        logging.info("{} perpendicular baseline {:.1f} m".format(safe[17:32],bp))
+    chosen = planNetwork(times,bperp,max_btemp=max_btemp,max_bperp=max_bperp,max_pairs=max_pairs)
+    writeNetwork(netfile,[safe[17:32] for safe in safes],chosen)
+    return netfile
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='sbas_network.py',
+    description='Plan a small baseline pair network for the SAFE files in the current directory')
+  parser.add_argument("-o","--output",default="sbas_network.txt",help="Output network file (def=sbas_network.txt)")
+  parser.add_argument("--max-btemp",default=48.0,type=float,help="Maximum temporal baseline in days (def=48)")
+  parser.add_argument("--max-bperp",default=150.0,type=float,help="Maximum perpendicular baseline in meters (def=150)")
+  parser.add_argument("--max-pairs",default=4,type=int,help="Maximum number of pairs per date (def=4)")
+  args = parser.parse_args()
+
+  logFile = "sbas_network_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  sbas_network(glob.glob("*.SAFE"),netfile=args.output,max_btemp=args.max_btemp,
+               max_bperp=args.max_bperp,max_pairs=args.max_pairs)
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+import logging
+import os
+import shutil
+import threading
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Number of files copied at once when staging inputs
+STAGE_WORKERS = min(8,multiprocessing.cpu_count())
+
+def same_filesystem(src,dstdir):
+    return os.stat(src).st_dev == os.stat(dstdir).st_dev
+
+#
+# Put the file src at dst: renamed (move) or hard linked when both are on
+# the same file system, otherwise copied under a temporary name and renamed
+# so that dst never holds a partial file
+#
+def place(src,dst,move=False):
+    dstdir = os.path.dirname(os.path.abspath(dst))
+    if not os.path.isdir(dstdir):
+        try:
+            os.makedirs(dstdir)
+        except OSError:
+            if not os.path.isdir(dstdir):
+                raise
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if same_filesystem(src,dstdir):
+        if move:
+            os.rename(src,dst)
+            return
+        try:
+            os.link(src,dst)
+            return
+        except OSError:
+            pass
+    tmp = "{}.part{}".format(dst,os.getpid())
+    shutil.copyfile(src,tmp)
+    shutil.copymode(src,tmp)
+    os.rename(tmp,dst)
+    if move:
+        os.remove(src)
+
+#
+# The (source, destination) pairs of the files under name (a file or a
+# directory, links followed), with the destinations under dest
+#
+def _files(name,dest,skip=None):
+    pairs = []
+    if os.path.isdir(name):
+        for dirpath,dirnames,filenames in os.walk(name,followlinks=True):
+            for f in filenames:
+                src = os.path.join(dirpath,f)
+                if skip is None or not skip(src):
+                    pairs.append((src,os.path.join(dest,src)))
+    elif os.path.isfile(name):
+        pairs.append((name,os.path.join(dest,name)))
+    return pairs
+
+#
+# True if dst already holds a complete copy of src, as left by an earlier
+# staging into the same directory
+#
+def _staged(src,dst):
+    if not os.path.isfile(dst):
+        return False
+    s = os.stat(src)
+    d = os.stat(dst)
+    return s.st_size == d.st_size and d.st_mtime >= s.st_mtime
+
+#
+# Stage files and directories (relative to the current directory) into
+# dest.  Those in copies are copied by workers threads at once; those in
+# links are mirrored as links to the real files, for inputs that are only
+# read once.  skip(path) leaves out files that are not needed.  Files
+# already staged into dest are left alone, so that the checkpoints of a
+# resumed run there still match them.
+#
+def stage_in(copies,dest,workers=STAGE_WORKERS,links=(),skip=None):
+    for name in links:
+        for src,dst in _files(name,dest,skip):
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if not os.path.lexists(dst):
+                os.symlink(os.path.realpath(src),dst)
+
+    pairs = []
+    for name in copies:
+        pairs += [(src,dst) for src,dst in _files(name,dest,skip) if not _staged(src,dst)]
+    if not pairs:
+        return
+    total = sum(os.path.getsize(src) for src,dst in pairs)
+    logging.info("Staging {} files ({:.1f} MB) into {}".format(len(pairs),total/1024.0**2,dest))
+
+    # Largest first, dealt out so each thread gets a similar amount of data
+    pairs.sort(key=lambda x: os.path.getsize(x[0]),reverse=True)
+    workers = max(1,min(workers,len(pairs)))
+    errors = []
+    def work(part):
+        try:
+            for src,dst in part:
+                place(src,dst)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work,args=(pairs[i::workers],)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        logging.error("ERROR: Unable to stage inputs into {}: {}".format(dest,errors[0]))
+        exit(1)
+
+#
+# Copies files from a scratch directory to the same place under a
+# persistent directory in the background, while processing goes on
+#
+class Publisher(object):
+
+    def __init__(self,src,dest):
+        self.src = os.path.abspath(src)
+        self.dest = os.path.abspath(dest)
+        self.published = {}
+        self.errors = []
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            src,dst = item
+            try:
+                place(src,dst)
+                logging.info("Published {}".format(dst))
+            except Exception as e:
+                logging.error("ERROR: Unable to publish {} to {}: {}".format(src,dst,e))
+                self.errors.append((src,e))
+
+    #
+    # Queue a finished file (a path under the scratch directory, or relative
+    # to the current directory inside it) for publishing
+    #
+    def publish(self,name):
+        src = os.path.abspath(name)
+        rel = os.path.relpath(src,self.src)
+        stamp = os.path.getmtime(src)
+        if self.published.get(rel) == stamp:
+            return
+        self.published[rel] = stamp
+        self.queue.put((src,os.path.join(self.dest,rel)))
+
+    #
+    # Queue every file in directory not yet published as it is now
+    #
+    def sync(self,directory):
+        for dirpath,dirnames,filenames in os.walk(directory):
+            for f in filenames:
+                self.publish(os.path.join(dirpath,f))
+
+    #
+    # Wait for everything queued to be published; returns the failures
+    #
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        return self.errors
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import os
+import json
+import time
+import resource
+import threading
+from execute import execute as _execute
+
+#
+# Timing and resource records of the commands run through execute, one JSON
+# object per line.  Records go to the file given to start() (or named by
+# $TELEMETRY_LOG) under the stage last given to set_stage().
+#
+# Child CPU times, block counts and peak RSS come from RUSAGE_CHILDREN, which
+# covers every child that has finished; for commands run at the same time
+# the deltas overlap, so each record counts the commands running alongside
+# it in "concurrent".  RUSAGE_CHILDREN only gives the largest RSS of any
+# child so far, not that of the command itself, so it is recorded as
+# "peak_rss_kb" and reported once for the whole run rather than per command.
+#
+_state = {"path": os.environ.get("TELEMETRY_LOG"), "stage": None, "running": 0}
+_lock = threading.Lock()
+
+def start(path):
+    _state["path"] = os.path.abspath(path)
+
+def set_stage(stage):
+    _state["stage"] = stage
+
+def _write(rec):
+    if _state["path"] is None:
+        return
+    line = json.dumps(rec,sort_keys=True) + "\n"
+    with _lock:
+        f = open(_state["path"],"a")
+        f.write(line)
+        f.close()
+
+#
+# Run cmd as hyp3lib's execute does, and record it
+#
+def execute(cmd,*args,**kwargs):
+    with _lock:
+        _state["running"] += 1
+        concurrent = _state["running"] - 1
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.time()
+    status = "failed"
+    try:
+        result = _execute(cmd,*args,**kwargs)
+        status = "ok"
+        return result
+    finally:
+        wall = time.time() - t0
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with _lock:
+            concurrent = max(concurrent,_state["running"] - 1)
+            _state["running"] -= 1
+        _write({"time": t0,
+                "stage": _state["stage"],
+                "command": cmd.split()[0] if cmd.split() else cmd,
+                "cmd": cmd,
+                "cwd": os.getcwd(),
+                "wall": round(wall,3),
+                "user": round(after.ru_utime - before.ru_utime,3),
+                "sys": round(after.ru_stime - before.ru_stime,3),
+                "peak_rss_kb": after.ru_maxrss,
+                "read_bytes": (after.ru_inblock - before.ru_inblock) * 512,
+                "write_bytes": (after.ru_oublock - before.ru_oublock) * 512,
+                "concurrent": concurrent,
+                "status": status})
+
+def read_records(path):
+    records = []
+    f = open(path,"r")
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning("WARNING: Skipping bad telemetry line in {}".format(path))
+    f.close()
+    return records
+
+#
+# Totals per stage and command, most wall time first
+#
+def summarize(records):
+    rows = {}
+    for rec in records:
+        key = (rec.get("stage") or "-",rec["command"])
+        row = rows.setdefault(key,{"stage": key[0], "command": key[1], "calls": 0, "wall": 0.0,
+                                   "cpu": 0.0, "read_bytes": 0, "write_bytes": 0,
+                                   "failed": 0})
+        row["calls"] += 1
+        row["wall"] += rec["wall"]
+        row["cpu"] += rec["user"] + rec["sys"]
+        row["read_bytes"] += rec["read_bytes"]
+        row["write_bytes"] += rec["write_bytes"]
+        if rec["status"] != "ok":
+            row["failed"] += 1
+    return sorted(rows.values(),key=lambda r: -r["wall"])
+
+def summary(path=None):
+    path = path or _state["path"]
+    if path is None or not os.path.isfile(path):
+        return []
+    records = read_records(path)
+    rows = summarize(records)
+    total = sum(r["wall"] for r in rows)
+    mb = 1024.0 * 1024.0
+    logging.info("Command summary from {}:".format(path))
+    logging.info("{:<20} {:<22} {:>5} {:>9} {:>6} {:>9} {:>9} {:>9}".format(
+                 "stage","command","calls","wall(s)","%","cpu(s)","read(MB)","write(MB)"))
+    for r in rows:
+        logging.info("{:<20} {:<22} {:>5} {:>9.1f} {:>6.1f} {:>9.1f} {:>9.1f} {:>9.1f}{}".format(
+                     r["stage"][:20],r["command"][:22],r["calls"],r["wall"],
+                     100.0 * r["wall"] / total if total else 0.0,r["cpu"],
+                     r["read_bytes"] / mb,r["write_bytes"] / mb,
+                     " ({} failed)".format(r["failed"]) if r["failed"] else ""))
+    logging.info("Total command wall time {:.1f}s".format(total))
+    peak = max([rec.get("peak_rss_kb",0) for rec in records] or [0])
+    if peak:
+        logging.info("Largest child process RSS {:.1f} MB".format(peak / 1024.0))
+    return rows
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='telemetry.py',
+    description='Summarize the command telemetry of processing runs')
+  parser.add_argument("logs",nargs="+",help="Telemetry JSON lines files")
+  args = parser.parse_args()
+
+  logging.basicConfig(format='%(message)s',level=logging.INFO)
+
+  for name in args.logs:
+      summary(name)
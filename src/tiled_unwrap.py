@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+import logging
+import argparse
+import os
+import math
+import time
+import shutil
+import resource
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+from telemetry import execute
+from gamma_io import par, read_raster, create_raster, FLOAT, FCOMPLEX
+from pipeline import Pipeline
+
+# Default number of patches unwrapped at once
+UNWRAP_WORKERS = min(4,multiprocessing.cpu_count())
+
+# Rough memory mcf needs per pixel of a patch (network, flows and rasters)
+MCF_BYTES_PER_PIXEL = 160
+
+# Share of the available memory the patches running at once may use
+MEMORY_SHARE = 0.7
+
+# Patches are not made smaller than this; below it the network costs of
+# the seams outweigh the gain
+MIN_PATCH_PIXELS = 1000*1000
+
+# Pixels each patch extends into its neighbours, used to tie them together
+OVERLAP = 64
+
+# Fewest pixels valid in both patches for an overlap to be trusted
+MIN_OVERLAP_PIXELS = 200
+
+TWO_PI = 2.0*np.pi
+
+def available_memory():
+    try:
+        f = open("/proc/meminfo","r")
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                f.close()
+                return int(line.split()[1])*1024
+        f.close()
+    except IOError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")//2
+
+#
+# Number of patches in range and azimuth for a width x nlines interferogram.
+# Each of the workers patches running at once has to fit its share of
+# memory, and large scenes are split into at least workers patches so all
+# of them are busy.  Patches are kept about square.
+#
+def plan_patches(width,nlines,workers=UNWRAP_WORKERS,memory=None):
+    if memory is None:
+        memory = available_memory()
+    workers = max(1,workers)
+    pixels = float(width)*nlines
+    budget = max(MIN_PATCH_PIXELS,MEMORY_SHARE*memory/workers/MCF_BYTES_PER_PIXEL)
+    count = int(math.ceil(pixels/budget))
+    count = max(count,min(workers,int(pixels//MIN_PATCH_PIXELS)),1)
+    npr = max(1,min(int(round(math.sqrt(count*float(width)/nlines))),width//(4*OVERLAP)))
+    npa = max(1,min(int(math.ceil(count/float(npr))),nlines//(4*OVERLAP)))
+    return npr,npa
+
+#
+# Core (without overlap) and full extents of every patch as
+# (r0,r1,a0,a1) boxes, in row major order
+#
+def patch_boxes(width,nlines,npr,npa):
+    re = np.linspace(0,width,npr+1).astype(int)
+    ae = np.linspace(0,nlines,npa+1).astype(int)
+    boxes = []
+    for i in range(npa):
+        for j in range(npr):
+            core = (re[j],re[j+1],ae[i],ae[i+1])
+            full = (max(0,re[j]-OVERLAP),min(width,re[j+1]+OVERLAP),
+                    max(0,ae[i]-OVERLAP),min(nlines,ae[i+1]+OVERLAP))
+            boxes.append((core,full))
+    return boxes
+
+def cut_raster(name,out,width,type,box):
+    r0,r1,a0,a1 = box
+    data = read_raster(name,width,type=type)
+    np.ascontiguousarray(data[a0:a1,r0:r1]).tofile(out)
+
+def cut_mask(name,out,box):
+    r0,r1,a0,a1 = box
+    src = gdal.Open(name)
+    band = src.GetRasterBand(1)
+    data = band.ReadAsArray(int(r0),int(a0),int(r1-r0),int(a1-a0))
+    dst = gdal.GetDriverByName("BMP").Create(out,int(r1-r0),int(a1-a0),1,gdal.GDT_Byte)
+    if band.GetColorTable() is not None:
+        dst.GetRasterBand(1).SetColorTable(band.GetColorTable())
+    dst.GetRasterBand(1).WriteArray(data)
+    dst = None
+    src = None
+
+#
+# Whole cycles to add to patch b to match patch a over their overlap, and
+# the number of pixels unwrapped in both
+#
+def overlap_offset(a,b):
+    valid = (a != 0) & (b != 0)
+    count = int(valid.sum())
+    if count < MIN_OVERLAP_PIXELS:
+        return 0,count
+    diff = a[valid].astype(np.float64) - b[valid]
+    return int(np.round(np.median(diff)/TWO_PI)),count
+
+#
+# Cycles to add to each patch.  The offsets of neighbouring patches are
+# tied together along a maximum spanning tree of the overlaps, weighted by
+# their valid pixel counts, so the most reliable seams decide; patches that
+# share nothing valid keep their own offset.
+#
+def reconcile(npatches,edges):
+    k = [None]*npatches
+    for root in range(npatches):
+        if k[root] is not None:
+            continue
+        k[root] = 0
+        while True:
+            best = None
+            for (a,b),(d,count) in edges.items():
+                if count < MIN_OVERLAP_PIXELS or (k[a] is None) == (k[b] is None):
+                    continue
+                if best is None or count > best[0]:
+                    best = (count,a,b,d)
+            if best is None:
+                break
+            count,a,b,d = best
+            if k[b] is None:
+                k[b] = k[a] + d
+            else:
+                k[a] = k[b] - d
+    return k
+
+#
+# Unwrap the patches of an interferogram separately and stitch them into
+# unw, shifting each by the whole cycles that make the overlaps agree
+#
+def stitch(names,boxes,npr,npa,unw,width,nlines):
+    tiles = []
+    for name,(core,full) in zip(names,boxes):
+        tiles.append(read_raster(name,full[1]-full[0],type=FLOAT))
+
+    edges = {}
+    for t in range(len(boxes)):
+        i,j = divmod(t,npr)
+        for u in ([t+1] if j+1 < npr else []) + ([t+npr] if i+1 < npa else []):
+            fa = boxes[t][1]
+            fb = boxes[u][1]
+            r0,r1 = max(fa[0],fb[0]),min(fa[1],fb[1])
+            a0,a1 = max(fa[2],fb[2]),min(fa[3],fb[3])
+            a = tiles[t][a0-fa[2]:a1-fa[2],r0-fa[0]:r1-fa[0]]
+            b = tiles[u][a0-fb[2]:a1-fb[2],r0-fb[0]:r1-fb[0]]
+            edges[(t,u)] = overlap_offset(a,b)
+    k = reconcile(len(boxes),edges)
+
+    # Overlap pixels still disagreeing after the shifts measure the seams
+    bad = 0
+    total = 0
+    for (t,u),(d,count) in edges.items():
+        if count >= MIN_OVERLAP_PIXELS and k[u] - k[t] != d:
+            bad += count
+        total += count
+    if total:
+        logging.info("Patch overlaps: {} pixels, {:.2f}% in seams left unreconciled".format(
+                     total,100.0*bad/total))
+
+    out = create_raster(unw,width,nlines,type=FLOAT)
+    for tile,(core,full),cycles in zip(tiles,boxes,k):
+        r0,r1,a0,a1 = core
+        data = np.array(tile[a0-full[2]:a1-full[2],r0-full[0]:r1-full[0]],dtype=np.float32)
+        if cycles:
+            data[data != 0] += TWO_PI*cycles
+        out[a0:a1,r0:r1] = data
+    out.flush()
+    del out
+
+#
+# mcf over an interferogram split into patches sized for the memory and
+# processors at hand and unwrapped workers at a time.  Same inputs and
+# output as the single mcf command.
+#
+def tiled_mcf(ifg,cc,mask,unw,parfile,trimode=0,workers=UNWRAP_WORKERS,memory=None):
+    t0 = time.time()
+    width,nlines = par(parfile).shape()
+    npr,npa = plan_patches(width,nlines,workers,memory)
+    logging.info("Unwrapping {} x {} interferogram in {} x {} patches, {} at a time".format(
+                 width,nlines,npr,npa,min(workers,npr*npa)))
+
+    if npr*npa == 1:
+        cmd = "mcf {} {} {} {} {} {} 0 0 - - 1 1".format(ifg,cc,mask,unw,width,trimode)
+        execute(cmd,uselogging=True)
+        logging.info("Unwrapped in {:.1f}s".format(time.time()-t0))
+        return
+
+    tmp = "{}.patches".format(unw)
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    boxes = patch_boxes(width,nlines,npr,npa)
+    p = Pipeline("mcf patches")
+    names = []
+    for t,(core,full) in enumerate(boxes):
+        base = os.path.join(tmp,"{:03d}".format(t))
+        cut_raster(ifg,base+".int",width,FCOMPLEX,full)
+        cut_raster(cc,base+".cc",width,FLOAT,full)
+        m = "-"
+        if os.path.isfile(mask):
+            m = base+".bmp"
+            cut_mask(mask,m,full)
+        cmd = "mcf {B}.int {B}.cc {M} {B}.unw {W} {TRI} 0 0 - - 1 1".format(B=base,M=m,W=full[1]-full[0],TRI=trimode)
+        p.add("mcf {:03d}".format(t),cmd,inputs=[base+".int",base+".cc"],outputs=[base+".unw"],
+              logfile=base+".log")
+        names.append(base+".unw")
+    p.run(workers=workers,force=True)
+
+    stitch(names,boxes,npr,npa,unw,width,nlines)
+    shutil.rmtree(tmp,ignore_errors=True)
+    # Only the peak over every child run so far is known, not that of mcf
+    logging.info("Unwrapped {} patches in {:.1f}s; largest child process so far used {:.0f} MB".format(
+                 len(boxes),time.time()-t0,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0))
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(prog='tiled_unwrap.py',
+    description='Unwrap an interferogram with mcf in patches run concurrently')
+  parser.add_argument("ifg",help='Filtered interferogram (e.g. <ifg>.diff0.man.adf)')
+  parser.add_argument("cc",help='Coherence (e.g. <ifg>.adf.cc)')
+  parser.add_argument("mask",help='Mask raster (e.g. <ifg>.adf.cc_mask.bmp) or -')
+  parser.add_argument("unw",help='Unwrapped output')
+  parser.add_argument("off",help='Offset parameter file giving the interferogram size')
+  parser.add_argument("-t","--tri",default=0,help="Triangulation method for mcf: 0) filled triangular mesh (default); 1) Delaunay triangulation")
+  parser.add_argument("-w","--workers",default=UNWRAP_WORKERS,type=int,
+    help="Number of patches to unwrap concurrently (def={})".format(UNWRAP_WORKERS))
+  args = parser.parse_args()
+
+  logFile = "tiled_unwrap_log.txt"
+  logging.basicConfig(filename=logFile,format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p',level=logging.INFO)
+  logging.getLogger().addHandler(logging.StreamHandler())
+  logging.info("Starting run")
+
+  tiled_mcf(args.ifg,args.cc,args.mask,args.unw,args.off,trimode=args.tri,workers=args.workers)
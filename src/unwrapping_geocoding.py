@@ -3,27 +3,57 @@
 import logging
 import argparse
 import os
-from getParameter import getParameter
-from execute import execute
+import multiprocessing
+from gamma_io import par
+from pipeline import Pipeline
+from geocode_native import geocode_layers, geocode_raster
+from geotiff_writer import write_geotiff
+from tiled_unwrap import tiled_mcf, UNWRAP_WORKERS
+from multires_unwrap import multires_mcf, factor_arg, MULTIRES_FACTOR
+from displacement import displacement_maps
 
-def geocode_back(inname,outname,width,lt,demw,demn,type):
+# Default number of geocode_back/data2geotiff chains run at once
+GEOCODE_WORKERS = min(4,multiprocessing.cpu_count())
+
+def geocode_back(p,inname,outname,width,lt,demw,demn,type,native=False):
+    if native and type == 2:
+        p.add("geocode_raster {}".format(outname),func=geocode_raster,args=(inname,outname,width,lt,demw,demn),
+              inputs=[inname,lt],outputs=[outname])
+        return
     cmd = "geocode_back {IN} {W} {LT} {OUT} {DEMW} {DEMN} 0 {TYPE}".format(IN=inname,W=width,LT=lt,OUT=outname,DEMW=demw,DEMN=demn,TYPE=type)
-    execute(cmd,uselogging=True)
+    p.add("geocode_back {}".format(outname),cmd,inputs=[inname,lt],outputs=[outname])
+
+#
+# Geocode all FLOAT and FCOMPLEX layers in one node that reads the lookup
+# table once
+#
+def geocode_native(p,layers,lt,demw,demn):
+    p.add("geocode_native",func=geocode_layers,args=(layers,lt,demw,demn),
+          inputs=[l[0] for l in layers]+[lt],outputs=[l[1] for l in layers])
 
-def data2geotiff(inname,outname,dempar,type):
+def data2geotiff(p,inname,outname,dempar,type,cog=False):
+    if cog:
+        p.add("write_geotiff {}".format(outname),func=write_geotiff,args=(inname,outname,dempar,type),
+              inputs=[inname,dempar],outputs=[outname])
+        return
     cmd = "data2geotiff {DEM} {IN} {TYPE} {OUT}".format(DEM=dempar,IN=inname,OUT=outname,TYPE=type)
-    execute(cmd,uselogging=True)
+    p.add("data2geotiff {}".format(outname),cmd,inputs=[inname,dempar],outputs=[outname])
 
-def unwrapping_geocoding(master, slave, step="man", rlooks=10, alooks=2, trimode=0, 
-    npatr=1, npata=1, alpha=0.6):
+#
+# tile_workers > 0 replaces the single mcf run by patches sized to the
+# scene and memory and unwrapped that many at a time.  multires > 1 instead
+# unwraps with that many more looks and carries the solution back to full
+# resolution (see multires_unwrap); with compare_mcf plain mcf is run too
+# to measure how far the two agree.
+#
+def unwrapping_pipeline(master, slave, step="man", rlooks=10, alooks=2, trimode=0, 
+    npatr=1, npata=1, alpha=0.6, tile_workers=0, multires=0, compare_mcf=False):
     
-    dem = "./DEM/demseg"
     dempar = "./DEM/demseg.par"
     lt = "./DEM/MAP2RDC"
     ifgname="{}_{}".format(master,slave)
     offit = "{}.off.it".format(ifgname)
     mmli = master + ".mli"
-    smli = slave + ".mli"
     
     if not os.path.isfile(dempar):
         logging.error("ERROR: Unable to find dem par file {}".format(dempar))
@@ -34,38 +64,31 @@ def unwrapping_geocoding(master, slave, step="man", rlooks=10, alooks=2, trimode
     if not os.path.isfile(offit):
         logging.error("ERROR: Unable to find offset file {}".format(offit))
     
-    width = getParameter(offit,"interferogram_width")
-    nline = getParameter(offit,"interferogram_azimuth_lines")
-    mwidth = getParameter(mmli+".par","range_samples")
-    swidth = getParameter(smli+".par","range_samples")
-    demw = getParameter(dempar,"width")
-    demn = getParameter(dempar,"nlines")
+    width = par(offit).int("interferogram_width")
     
     ifgf = "{}.diff0.{}".format(ifgname,step)
     
     logging.info("{} will be used for unwrapping and geocoding".format(ifgf))
-    
-    logging.info("-------------------------------------------------")
-    logging.info("            Start unwrapping")
-    logging.info("-------------------------------------------------")
+
+    p = Pipeline("unwrapping")
 
     cmd = "cc_wave {IFGF} {MMLI} - {IFG}.cc {W}".format(IFGF=ifgf,IFG=ifgname,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
+    p.add("cc_wave",cmd,inputs=[ifgf,mmli],outputs=["{}.cc".format(ifgname)])
  
     cmd = "rascc {IFG}.cc {MMLI} {W} 1 1 0 1 1 .1 .9 - - - {IFG}.cc.ras".format(IFG=ifgname,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
+    p.add("rascc",cmd,inputs=["{}.cc".format(ifgname),mmli],outputs=["{}.cc.ras".format(ifgname)])
     
     cmd = "adf {IFGF} {IFGF}.adf {IFG}.adf.cc {W} {A} - 5".format(IFGF=ifgf,IFG=ifgname,W=width,A=alpha)
-    execute(cmd,uselogging=True)
+    p.add("adf",cmd,inputs=[ifgf],outputs=["{}.adf".format(ifgf),"{}.adf.cc".format(ifgname)])
     
     cmd = "rasmph_pwr {IFGF}.adf {MMLI} {W}".format(IFGF=ifgf,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
+    p.add("rasmph_pwr",cmd,inputs=["{}.adf".format(ifgf),mmli],outputs=["{}.adf.bmp".format(ifgf)])
     
     cmd = "rascc {IFG}.adf.cc {MMLI} {W} 1 1 0 1 1 .1 .9 - - - {IFG}.adf.cc.ras".format(IFG=ifgname,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
+    p.add("rascc adf",cmd,inputs=["{}.adf.cc".format(ifgname),mmli],outputs=["{}.adf.cc.ras".format(ifgname)])
     
     cmd = "rascc_mask {IFG}.adf.cc {MMLI} {W} 1 1 0 1 1 0.10 0.20 ".format(IFG=ifgname,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
+    p.add("rascc_mask",cmd,inputs=["{}.adf.cc".format(ifgname),mmli],outputs=["{}.adf.cc_mask.bmp".format(ifgname)])
     
     cmd = "mcf {IFGF}.adf {IFG}.adf.cc {IFG}.adf.cc_mask.bmp {IFG}.adf.unw {W} {TRI} 0 0 - - {NPR} {NPA}".format(
         IFGF=ifgf,IFG=ifgname,W=width,TRI=trimode,NPR=npatr,NPA=npata)
@@ -73,68 +96,195 @@ def unwrapping_geocoding(master, slave, step="man", rlooks=10, alooks=2, trimode
 #    cmd = "mcf {IFGF}.adf {IFG}.adf.cc - {IFG}.adf.unw {W} {TRI} 0 0 - - {NPR} {NPA}".format(
 #        IFGF=ifgf,IFG=ifgname,W=width,TRI=trimode,NPR=npatr,NPA=npata)
 
-    execute(cmd,uselogging=True)
+    inputs = ["{}.adf".format(ifgf),"{}.adf.cc".format(ifgname),"{}.adf.cc_mask.bmp".format(ifgname)]
+    if multires > 1:
+        p.add("mcf",func=multires_mcf,args=inputs+["{}.adf.unw".format(ifgname),offit],
+              kwargs={"trimode": trimode, "factor": multires, "workers": tile_workers or UNWRAP_WORKERS,
+                      "compare": compare_mcf},inputs=inputs,outputs=["{}.adf.unw".format(ifgname)])
+    elif tile_workers:
+        p.add("mcf",func=tiled_mcf,args=inputs+["{}.adf.unw".format(ifgname),offit],
+              kwargs={"trimode": trimode, "workers": tile_workers},inputs=inputs,outputs=["{}.adf.unw".format(ifgname)])
+    else:
+        p.add("mcf",cmd,inputs=inputs,outputs=["{}.adf.unw".format(ifgname)])
     
     cmd="rasrmg {IFG}.adf.unw {MMLI} {W} 1 1 0 1 1 0.33333 1.0 .35 0.0 - {IFG}.adf.unw.ras".format(IFG=ifgname,MMLI=mmli,W=width)
-    execute(cmd,uselogging=True)
-    
-    cmd = "dispmap {IFG}.adf.unw DEM/HGT_SAR_{RL}_{AL} {MMLI}.par - {IFG}.vert.disp 1".format(IFG=ifgname,RL=rlooks,AL=alooks,MMLI=mmli)
-    execute(cmd,uselogging=True)
-    
-    cmd = "rashgt {IFG}.vert.disp - {W} 1 1 0 1 1 0.028".format(IFG=ifgname,W=width)
-    execute(cmd,uselogging=True)
-    
-    cmd = "dispmap {IFG}.adf.unw DEM/HGT_SAR_{RL}_{AL} {MMLI}.par - {IFG}.los.disp 0".format(IFG=ifgname,RL=rlooks,AL=alooks,MMLI=mmli)
-    execute(cmd,uselogging=True)
+    p.add("rasrmg",cmd,inputs=["{}.adf.unw".format(ifgname),mmli],outputs=["{}.adf.unw.ras".format(ifgname)])
+
+    return p
+
+def geocoding_pipeline(master, slave, step="man", native=False, targets=None, cog=False, keep=True,
+    enu=False):
+
+    dem = "./DEM/demseg"
+    dempar = "./DEM/demseg.par"
+    lt = "./DEM/MAP2RDC"
+    ifgname="{}_{}".format(master,slave)
+    offit = "{}.off.it".format(ifgname)
+    mmli = master + ".mli"
+    smli = slave + ".mli"
+
+    width = par(offit).int("interferogram_width")
+    mwidth = par(mmli+".par").int("range_samples")
+    swidth = par(smli+".par").int("range_samples")
+    demw,demn = par(dempar).shape()
+
+    ifgf = "{}.diff0.{}".format(ifgname,step)
+
+    layers = [(mmli,mmli+".geo",mwidth,0),
+              (smli,smli+".geo",swidth,0),
+              ("{}.sim_unw".format(ifgname),"{}.sim_unw.geo".format(ifgname),width,0),
+              ("{}.adf.unw".format(ifgname),"{}.adf.unw.geo".format(ifgname),width,0),
+              ("{}.adf".format(ifgf),"{}.adf.geo".format(ifgf),width,1),
+              ("{}.adf.unw.ras".format(ifgname),"{}.adf.unw.geo.bmp".format(ifgname),width,2),
+              ("{}.adf.bmp".format(ifgf),"{}.adf.bmp.geo".format(ifgf),width,2),
+              ("{}.cc".format(ifgname),"{}.cc.geo".format(ifgname),width,0),
+              ("{}.adf.cc".format(ifgname),"{}.adf.cc.geo".format(ifgname),width,0)]
+
+    components = ["vert","los"]
+    if enu:
+        components += ["east","north","up"]
+    disp = dict((c,"{}.{}.disp.geo".format(ifgname,c)) for c in components)
+
+    # The geocoded binaries are only kept until they are written as GeoTIFFs
+    p = Pipeline("geocoding",keep=keep)
+    p.temporary([l[1] for l in layers])
+    p.temporary(disp.values())
+    p.temporary(["{}.bmp".format(disp["vert"]),"{}.bmp".format(disp["los"])])
+
+    if native:
+        # The single native node must only read the layers the targets need
+        if targets is not None:
+            needed = set(geocoding_inputs(master, slave, step=step, targets=targets))
+            layers = [l for l in layers if l[0] in needed]
+        merged = [l for l in layers if l[3] != 2]
+        if merged:
+            geocode_native(p,merged,lt,demw,demn)
+        layers = [l for l in layers if l[3] == 2]
+
+    for inname,outname,w,type in layers:
+        geocode_back(p,inname,outname,w,lt,demw,demn,type,native=native)
+
+    data2geotiff(p,mmli+".geo",mmli+".geo.tif",dempar,2,cog=cog)
+    data2geotiff(p,smli+".geo",smli+".geo.tif",dempar,2,cog=cog)
+    data2geotiff(p,"{}.sim_unw.geo".format(ifgname),"{}.sim_unw.geo.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"{}.adf.unw.geo".format(ifgname),"{}.adf.unw.geo.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"{}.adf.unw.geo.bmp".format(ifgname),"{}.adf.unw.geo.bmp.tif".format(ifgname),dempar,0,cog=cog)
+    data2geotiff(p,"{}.adf.bmp.geo".format(ifgf),"{}.adf.bmp.geo.tif".format(ifgf),dempar,0,cog=cog)
+    data2geotiff(p,"{}.cc.geo".format(ifgname),"{}.cc.geo.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"{}.adf.cc.geo".format(ifgname),"{}.adf.cc.geo.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"DEM/demseg","{}.dem.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"DEM/inc_flat","{}.inc.tif".format(ifgname),dempar,2,cog=cog)
+    cmd = "look_vector {MMLI}.par {OFFIT} {DEMPAR} {DEM} lv_theta lv_phi".format(MMLI=mmli,OFFIT=offit,DEMPAR=dempar,DEM=dem)
+    p.add("look_vector",cmd,inputs=[mmli+".par",offit,dempar,dem],outputs=["lv_theta","lv_phi"])
+
+    # All displacement maps in one pass over the geocoded phase and look
+    # vectors, instead of dispmap runs in radar geometry that are then
+    # geocoded one by one
+    unwgeo = "{}.adf.unw.geo".format(ifgname)
+    p.add("displacement",func=displacement_maps,args=(unwgeo,"lv_theta","lv_phi",mmli+".par",demw,disp),
+          inputs=[unwgeo,"lv_theta","lv_phi",mmli+".par"],outputs=[disp[c] for c in components])
+    for c in ("vert","los"):
+        cmd = "rashgt {DISP} - {W} 1 1 0 1 1 0.028".format(DISP=disp[c],W=demw)
+        p.add("rashgt {}".format(c),cmd,inputs=[disp[c]],outputs=["{}.bmp".format(disp[c])])
+        data2geotiff(p,"{}.bmp".format(disp[c]),"{}.{}.disp.geo.tif".format(ifgname,c),dempar,0,cog=cog)
+    for c in components:
+        data2geotiff(p,disp[c],"{}.{}.disp.geo.org.tif".format(ifgname,c),dempar,2,cog=cog)
+    data2geotiff(p,"lv_theta","{}.lv_theta.tif".format(ifgname),dempar,2,cog=cog)
+    data2geotiff(p,"lv_phi","{}.lv_phi.tif".format(ifgname),dempar,2,cog=cog)
+
+    return p
+
+#
+# The geocoded layers that make up the products; only these and what they
+# are built from gets computed
+#
+def product_targets(master, slave, step="man", los_flag=False, inc_flag=False, look_flag=False,
+    enu_flag=False):
+    ifgname="{}_{}".format(master,slave)
+    ifgf = "{}.diff0.{}".format(ifgname,step)
+    targets = ["{}.mli.geo.tif".format(master),
+               "{}.cc.geo.tif".format(ifgname),
+               "{}.vert.disp.geo.org.tif".format(ifgname),
+               "{}.adf.unw.geo.tif".format(ifgname),
+               "{}.adf.bmp.geo.tif".format(ifgf),
+               "{}.adf.unw.geo.bmp.tif".format(ifgname)]
+    # Layers of the HDF5 product (see makeHDF5List)
+    targets += ["{}.mli.geo.tif".format(slave),
+                "{}.dem.tif".format(ifgname),
+                "{}.sim_unw.geo.tif".format(ifgname),
+                "{}.adf.cc.geo.tif".format(ifgname),
+                "{}.vert.disp.geo.tif".format(ifgname)]
+    if los_flag:
+        targets.append("{}.los.disp.geo.org.tif".format(ifgname))
+    if inc_flag:
+        targets.append("{}.inc.tif".format(ifgname))
+    if look_flag:
+        targets += ["{}.lv_theta.tif".format(ifgname),"{}.lv_phi.tif".format(ifgname)]
+    if enu_flag:
+        targets += ["{}.{}.disp.geo.org.tif".format(ifgname,c) for c in ("east","north","up")]
+    return targets
+
+#
+# Radar geometry files the geocoding of the given targets reads
+#
+def geocoding_inputs(master, slave, step="man", targets=None, enu=False):
+    p = geocoding_pipeline(master, slave, step=step, enu=enu)
+    inputs = set()
+    for node in p.select(targets):
+        inputs.update(f for f in node.inputs if f not in p.producers)
+    return sorted(inputs)
+
+def unwrapping(master, slave, step="man", rlooks=10, alooks=2, trimode=0, 
+    npatr=1, npata=1, alpha=0.6, workers=1, targets=None, tile_workers=0, multires=0, compare_mcf=False):
+
+    p = unwrapping_pipeline(master, slave, step=step, rlooks=rlooks, alooks=alooks, trimode=trimode,
+        npatr=npatr, npata=npata, alpha=alpha, tile_workers=tile_workers, multires=multires,
+        compare_mcf=compare_mcf)
+    if targets is not None:
+        targets = [f for f in targets if f in p.producers]
     
-    cmd = "rashgt {IFG}.los.disp - {W} 1 1 0 1 1 0.028".format(IFG=ifgname,W=width)
-    execute(cmd,uselogging=True)
+    logging.info("-------------------------------------------------")
+    logging.info("            Start unwrapping")
+    logging.info("-------------------------------------------------")
+
+    p.run(workers=workers,targets=targets)
   
     logging.info("-------------------------------------------------")
     logging.info("            End unwrapping")
     logging.info("-------------------------------------------------")
     
+#
+# Every layer is an independent geocode_back -> data2geotiff chain, so the
+# layers are run concurrently; a failed layer doesn't stop the others and
+# all failures are reported together at the end
+#
+def geocoding(master, slave, step="man", workers=GEOCODE_WORKERS, targets=None, native=False,
+    cog=False, keep=False, enu=False):
+
+    p = geocoding_pipeline(master, slave, step=step, native=native, targets=targets, cog=cog, keep=keep,
+        enu=enu)
+
     logging.info("-------------------------------------------------")
     logging.info("            Start geocoding")
     logging.info("-------------------------------------------------")
-    
-    geocode_back(mmli,mmli+".geo",mwidth,lt,demw,demn,0)
-    geocode_back(smli,smli+".geo",swidth,lt,demw,demn,0)
-    geocode_back("{}.sim_unw".format(ifgname),"{}.sim_unw.geo".format(ifgname),width,lt,demw,demn,0)
-    geocode_back("{}.adf.unw".format(ifgname),"{}.adf.unw.geo".format(ifgname),width,lt,demw,demn,0)
-    geocode_back("{}.adf".format(ifgf),"{}.adf.geo".format(ifgf),width,lt,demw,demn,1)
-    geocode_back("{}.adf.unw.ras".format(ifgname),"{}.adf.unw.geo.bmp".format(ifgname),width,lt,demw,demn,2)
-    geocode_back("{}.adf.bmp".format(ifgf),"{}.adf.bmp.geo".format(ifgf),width,lt,demw,demn,2)
-    geocode_back("{}.cc".format(ifgname),"{}.cc.geo".format(ifgname),width,lt,demw,demn,0)
-    geocode_back("{}.adf.cc".format(ifgname),"{}.adf.cc.geo".format(ifgname),width,lt,demw,demn,0)
-    geocode_back("{}.vert.disp.bmp".format(ifgname),"{}.vert.disp.bmp.geo".format(ifgname),width,lt,demw,demn,2)
-    geocode_back("{}.vert.disp".format(ifgname),"{}.vert.disp.geo".format(ifgname),width,lt,demw,demn,0)
-    geocode_back("{}.los.disp.bmp".format(ifgname),"{}.los.disp.bmp.geo".format(ifgname),width,lt,demw,demn,2)
-    geocode_back("{}.los.disp".format(ifgname),"{}.los.disp.geo".format(ifgname),width,lt,demw,demn,0)
-
-    data2geotiff(mmli+".geo",mmli+".geo.tif",dempar,2)
-    data2geotiff(smli+".geo",smli+".geo.tif",dempar,2)
-    data2geotiff("{}.sim_unw.geo".format(ifgname),"{}.sim_unw.geo.tif".format(ifgname),dempar,2)
-    data2geotiff("{}.adf.unw.geo".format(ifgname),"{}.adf.unw.geo.tif".format(ifgname),dempar,2)
-    data2geotiff("{}.adf.unw.geo.bmp".format(ifgname),"{}.adf.unw.geo.bmp.tif".format(ifgname),dempar,0)
-    data2geotiff("{}.adf.bmp.geo".format(ifgf),"{}.adf.bmp.geo.tif".format(ifgf),dempar,0)
-    data2geotiff("{}.cc.geo".format(ifgname),"{}.cc.geo.tif".format(ifgname),dempar,2)
-    data2geotiff("{}.adf.cc.geo".format(ifgname),"{}.adf.cc.geo.tif".format(ifgname),dempar,2)
-    data2geotiff("DEM/demseg","{}.dem.tif".format(ifgname),dempar,2)
-    data2geotiff("{}.vert.disp.bmp.geo".format(ifgname),"{}.vert.disp.geo.tif".format(ifgname),dempar,0)
-    data2geotiff("{}.vert.disp.geo".format(ifgname),"{}.vert.disp.geo.org.tif".format(ifgname),dempar,2)
-    data2geotiff("{}.los.disp.bmp.geo".format(ifgname),"{}.los.disp.geo.tif".format(ifgname),dempar,0)
-    data2geotiff("{}.los.disp.geo".format(ifgname),"{}.los.disp.geo.org.tif".format(ifgname),dempar,2)
-    data2geotiff("DEM/inc_flat","{}.inc.tif".format(ifgname),dempar,2)
-    cmd = "look_vector {MMLI}.par {OFFIT} {DEMPAR} {DEM} lv_theta lv_phi".format(MMLI=mmli,OFFIT=offit,DEMPAR=dempar,DEM=dem)
-    execute(cmd,uselogging=True)
-    data2geotiff("lv_theta","{}.lv_theta.tif".format(ifgname),dempar,2)
-    data2geotiff("lv_phi","{}.lv_phi.tif".format(ifgname),dempar,2)
+
+    p.run(workers=workers,targets=targets)
     
     logging.info("-------------------------------------------------")
     logging.info("            End geocoding")
     logging.info("-------------------------------------------------")
     
+def unwrapping_geocoding(master, slave, step="man", rlooks=10, alooks=2, trimode=0, 
+    npatr=1, npata=1, alpha=0.6, workers=1, geocode_workers=GEOCODE_WORKERS, targets=None,
+    native=False, cog=False, keep=False, tile_workers=0, multires=0, compare_mcf=False, enu=False):
+
+    unwrapping(master, slave, step=step, rlooks=rlooks, alooks=alooks, trimode=trimode,
+        npatr=npatr, npata=npata, alpha=alpha, workers=workers, tile_workers=tile_workers,
+        multires=multires, compare_mcf=compare_mcf,
+        targets=None if targets is None else geocoding_inputs(master, slave, step=step, targets=targets, enu=enu))
+    geocoding(master, slave, step=step, workers=geocode_workers, targets=targets, native=native, cog=cog,
+        keep=keep, enu=enu)
+
 
 if __name__ == '__main__':
     
@@ -149,6 +299,23 @@ if __name__ == '__main__':
   parser.add_argument("--alpha",default=0.6,type=float,help="adf filter alpha value (def=0.6)")
   parser.add_argument("--npatr",default=1,help="Number of patches in range (def=1)")
   parser.add_argument("--npata",default=1,help="Number of patches in azimuth (def=1)")
+  parser.add_argument("--tiled",nargs="?",const=UNWRAP_WORKERS,default=0,type=int,metavar="N",
+    help="Unwrap in patches sized from the scene and memory, N at a time (def N={}); overrides --npatr/--npata".format(UNWRAP_WORKERS))
+  parser.add_argument("--multires",nargs="?",const=MULTIRES_FACTOR,default=0,type=factor_arg,metavar="F",
+    help="Unwrap with F times more looks and refine the result at full resolution (def F={})".format(MULTIRES_FACTOR))
+  parser.add_argument("--compare-mcf",action="store_true",
+    help="With --multires, also run plain mcf and report the share of pixels whose cycles disagree")
+  parser.add_argument("-w","--workers",default=1,type=int,help="Number of unwrapping commands to run concurrently (def=1)")
+  parser.add_argument("-g","--geocode-workers",default=GEOCODE_WORKERS,type=int,
+    help="Number of layers to geocode concurrently (def={})".format(GEOCODE_WORKERS))
+  parser.add_argument("--native-geocode",action="store_true",
+    help="Geocode the data layers in a single pass in python instead of with geocode_back")
+  parser.add_argument("--cog",action="store_true",
+    help="Write compressed cloud optimized GeoTIFFs with GDAL instead of using data2geotiff")
+  parser.add_argument("--keep-intermediates",action="store_true",
+    help="Keep the geocoded binaries after they are written as GeoTIFFs")
+  parser.add_argument("--enu",action="store_true",
+    help="Also write the east, north and up components of the line of sight displacement")
   args = parser.parse_args()
 
   logFile = "unwrapping_geocoding_log.txt"
@@ -158,4 +325,7 @@ if __name__ == '__main__':
   logging.info("Starting run")
 
   unwrapping_geocoding(args.master, args.slave, step=args.step, rlooks=args.rlooks, alooks=args.alooks,
-      trimode=args.tri,npatr=args.npatr,npata=args.npata,alpha=args.alpha)
+      trimode=args.tri,npatr=args.npatr,npata=args.npata,alpha=args.alpha,workers=args.workers,
+      geocode_workers=args.geocode_workers,native=args.native_geocode,
+      cog=args.cog,keep=args.keep_intermediates,tile_workers=args.tiled,
+      multires=args.multires,compare_mcf=args.compare_mcf,enu=args.enu)